@@ -1,4 +1,5 @@
 import click
+import json
 from dicom.services.find import Find
 from dicom.config.server_config import TelemisConfig
 from dicom.services.search_criteria import SearchCriteria
@@ -6,6 +7,21 @@ from pynetdicom import debug_logger
 from dicom.cli_options import common_dicom_options, build_search_criteria
 from dicom.services.get import Get
 from dicom.services.move import Move
+from dicom.services.sorter import sort_tree
+from dicom.services.catalog import LocalCatalog, DEFAULT_CATALOG_PATH
+from dicom.services.manifest import ManifestStore, verify as verify_manifests
+from dicom.services.export import FORMATS, export_tree, export_units
+from dicom.services.daemon import DaemonClient, DicomDaemon, api_server, default_address
+from dicom.services.durability import MODES as DURABILITY_MODES, DurableWriter
+from dicom.services.pack import PackStore, find_packs, pack_tree, series_folders, unpack_tree
+from dicom.services.volume import find_series_dirs, load_volume
+from dicom.services.fat_fraction import FF_PATTERNS, MASK_FRACTION, dixon_patient_dirs, fat_fraction_tree
+from dicom.services.t2map import T2MAP_PATTERN, fit_series_tree, t2_series_dirs
+from dicom.services.throttle import Throttler
+from dicom.services.benchmark import DEFAULT_PDU_SIZES, benchmark_pdu, find_node
+from dicom.services.tracing import tracer
+from dicom.services.records import record_class
+from dicom.services.result_writers import FORMATS as RESULT_FORMATS, open_writer
 from time import time
 
 # debug_logger()
@@ -14,26 +30,66 @@ find_service = Find(TelemisConfig)
 get_service = Get(TelemisConfig)
 move_service = Move(TelemisConfig)
 
+def _write_trace():
+    click.echo(click.style("\nTime per stage:", fg='cyan', bold=True))
+    tracer.log_summary(click.echo)
+    for path in tracer.write():
+        click.echo(f"I: Trace written: {path}")
+
+
 @click.group()
 @click.version_option(version='1.0.0', prog_name='Dicom CLI Tool')
-def cli():
+@click.option('--trace', is_flag=True, help='Record per-stage spans into <trace-dir>/<command>-<time>.trace.json (Chrome trace).')
+@click.option('--profile', is_flag=True, help='Also run each stage under cProfile, one .prof file per stage (implies --trace).')
+@click.option('--trace-dir', default='traces', show_default=True, help='Directory of the trace and profile files.')
+@click.option('--no-daemon', is_flag=True, help='Run search/get/move in this process even if a serve daemon is running.')
+@click.pass_context
+def cli(ctx, trace, profile, trace_dir, no_daemon):
     """DICOM Client - A command-line tool for managing DICOM files and servers."""
-    pass
+    ctx.obj = {'no_daemon': no_daemon}
+    if trace or profile:
+        tracer.enable(profile=profile, directory=trace_dir, prefix=ctx.invoked_subcommand or 'dicom-client')
+        ctx.call_on_close(_write_trace)
+
+
+def _daemon_client(ctx):
+    """Client of the serve daemon if one is running (and --no-daemon not given), else None"""
+    if (ctx.obj or {}).get('no_daemon'):
+        return None
+    client = DaemonClient.discover(TelemisConfig.DAEMON_ADDRESS)
+    if client is not None:
+        click.echo(click.style(f"I: Running on the daemon at {client.address}", fg='cyan'), err=True)
+    return client
 
 @cli.command()
 @common_dicom_options
-def search(**kwargs):  
+@click.option('--local', is_flag=True, help='Search the local catalog instead of the PACS.')
+@click.option('--catalog', default=DEFAULT_CATALOG_PATH, show_default=True, help='Path of the local catalog.')
+@click.option('--format', 'fmt', type=click.Choice(('table',) + RESULT_FORMATS), default='table', show_default=True, help='Print the results, or stream them as rows (one per study/series/instance).')
+@click.option('--output', '-o', type=click.Path(dir_okay=False), default=None, help='Output file of --format jsonl/csv/parquet (default: stdout, parquet needs a file).')
+@click.option('--limit', type=click.IntRange(min=1), default=None, help='Stop after N results (the C-FIND is cancelled early).')
+@click.pass_context
+def search(ctx, local, catalog, fmt, output, limit, **kwargs):
     """Search for DICOM studies based on provided criteria."""
-    click.echo(click.style("Searching DICOM studies...", fg='cyan', bold=True))
-
     criteria_kwargs = build_search_criteria(**kwargs)
-
     if not criteria_kwargs:
         return
+    client = None if local else _daemon_client(ctx)
+
+    if fmt != 'table':
+        export_search(SearchCriteria(**criteria_kwargs), local, catalog, fmt, output, limit, client)
+        return
+
+    click.echo(click.style("Searching DICOM studies...", fg='cyan', bold=True))
 
     try:
         criteria = SearchCriteria(**criteria_kwargs)
-        studies = find_service.search_data(criteria)
+        if local:
+            studies = LocalCatalog(catalog).search(criteria, limit)
+        elif client is not None:
+            studies = list(client.search(criteria, limit))
+        else:
+            studies = find_service.search_data(criteria, limit)
     except Exception as e:
         click.echo(click.style(f"Search error: {e}", fg='red', bold=True))
         return
@@ -42,15 +98,59 @@ def search(**kwargs):
         click.echo(click.style("No studies found.", fg='red', bold=True))
         return
 
-    click.echo(click.style(f"{len(studies)} study(ies) found.", fg='green', bold=True))
+    reached = " (limit reached)" if limit and len(studies) >= limit else ""
+    click.echo(click.style(f"{len(studies)} study(ies) found{reached}.", fg='green', bold=True))
     for idx, study in enumerate(studies, 1):
         click.echo(click.style(f"[{idx}]", fg='green', bold=True) + f" {study}")
 
+def export_search(criteria, local, catalog, fmt, output, limit=None, client=None):
+    """Write the search results row by row as they arrive; messages go to stderr"""
+    cls = record_class(criteria.level)
+    try:
+        writer = open_writer(fmt, cls, output)
+    except (ValueError, RuntimeError) as e:
+        click.echo(click.style(str(e), fg='red', bold=True), err=True)
+        return
+    start = time()
+    try:
+        if local:
+            records = (cls.from_identifier(ds) for ds in LocalCatalog(catalog).search(criteria, limit))
+        elif client is not None:
+            records = client.search(criteria, limit)
+        else:
+            records = find_service.iter_search(criteria, limit)
+        for record in records:
+            writer.write(record)
+    except Exception as e:
+        click.echo(click.style(f"Search error: {e}", fg='red', bold=True), err=True)
+    finally:
+        writer.close()
+    click.echo(click.style(f"{writer.rows} row(s) written to {output or 'stdout'} in {time() - start:.2f} seconds.",
+                           fg='green', bold=True), err=True)
+
+
 @cli.command()
 @common_dicom_options
-def get(**kwargs):
+@click.option('--throttle', multiple=True, help='Bandwidth window "HH:MM-HH:MM=<MB/s>[,<instances/s>]", repeatable (default: TelemisConfig.THROTTLE_SCHEDULE)')
+@click.option('--pack', is_flag=True, help='Append the instances to one <series>.zip pack per series instead of one file each.')
+@click.option('--durable', type=click.Choice(DURABILITY_MODES), default=TelemisConfig.DURABILITY, help='Fsync the files in batches before answering the C-STORE ("response") or recording them ("manifest").')
+@click.option('--fsync-window', type=float, default=TelemisConfig.FSYNC_WINDOW, show_default=True, help='Seconds a file waits for others to share its fsync batch.')
+@click.pass_context
+def get(ctx, throttle, pack, durable, fsync_window, **kwargs):
     """Retrieve DICOM files based on provided criteria."""
     click.echo(click.style("Retrieving DICOM files...", fg='cyan', bold=True))
+    client = _daemon_client(ctx)
+    if client is not None:
+        _run_on_daemon(client, 'get', kwargs, {'throttle': list(throttle), 'pack': pack, 'durable': durable,
+                                               'fsync_window': fsync_window})
+        return
+    # Opened here, not at import: --help and the other commands do not create the catalog
+    get_service.catalog = LocalCatalog()
+    get_service.packs = PackStore() if pack else None
+    get_service.durable = DurableWriter(durable, fsync_window, TelemisConfig.FSYNC_BATCH) if durable else None
+    get_service.manifest.fsync = get_service.durable is not None
+    schedule = list(throttle) or TelemisConfig.THROTTLE_SCHEDULE
+    get_service.throttler = Throttler(schedule) if schedule else None
     # Build initial search criteria (we will C-FIND at STUDY level to get StudyInstanceUIDs)
     criteria_kwargs = build_search_criteria(**kwargs)
     if not criteria_kwargs:
@@ -79,15 +179,12 @@ def get(**kwargs):
         click.echo(click.style(f"{len(study_uids)} study(ies) found. Starting retrieval...", fg='green'))
 
         total_files = 0
-        for uid in study_uids:
-            click.echo(click.style(f"Retrieving study {uid}...", fg='cyan'))
-            sc = SearchCriteria(level='STUDY', study_instance_uid=uid)
-            try:
-                received = get_service.retrieve_data(sc)
-                total_files += int(received)
-                click.echo(click.style(f"Received {received} files for study {uid}.", fg='green'))
-            except Exception as e:
-                click.echo(click.style(f"Error retrieving study {uid}: {e}", fg='red'))
+        # The UIDs are packed into C-GET requests of RETRIEVE_BATCH_SIZE studies
+        sc = SearchCriteria(level='STUDY', study_instance_uid=study_uids)
+        try:
+            total_files += int(get_service.retrieve_data(sc))
+        except Exception as e:
+            click.echo(click.style(f"Error retrieving studies: {e}", fg='red'))
     
     elif criteria.level == 'SERIES':
         series_list = []
@@ -100,21 +197,56 @@ def get(**kwargs):
         click.echo(click.style(f"{len(series_list)} series found. Starting retrieval...", fg='green'))
         
         total_files = 0
-        for study_uid, series_uid in series_list:
-            click.echo(click.style(f"Retrieving series {series_uid} from study {study_uid}...", fg='cyan'))
-            sc = SearchCriteria(level='SERIES', study_instance_uid=study_uid, series_instance_uid=series_uid)
+        # The UIDs are packed into C-GET requests of RETRIEVE_BATCH_SIZE series (per study)
+        sc = SearchCriteria(level='SERIES',
+                            study_instance_uid=[study_uid for study_uid, _ in series_list],
+                            series_instance_uid=[series_uid for _, series_uid in series_list])
+        try:
+            total_files += int(get_service.retrieve_data(sc))
+        except Exception as e:
+            click.echo(click.style(f"Error retrieving series: {e}", fg='red'))
+
+    elif criteria.level == 'IMAGE':
+        click.echo(click.style(f"{len(results)} instance(s) found. Starting retrieval...", fg='green'))
+
+        total_files = 0
+        for record in results:
+            sc = SearchCriteria(level='IMAGE', study_instance_uid=record.StudyInstanceUID,
+                                series_instance_uid=record.SeriesInstanceUID,
+                                sop_instance_uid=record.SOPInstanceUID)
             try:
                 received = get_service.retrieve_data(sc)
                 total_files += int(received)
-                click.echo(click.style(f"Received {received} files for series {series_uid}.", fg='green'))
             except Exception as e:
-                click.echo(click.style(f"Error retrieving series {series_uid}: {e}", fg='red'))
+                click.echo(click.style(f"Error retrieving instance {record.SOPInstanceUID}: {e}", fg='red'))
     
     else:
         click.echo(click.style(f"Unsupported query level: {criteria.level}", fg='red', bold=True))
         return
 
     click.echo(click.style(f"Total files retrieved: {total_files}", fg='yellow', bold=True))
+    if get_service.durable is not None:
+        get_service.durable.close()
+        click.echo(click.style(f"Durable writes: {get_service.durable.report()}", fg='cyan'))
+    if get_service.throttler is not None:
+        click.echo(click.style(f"Throttling: {get_service.throttler.report()}", fg='cyan'))
+
+
+def _run_on_daemon(client, kind, kwargs, options):
+    """Run a get/move job on the daemon and print its outcome"""
+    criteria_kwargs = build_search_criteria(**kwargs)
+    if not criteria_kwargs:
+        click.echo(click.style("No criteria provided.", fg='red'))
+        return
+    try:
+        result = client.run(kind, SearchCriteria(**criteria_kwargs), options)
+    except (OSError, RuntimeError) as e:
+        click.echo(click.style(f"Error on the daemon: {e}", fg='red', bold=True))
+        return
+    if not result['matches']:
+        click.echo(click.style("No matches found.", fg='red', bold=True))
+        return
+    click.echo(click.style(f"{result['matches']} match(es), total files retrieved: {result['files']}", fg='yellow', bold=True))
 
 
 move_service = Move(TelemisConfig)
@@ -124,8 +256,13 @@ from time import time
 @cli.command()
 @common_dicom_options
 @click.option('--destination', help='Destination AE Title')
-def move(destination, **kwargs):
+@click.pass_context
+def move(ctx, destination, **kwargs):
     """Retrieve DICOM files using C-MOVE."""
+    client = _daemon_client(ctx)
+    if client is not None:
+        _run_on_daemon(client, 'move', kwargs, {'destination': destination})
+        return
     click.echo(click.style("Phase 1 : Recherche des UIDs (C-FIND)...", fg='cyan'))
     
     criteria_kwargs = build_search_criteria(**kwargs)
@@ -138,23 +275,33 @@ def move(destination, **kwargs):
         return
 
     total_moved = 0
-    
 
-    for res in results:
-        study_uid = getattr(res, 'StudyInstanceUID', None)
-        series_uid = getattr(res, 'SeriesInstanceUID', None) # Pour le niveau SERIES
-
-        if criteria.level == 'SERIES' and series_uid:
-            click.echo(f"Transfert de la Série : {series_uid}")
-            sc = SearchCriteria(
-                level='SERIES', 
-                study_instance_uid=study_uid, 
-                series_instance_uid=series_uid
-            )
-        else:
-            click.echo(f"Transfert de l'Étude : {study_uid}")
-            sc = SearchCriteria(level='STUDY', study_instance_uid=study_uid)
+    if criteria.level == 'IMAGE':
+        requests = []
+        for res in results:
+            click.echo(f"Transfert de l'Instance : {res.SOPInstanceUID}")
+            requests.append(SearchCriteria(
+                level='IMAGE',
+                study_instance_uid=res.StudyInstanceUID,
+                series_instance_uid=res.SeriesInstanceUID,
+                sop_instance_uid=res.SOPInstanceUID
+            ))
+    elif criteria.level == 'SERIES':
+        pairs = [(res.StudyInstanceUID, res.SeriesInstanceUID) for res in results
+                 if getattr(res, 'StudyInstanceUID', None) and getattr(res, 'SeriesInstanceUID', None)]
+        click.echo(f"Transfert de {len(pairs)} Série(s)")
+        # Packed into C-MOVE requests of RETRIEVE_BATCH_SIZE series (per study)
+        requests = [SearchCriteria(
+            level='SERIES',
+            study_instance_uid=[study_uid for study_uid, _ in pairs],
+            series_instance_uid=[series_uid for _, series_uid in pairs]
+        )]
+    else:
+        study_uids = [res.StudyInstanceUID for res in results if getattr(res, 'StudyInstanceUID', None)]
+        click.echo(f"Transfert de {len(study_uids)} Étude(s)")
+        requests = [SearchCriteria(level='STUDY', study_instance_uid=study_uids)]
 
+    for sc in requests:
         try:
             received = move_service.move_data(sc, destination_aet=destination)
             if received:
@@ -163,5 +310,289 @@ def move(destination, **kwargs):
             click.echo(click.style(f"Error during move: {e}", fg='red'))
 
 
+@cli.command()
+@click.argument('src', type=click.Path(exists=True, file_okay=False))
+@click.argument('dst', type=click.Path(file_okay=False))
+@click.option('--mode', type=click.Choice(['move', 'link', 'copy']), default='move', help='Move (rename), hardlink or copy the files. Across filesystems files are always stream-copied.')
+@click.option('--workers', '-w', type=int, default=None, help='Number of worker processes (default: CPU count).')
+@click.option('--catalog', default=None, help='Record the sorted instances in this local catalog.')
+def sort(src, dst, mode, workers, catalog):
+    """Sort an existing DICOM tree into the <PatientID>/<SeriesNumber>_<SeriesDescription> layout."""
+    click.echo(click.style(f"Sorting {src} into {dst} ({mode})...", fg='cyan', bold=True))
+    # Moved files keep their manifest entries (if DST has manifests)
+    manifest = ManifestStore(dst) if mode == 'move' else None
+    report = sort_tree(src, dst, mode=mode, workers=workers,
+                       catalog=LocalCatalog(catalog) if catalog else None, manifest=manifest)
+    if manifest is not None:
+        manifest.flush()
+
+    for path, error in report.errors:
+        click.echo(click.style(f"Error on {path}: {error}", fg='red'))
+    click.echo(click.style(f"{report.sorted} files sorted, {report.skipped} non-DICOM files skipped, "
+                           f"{len(report.errors)} errors.", fg='green', bold=True))
+    click.echo(click.style(f"Elapsed time: {report.elapsed:.2f} seconds ({report.files_per_second:.0f} files/s)", fg='cyan', bold=True))
+
+
+@cli.command()
+@click.argument('root', type=click.Path(exists=True, file_okay=False), default='output_dir')
+@click.option('--catalog', default=DEFAULT_CATALOG_PATH, show_default=True, help='Path of the local catalog.')
+@click.option('--workers', '-w', type=int, default=None, help='Number of worker processes (default: CPU count).')
+def index(root, catalog, workers):
+    """Index the DICOM files under ROOT into the local catalog (header-only reads)."""
+    start = time()
+    indexed = LocalCatalog(catalog).scan(root, workers=workers)
+    click.echo(click.style(f"{indexed} instances indexed in {time() - start:.2f} seconds.", fg='green', bold=True))
+
+
+@cli.command()
+@click.argument('root', type=click.Path(exists=True, file_okay=False), default='output_dir')
+@click.option('--series-instance-uid', '-seiu', multiple=True, help='Only verify these series (repeatable).')
+@click.option('--quick', is_flag=True, help='Only check that the files exist with the right size, do not hash them.')
+@click.option('--workers', '-w', type=int, default=8, show_default=True, help='Number of hashing threads.')
+def verify(root, series_instance_uid, quick, workers):
+    """Compare the series manifests of ROOT with the files on disk (no DICOM decoding)."""
+    series_uids = list(series_instance_uid) or ManifestStore(root).series_uids()
+    if not series_uids:
+        click.echo(click.style(f"No manifest found in {root}.", fg='red', bold=True))
+        return
+    start = time()
+    report = verify_manifests(root, series_uids, full=not quick, workers=workers)
+
+    for label, failures in (("Missing", report.missing), ("Size mismatch", report.size_mismatch),
+                            ("Hash mismatch", report.hash_mismatch)):
+        for series_uid, sop_uid, path in failures:
+            click.echo(click.style(f"{label}: {path} ({sop_uid})", fg='red'))
+    color = 'green' if not report.failed else 'red'
+    click.echo(click.style(f"{len(series_uids)} series, {report.ok} instances OK, {report.failed} failed "
+                           f"in {time() - start:.2f} seconds.", fg=color, bold=True))
+    if report.failed:
+        raise SystemExit(1)
+
+
+@cli.command()
+@click.argument('root', type=click.Path(exists=True, file_okay=False), default='output_dir')
+@click.argument('dst', type=click.Path(file_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default='tar', show_default=True, help='Archive format (zip members are stored, not compressed).')
+@click.option('--level', type=click.Choice(['patient', 'series']), default='patient', show_default=True, help='One archive per patient or per series folder.')
+@click.option('--workers', '-w', type=int, default=2, show_default=True, help='Number of archives written in parallel.')
+def export(root, dst, fmt, level, workers):
+    """Stream the sorted folders of ROOT into tar/zip archives in DST, without temporary copies."""
+    units = export_units(root, level)
+    click.echo(click.style(f"Exporting {len(units)} {level} folder(s) of {root} to {dst} ({fmt})...", fg='cyan', bold=True))
+    with click.progressbar(length=len(units), label="Exporting..") as bar:
+        report = export_tree(root, dst, fmt=fmt, level=level, workers=workers, progress=bar.update)
+
+    for path, error in report.errors:
+        click.echo(click.style(f"Error on {path}: {error}", fg='red'))
+    click.echo(click.style(f"{report.archives} archives, {report.files} files ({report.bytes / 1024 / 1024:.1f} MB), "
+                           f"{len(report.errors)} errors.", fg='green', bold=True))
+    click.echo(click.style(f"Elapsed time: {report.elapsed:.2f} seconds ({report.mb_per_second:.0f} MB/s)", fg='cyan', bold=True))
+
+
+@cli.command()
+@click.argument('root', type=click.Path(exists=True, file_okay=False), default='output_dir')
+@click.option('--keep', is_flag=True, help='Keep the series folders once packed.')
+@click.option('--catalog', default=None, help='Follow the packed instances in this local catalog.')
+@click.option('--workers', '-w', type=int, default=4, show_default=True, help='Number of series packed in parallel.')
+def pack(root, keep, catalog, workers):
+    """Pack each series folder of ROOT into one <series>.zip with an offset index (fewer inodes)."""
+    folders = series_folders(root)
+    click.echo(click.style(f"Packing {len(folders)} series folder(s) of {root}...", fg='cyan', bold=True))
+    with click.progressbar(length=len(folders), label="Packing..") as bar:
+        report = pack_tree(root, workers=workers, progress=bar.update, manifest=ManifestStore(root),
+                           catalog=LocalCatalog(catalog) if catalog else None, remove=not keep)
+    _pack_summary(report, "packed")
+
+
+@cli.command()
+@click.argument('root', type=click.Path(exists=True, file_okay=False), default='output_dir')
+@click.option('--keep', is_flag=True, help='Keep the packs once extracted.')
+@click.option('--catalog', default=None, help='Follow the extracted instances in this local catalog.')
+@click.option('--workers', '-w', type=int, default=4, show_default=True, help='Number of packs extracted in parallel.')
+def unpack(root, keep, catalog, workers):
+    """Restore the <PatientID>/<series>/<SOPInstanceUID>.dcm folders of the packs of ROOT."""
+    packs = find_packs(root)
+    click.echo(click.style(f"Unpacking {len(packs)} pack(s) of {root}...", fg='cyan', bold=True))
+    with click.progressbar(length=len(packs), label="Unpacking..") as bar:
+        report = unpack_tree(root, workers=workers, progress=bar.update, manifest=ManifestStore(root),
+                             catalog=LocalCatalog(catalog) if catalog else None, remove=not keep)
+    _pack_summary(report, "unpacked")
+
+
+def _pack_summary(report, action):
+    for path, error in report.errors:
+        click.echo(click.style(f"Error on {path}: {error}", fg='red'))
+    click.echo(click.style(f"{report.packs} series, {report.files} files {action}, {report.skipped} non-DICOM files "
+                           f"skipped, {len(report.errors)} errors in {report.elapsed:.2f} seconds.",
+                           fg='green', bold=True))
+
+
+@cli.command()
+@click.argument('series_dirs', nargs=-1, type=click.Path(exists=True, file_okay=False))
+@click.option('--root', type=click.Path(exists=True, file_okay=False), default=None, help='Sorted tree to search for series folders (with --match).')
+@click.option('--match', 'pattern', default='*', show_default=True, help='Series folder pattern under ROOT, e.g. "*T2mapping*".')
+@click.option('--rebuild', is_flag=True, help='Rebuild the cache even if it is up to date.')
+@click.option('--workers', '-w', type=int, default=4, show_default=True, help='Threads reading the slices.')
+def volume(series_dirs, root, pattern, rebuild, workers):
+    """Build or load the memory-mapped NumPy volume of sorted series folders."""
+    targets = list(series_dirs) + (find_series_dirs(root, pattern) if root else [])
+    if not targets:
+        click.echo(click.style("No series folder given (SERIES_DIRS or --root).", fg='red', bold=True))
+        return
+    for series_dir in targets:
+        start = time()
+        try:
+            vol = load_volume(series_dir, root=root, rebuild=rebuild, workers=workers)
+        except Exception as e:
+            click.echo(click.style(f"Error on {series_dir}: {e}", fg='red'))
+            continue
+        geometry = vol.geometry
+        click.echo(click.style(f"{series_dir}", fg='green', bold=True) +
+                   f" shape={tuple(vol.array.shape)} dtype={vol.array.dtype} "
+                   f"echoes={geometry['echo_times']} spacing={geometry['pixel_spacing']}x{geometry['slice_spacing']:.2f} mm "
+                   f"({(time() - start) * 1000:.0f} ms)")
+
+
+@cli.command()
+@click.argument('series_dirs', nargs=-1, type=click.Path(exists=True, file_okay=False))
+@click.option('--root', type=click.Path(exists=True, file_okay=False), default=None, help='Sorted tree to search for multi-echo series (with --match).')
+@click.option('--match', 'pattern', default=T2MAP_PATTERN, show_default=True, help='Series folder pattern under ROOT.')
+@click.option('--format', 'fmt', type=click.Choice(['npy', 'dicom']), default='npy', show_default=True, help='Write the maps as NumPy arrays or as a derived DICOM series.')
+@click.option('--noise-floor', default=None, help='Noise floor in pixel units, or "auto" to estimate it from the background.')
+@click.option('--skip-echoes', type=int, default=0, show_default=True, help='Number of first echoes left out of the fit.')
+@click.option('--workers', '-w', type=int, default=None, help='Number of series fitted in parallel (default: CPU count).')
+def t2map(series_dirs, root, pattern, fmt, noise_floor, skip_echoes, workers):
+    """Fit mono-exponential T2 maps of multi-echo series, written next to each series."""
+    targets = list(series_dirs) + (t2_series_dirs(root, pattern) if root else [])
+    if not targets:
+        click.echo(click.style("No series folder given (SERIES_DIRS or --root).", fg='red', bold=True))
+        return
+    start = time()
+    with click.progressbar(length=len(targets), label="Fitting T2..") as bar:
+        done, errors = fit_series_tree(targets, workers=workers, progress=bar.update, root=root, fmt=fmt,
+                                       noise_floor=noise_floor, skip_echoes=skip_echoes)
+    for series_dir, out_dir, voxels in sorted(done):
+        click.echo(f"{out_dir} ({voxels} voxels fitted)")
+    for series_dir, error in errors:
+        click.echo(click.style(f"Error on {series_dir}: {error}", fg='red'))
+    click.echo(click.style(f"{len(done)} T2 maps, {len(errors)} errors in {time() - start:.2f} seconds.", fg='green', bold=True))
+
+
+@cli.command('fat-fraction')
+@click.argument('patient_dirs', nargs=-1, type=click.Path(exists=True, file_okay=False))
+@click.option('--root', type=click.Path(exists=True, file_okay=False), default=None, help='Sorted tree to search for patients with Dixon series (with --match).')
+@click.option('--match', 'patterns', multiple=True, help=f'Dixon series folder pattern, repeatable (default: {", ".join(FF_PATTERNS)}).')
+@click.option('--format', 'fmt', type=click.Choice(['npy', 'dicom']), default='npy', show_default=True, help='Write the maps as NumPy arrays or as a derived DICOM series.')
+@click.option('--mask-fraction', type=float, default=MASK_FRACTION, show_default=True, help='Voxels with W+F below this fraction of its 99th percentile are masked out.')
+@click.option('--workers', '-w', type=int, default=None, help='Number of patients processed in parallel (default: CPU count).')
+def fat_fraction(patient_dirs, root, patterns, fmt, mask_fraction, workers):
+    """Fat-fraction maps F/(W+F) of the Dixon series of patient folders, written next to each water series."""
+    patterns = patterns or FF_PATTERNS
+    targets = list(patient_dirs) + (dixon_patient_dirs(root, patterns) if root else [])
+    if not targets:
+        click.echo(click.style("No patient folder given (PATIENT_DIRS or --root).", fg='red', bold=True))
+        return
+    start = time()
+    with click.progressbar(length=len(targets), label="Fat fraction..") as bar:
+        done, errors = fat_fraction_tree(targets, workers=workers, progress=bar.update, patterns=patterns, fmt=fmt,
+                                         mask_fraction=mask_fraction)
+    for out_dir, voxels in sorted(done):
+        click.echo(f"{out_dir} ({voxels} voxels in the mask)")
+    for acquisition, error in errors:
+        click.echo(click.style(f"Error on {acquisition}: {error}", fg='red'))
+    click.echo(click.style(f"{len(done)} fat-fraction maps, {len(errors)} errors in {time() - start:.2f} seconds.", fg='green', bold=True))
+
+
+@cli.command()
+@click.option('--listen', default=TelemisConfig.DAEMON_ADDRESS, help='Job API address: "unix:<socket path>" or "host:port" (keep it on localhost), token-protected either way (default: Unix socket in the per-user runtime directory).')
+@click.option('--scp-ip', default='0.0.0.0', show_default=True, help='IP of the storage SCP receiving the C-MOVEs.')
+@click.option('--scp-port', type=int, default=None, help='Port of the storage SCP (default: no SCP, C-MOVEs need one).')
+@click.option('--output-dir', '-o', default='output_dir', show_default=True, help='Output directory of the retrieved files.')
+@click.option('--workers', '-w', type=int, default=4, show_default=True, help='Jobs run in parallel (get jobs one at a time).')
+@click.option('--keep-alive', type=float, default=TelemisConfig.DAEMON_KEEP_ALIVE, show_default=True, help='Seconds an idle association is kept for reuse (0: released after each request).')
+@click.option('--catalog', default=DEFAULT_CATALOG_PATH, show_default=True, help='Record the retrieved instances in this local catalog.')
+@click.option('--stop', is_flag=True, help='Stop the daemon running at --listen.')
+def serve(listen, scp_ip, scp_port, output_dir, workers, keep_alive, catalog, stop):
+    """Run a daemon with warm associations and a storage SCP; search/get/move then run on it."""
+    try:
+        listen = listen or default_address()
+    except OSError as e:
+        click.echo(click.style(f"No daemon address: {e}", fg='red', bold=True))
+        return
+    if stop:
+        try:
+            DaemonClient(listen).shutdown()
+            click.echo(click.style(f"Daemon at {listen} stopping.", fg='green', bold=True))
+        except (OSError, RuntimeError) as e:
+            click.echo(click.style(f"No daemon at {listen}: {e}", fg='red', bold=True))
+        return
+    if DaemonClient.discover(listen) is not None:
+        click.echo(click.style(f"A daemon is already running at {listen}.", fg='red', bold=True))
+        return
+    scp_address = (scp_ip, scp_port) if scp_port else None
+    daemon = DicomDaemon(TelemisConfig, output_dir=output_dir, scp_address=scp_address, workers=workers,
+                         keep_alive=keep_alive, catalog=LocalCatalog(catalog))
+    server = api_server(daemon, listen)
+    scp = f"storage SCP {TelemisConfig.CALLING_AET} on {scp_ip}:{scp_port}" if scp_address else "no storage SCP"
+    click.echo(click.style(f"Daemon listening on {listen}, {scp}, {workers} workers.", fg='green', bold=True))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.close()
+        click.echo(click.style("Daemon stopped.", fg='cyan', bold=True))
+
+
+@cli.command()
+@click.argument('job_id', type=int, required=False)
+@click.option('--listen', default=TelemisConfig.DAEMON_ADDRESS, help='Job API address of the daemon (default: as serve).')
+def jobs(job_id, listen):
+    """List the jobs of the serve daemon, or show one job."""
+    try:
+        client = DaemonClient(listen)
+        if job_id is not None:
+            click.echo(json.dumps(client.request('GET', f'/jobs/{job_id}'), indent=1))
+            return
+        status = client.status()
+        listing = client.jobs()
+    except (OSError, RuntimeError) as e:
+        click.echo(click.style(f"Daemon at {listen or 'the default address'}: {e}", fg='red', bold=True))
+        return
+    click.echo(click.style(f"Daemon pid {status['pid']}, up {status['uptime']:.0f} s, jobs {status['jobs']}, "
+                           f"{status['reused_associations']} associations reused", fg='cyan'))
+    for job in listing:
+        outcome = job['error'] or (json.dumps(job['result']) if job['result'] else '')
+        click.echo(f"[{job['id']}] {job['kind']:<6} {job['state']:<9} {json.dumps(job['criteria'])} {outcome}")
+
+
+@cli.command('bench-pdu')
+@click.option('--study-instance-uid', '-stui', required=True, help='Study of the series used for the benchmark.')
+@click.option('--series-instance-uid', '-seui', required=True, help='Series retrieved once per PDU size.')
+@click.option('--pdu', 'pdu_sizes', type=int, multiple=True, help=f'Max PDU length to test, repeatable, 0 = unlimited (default: {", ".join(map(str, DEFAULT_PDU_SIZES))}).')
+@click.option('--node', default=None, help='Source node name or called AE title (default: the first node).')
+@click.option('--repeat', type=int, default=1, show_default=True, help='Number of passes over the PDU sizes.')
+@click.option('--recv-buffer', type=int, default=None, help='TCP receive buffer size in bytes (default: node profile).')
+def bench_pdu(study_instance_uid, series_instance_uid, pdu_sizes, node, repeat, recv_buffer):
+    """Measure the C-GET throughput of one series for several max PDU lengths."""
+    try:
+        target = find_node(TelemisConfig, node)
+    except ValueError as e:
+        click.echo(click.style(str(e), fg='red', bold=True))
+        return
+    click.echo(click.style(f"Benchmarking {target.name} ({target.profile})", fg='cyan', bold=True))
+    criteria = SearchCriteria(level='SERIES', study_instance_uid=study_instance_uid,
+                              series_instance_uid=series_instance_uid)
+    changes = {'recv_buffer': recv_buffer} if recv_buffer else {}
+    results = benchmark_pdu(TelemisConfig, criteria, list(pdu_sizes) or DEFAULT_PDU_SIZES, node=target,
+                            repeat=repeat, **changes)
+    for result in results:
+        click.echo(f"I: {result}")
+    best = max(results, key=lambda result: result.mb_per_second, default=None)
+    if best is not None and best.files:
+        click.echo(click.style(f"Best: {best}", fg='green', bold=True))
+
+
 if __name__ == '__main__':
     cli()
\ No newline at end of file
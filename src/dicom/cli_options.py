@@ -15,6 +15,7 @@ def common_dicom_options(f):
         click.option('--modality', '-m', help='Modality to search for (e.g., CT, MR).'),
         click.option('--series-instance-uid', '-seui', help='Series Instance UID to search for.'),
         click.option('--study-instance-uid', '-stui', help='Study Instance UID to search for.'),
+        click.option('--sop-instance-uid', '-sopi', help='SOP Instance UID to search for (IMAGE level).'),
         click.option('--patient-birth-date', '-bd', help='Patient Birth Date to search for (YYYYMMDD).'),
         # click.option('--json-series-number-file', '-jsnf', help='Path to JSON file containing series numbers.'),
         click.option('--number-of-study-related-instances', '-nsri', help='Number of Study Related Instances to search for.'),
@@ -14,6 +14,63 @@ class TelemisConfig:
     CALLING_AET = "RMN-TEST"
     CALLED_AET = "TELEMISQR"
 
+#  Equivalent source nodes (replicas) the C-MOVEs are spread over, by weight, latency and
+#  max concurrent associations. Empty : HOST/PORT/CALLED_AET only.
+#  A node refusing associations is skipped for NODE_RETRY_DELAY seconds, while another node is up.
+#  "transport": "dicomweb" : QIDO-RS / WADO-RS on "url" instead of C-FIND / C-GET / C-MOVE, max_associations
+#  pooled HTTP connections (series downloaded in parallel), optional "headers" (e.g. Authorization).
+    SOURCE_NODES = [
+        # {"host": "192.168.0.170", "port": 106, "called_aet": "TELEMISQR", "weight": 2, "max_associations": 4},
+        # {"host": "192.168.0.171", "port": 106, "called_aet": "TELEMISQR", "weight": 1, "max_associations": 2},
+        # {"transport": "dicomweb", "url": "http://192.168.0.170:8080/dicom-web", "max_associations": 8},
+    ]
+    NODE_RETRY_DELAY = 30
+
+#  Network profile of the associations : max PDU (bytes, 0 = unlimited), TCP buffers (bytes, None = OS default),
+#  timeouts (s). Per node overrides in NETWORK_PROFILE_FILE (JSON) or the "network" entry of SOURCE_NODES,
+#  DICOM_NETWORK_PROFILE / DICOM_MAX_PDU / DICOM_RECV_BUFFER... environment variables override everything.
+    NETWORK_PROFILE = {
+        "max_pdu": 16382,
+        "send_buffer": None,
+        "recv_buffer": None,
+        "acse_timeout": 60,
+        "dimse_timeout": 1200,
+        "network_timeout": 1200,
+    }
+    NETWORK_PROFILE_FILE = None
+
+#  C-FIND : the PACS stops answering after MAX_FIND_RESULTS matches (or ends with one of FIND_TRUNCATED_STATUSES),
+#  larger queries are split, MAX_FIND_SUB_QUERIES at most, and run over MAX_FIND_ASSOCIATIONS associations.
+#  'prefix*' PatientIDs are split over PATIENT_ID_ALPHABET, the date range instead if IDs use other characters.
+    MAX_FIND_RESULTS = 1000
+    MAX_FIND_ASSOCIATIONS = 4
+    FIND_TRUNCATED_STATUSES = []
+    MAX_FIND_SUB_QUERIES = 256
+    PATIENT_ID_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+#  C-MOVE / C-GET : Study/Series UIDs packed per request (UID list matching)
+    RETRIEVE_BATCH_SIZE = 20
+
+#  Throttling of received data : "HH:MM-HH:MM=<MB/s>[,<instances/s>]" with limits > 0 ("-" : unlimited),
+#  unlimited outside the windows
+    THROTTLE_SCHEDULE = [
+        # "08:00-19:00=20",
+    ]
+
+#  Durable writes : None, "response" (C-STORE answered once the file is on disk) or "manifest" (answered at once,
+#  recorded in the manifest once on disk). Files are fsynced in batches of FSYNC_BATCH files or FSYNC_WINDOW seconds.
+    DURABILITY = None
+    FSYNC_WINDOW = 0.01
+    FSYNC_BATCH = 64
+
+#  Associations kept idle for reuse (s), 0 : released after each request.
+#  `dicom-client serve` daemon : job API address, used by the CLI commands search/get/move when a daemon answers
+#  there, and its association keep-alive. None : Unix socket in $XDG_RUNTIME_DIR/dicom-client (or ~/.dicom-client),
+#  else "unix:<path>" or "host:port" on localhost. Requests need the token the daemon writes next to it (owner-only).
+    ASSOCIATION_KEEP_ALIVE = 0
+    DAEMON_ADDRESS = None
+    DAEMON_KEEP_ALIVE = 60
+
 #  CONNFI USER 
 #  IP = "192.168.1.163"
 #  PORT = 1
@@ -1,5 +1,7 @@
 import os
 import csv
+import socket
+import time
 import click
 import logging
 import pydicom
@@ -11,9 +13,21 @@ from dicom.config.server_config import TelemisConfig
 from dicom.config.user_config import UserConfig
 from dicom.services.find import Find
 from dicom.services.move import Move
+from dicom.services.pipeline import SeriesGroup, SeriesPipeline
+from dicom.services.manifest import save_dataset
+from dicom.services.durability import MODES as DURABILITY_MODES, DurableWriter
+from dicom.services.export import ArchiveSink, FORMATS
+from dicom.services.fat_fraction import dixon_patient_dirs, fat_fraction_tree
+from dicom.services.t2map import fit_series_tree, t2_series_dirs
+from dicom.services.catalog import LocalCatalog
+from dicom.services.throttle import Throttler
+from dicom.services.tracing import span, traced, tracer
+from dicom.services.work_queue import WorkQueue, LeaseKeeper
+from dicom.services.sync_state import LOOKBACK_DAYS, SyncState
 from dicom.services.search_criteria import SearchCriteria
 from dicom.controllers.pseudonym_controller import PseudonymController
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 
 logging.basicConfig(
     level=logging.INFO,
@@ -58,10 +72,21 @@ class TransferStats:
         with stats_lock:
             self.pseudo_errors += 1
 
+    def merge(self, other):
+        with stats_lock:
+            self.total_series += other.total_series
+            self.total_errors += other.total_errors
+
+
+def process_single_series(p_id, series_desc, research_pseudo, stats, pipeline=None, mover=None, sync=None):
+    """Treats a single biomarker series for a patient.
 
-def process_single_series(p_id, series_desc, research_pseudo, stats):
-    """Treats a single biomarker series for a patient."""
-    mover = Move(TelemisConfig)
+    With a SyncState, only the studies dated since the last sync are
+    queried and only the series not transferred yet are moved. A series is
+    recorded as synced once the pipeline has processed it, and the
+    checkpoint advances once all of them are.
+    """
+    mover = mover or Move(TelemisConfig)
     finder = Find(TelemisConfig)
 
 
@@ -74,16 +99,27 @@ def process_single_series(p_id, series_desc, research_pseudo, stats):
             level="SERIES",
             research_pseudo=research_pseudo
         )
+        if sync is not None:
+            criteria.study_date = sync.study_date_range(p_id, series_desc)
         
         results = finder.search_data(criteria)
         
+        if sync is not None and finder.last_error is not None:
+            stats.increment_errors()
+            return 0
         if not results:
+            if sync is not None:
+                sync.advance(p_id, series_desc)
+                logger.info(f"[{p_id}] Up to date: no study for {series_desc} since {criteria.study_date or 'ever'}")
+                return 0
             logger.warning(f"[{p_id}] Nothing found for series: {series_desc}")
             return 0
         
         logger.info(f"[{p_id}] Found {len(results)} result(s) for {series_desc}")
         transferred = 0
-        
+
+        study_uids, series_uids = [], []
+        instance_counts = {}
         for idx, res in enumerate(results, 1):
             s_uid = getattr(res, 'SeriesInstanceUID', None)
             std_uid = getattr(res, 'StudyInstanceUID', None)
@@ -91,25 +127,96 @@ def process_single_series(p_id, series_desc, research_pseudo, stats):
             if not s_uid or not std_uid:
                 logger.warning(f"[{p_id}] Missing UID for result {idx}, skipping")
                 continue
-            
-            logger.info(f"[{p_id}] [{idx}/{len(results)}] Transferring series...")
-            
-            specific_criteria = SearchCriteria(
-                level='SERIES',
-                study_instance_uid=std_uid,
-                series_instance_uid=s_uid,
-                research_pseudo=research_pseudo
-            )
-            
-            try:
-                mover.move_data(specific_criteria)
-                stats.increment_series()
-                transferred += 1
-                logger.info(f"[{p_id}] ✓ Transfer {idx}/{len(results)} successful")
-            except Exception as e:
+            study_uids.append(std_uid)
+            series_uids.append(s_uid)
+            instance_counts[s_uid] = getattr(res, 'NumberOfSeriesRelatedInstances', None)
+
+        if not series_uids:
+            return 0
+
+        study_of = dict(zip(series_uids, study_uids))
+        if sync is not None:
+            # Local UID diffing: series already synced, or complete in the catalog
+            known = sync.synced_series(p_id, series_uids)
+            if mover.catalog is not None:
+                known |= mover.catalog.known_series(instance_counts)
+            new_series = [s_uid for s_uid in series_uids if s_uid not in known]
+            if not new_series:
+                sync.advance(p_id, series_desc, [(study_of[s_uid], s_uid) for s_uid in series_uids])
+                logger.info(f"[{p_id}] Up to date: {len(series_uids)} {series_desc} series already synced")
+                return 0
+            logger.info(f"[{p_id}] {len(new_series)} new series out of {len(series_uids)} found")
+            series_uids = new_series
+            study_uids = [study_of[s_uid] for s_uid in new_series]
+
+        logger.info(f"[{p_id}] Transferring {len(series_uids)} series...")
+
+        # All the series are packed into as few C-MOVE requests as the batch size allows
+        specific_criteria = SearchCriteria(
+            level='SERIES',
+            study_instance_uid=study_uids,
+            series_instance_uid=series_uids,
+            research_pseudo=research_pseudo
+        )
+
+        # Received and through the pipeline (pseudonymized, sorted) without error
+        processed = []
+        received_lock = Lock()
+
+        def series_processed(pair, job):
+            if job.errors:
+                logger.error(f"[{p_id}] ✗ Series {pair[1]}: {job.errors} file(s) failed in the pipeline")
+                return
+            with received_lock:
+                processed.append(pair)
+
+        def checkpoint(errors=0):
+            # The checkpoint only moves forward once every new series has been received and processed
+            if len(processed) == len(series_uids):
+                sync.advance(p_id, series_desc, processed)
+            else:
+                sync.record_series(p_id, series_desc, processed)
+
+        # With a sync, the series of this pattern are followed through the pipeline before they count as synced
+        group = SeriesGroup(pipeline, on_done=checkpoint) if sync is not None and pipeline is not None else None
+
+        def series_moved(record, s_uid):
+            """Each series goes to the pipeline as soon as its C-MOVE has completed, the next ones still moving"""
+            nonlocal transferred
+            files = record.files_by_series.get(s_uid, [])
+            duplicates = record.duplicates_by_series.get(s_uid, 0)
+            if not files and not duplicates:
                 stats.increment_errors()
-                logger.error(f"[{p_id}] ✗ Transfer failed: {e}")
-        
+                logger.error(f"[{p_id}] ✗ No file received for series {s_uid} (status: {record.status})")
+                return
+            stats.increment_series()
+            pair = (study_of.get(s_uid), s_uid)
+            with received_lock:
+                transferred += 1
+                count = transferred
+                if not files or pipeline is None:
+                    processed.append(pair)
+            if not files:
+                logger.info(f"[{p_id}] ✓ Series {s_uid} already stored unchanged ({duplicates} files skipped)")
+                return
+            logger.info(f"[{p_id}] ✓ Transfer {count}/{len(series_uids)} successful ({len(files)} files)")
+            if group is not None:
+                group.submit(files, on_done=partial(series_processed, pair))
+            elif pipeline is not None:
+                pipeline.submit(files)
+
+        try:
+            mover.move_tracked(specific_criteria, on_series_complete=series_moved)
+        except Exception as e:
+            stats.increment_errors()
+            logger.error(f"[{p_id}] ✗ Transfer failed: {e}")
+        finally:
+            if group is not None:
+                # checkpoint runs once the series in flight are processed
+                group.close()
+            elif sync is not None:
+                checkpoint()
+
         return transferred
     
     except Exception as e:
@@ -118,7 +225,7 @@ def process_single_series(p_id, series_desc, research_pseudo, stats):
         return 0
 
 
-def process_patient(p_id, research_pseudo, stats):
+def process_patient(p_id, research_pseudo, stats, pipeline=None, mover=None, sync=None):
     """Treats all biomarker series for a single patient."""
     logger.info(f"\n{'='*60}")
     logger.info(f"[{p_id}] Starting patient processing")
@@ -128,7 +235,7 @@ def process_patient(p_id, research_pseudo, stats):
 
     with ThreadPoolExecutor(max_workers=4) as executor:
         futures = {
-            executor.submit(process_single_series, p_id, series_desc, research_pseudo, stats): series_desc
+            executor.submit(process_single_series, p_id, series_desc, research_pseudo, stats, pipeline, mover, sync): series_desc
             for series_desc in BIOMARKERS
         }
         
@@ -144,8 +251,84 @@ def process_patient(p_id, research_pseudo, stats):
     return total_transferred
 
 
-def pseudonymize_file_safe(file_path, pseudonymizer, stats):
-    """Pseudonymize with detailed error handling"""
+def run_worker(queue, worker_id, research_pseudo, stats, pipeline, mover, max_workers, poll_interval=10, sync=None):
+    """Process (patient, series) jobs from the shared queue until none is left.
+
+    The leases of the jobs in progress are renewed in the background. A job
+    is done only once its series have been pseudonymized and sorted by the
+    pipeline, and its lease is held until then: a worker dying meanwhile
+    leaves it to be leased again. A worker with nothing to lease keeps
+    polling while other workers hold leases, in case one of them dies and
+    its jobs are put back.
+    """
+    keeper = LeaseKeeper(queue, worker_id).start()
+    done_lock = Lock()
+    jobs_done = 0
+
+    def finish(job, job_stats, errors):
+        """Close a job once its series went through the pipeline: done, or back in the queue on errors"""
+        nonlocal jobs_done
+        keeper.drop(job.id)
+        stats.merge(job_stats)
+        if job_stats.total_errors or errors:
+            queue.fail(job.id, worker_id, f"{job_stats.total_errors} transfer error(s), {errors} file error(s)")
+            return
+        queue.complete(job.id, worker_id, job_stats.total_series)
+        with done_lock:
+            jobs_done += 1
+
+    def work():
+        groups = []
+        while True:
+            job = queue.lease(worker_id)
+            if job is None:
+                # Jobs of this worker still in the pipeline count as leased: wait for them first
+                for group in groups:
+                    group.done.wait()
+                groups = []
+                if queue.counts()['leased'] == 0:
+                    return
+                time.sleep(poll_interval)
+                continue
+
+            logger.info(f"[{job.patient_id}] Job {job.id} leased: {job.series_description} (attempt {job.attempts})")
+            keeper.hold(job.id)
+            job_stats = TransferStats()
+            group = SeriesGroup(pipeline, partial(finish, job, job_stats))
+            groups = [g for g in groups if not g.done.is_set()] + [group]
+            try:
+                process_single_series(job.patient_id, job.series_description, research_pseudo, job_stats, group,
+                                      mover, sync)
+            except Exception as e:
+                job_stats.increment_errors()
+                logger.error(f"[{job.patient_id}] Job {job.id} failed: {e}")
+            finally:
+                group.close()
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(lambda _: work(), range(max_workers)))
+    finally:
+        keeper.stop()
+    logger.info(f"Worker {worker_id}: {jobs_done} job(s) done, queue: {queue.counts()}")
+    return jobs_done
+
+
+def series_sorted(paths, mover, archive_sink=None):
+    """Post-sort step of a series: its renames made durable, then its files appended to the patient archive"""
+    mover.sync_sorted(paths)
+    if archive_sink is not None:
+        archive_sink.add_series(paths)
+
+
+@traced('pseudonymize.file')
+def pseudonymize_file_safe(file_path, pseudonymizer, stats, manifest=None, durable=None):
+    """Pseudonymize with detailed error handling.
+
+    With a DurableWriter the file is rewritten under a temporary name and
+    committed (fsync, rename, directory fsync) before returning, never
+    truncated in place.
+    """
     try:
         if not os.path.exists(file_path):
             logger.error(f"File not found: {file_path}")
@@ -163,17 +346,29 @@ def pseudonymize_file_safe(file_path, pseudonymizer, stats):
             stats.increment_pseudo_errors()
             return False
         
-        ds = pydicom.dcmread(file_path)
+        with span('pseudonymize.read'):
+            ds = pydicom.dcmread(file_path)
         
         if not hasattr(ds, 'SOPInstanceUID'):
             logger.warning(f"Missing SOPInstanceUID (not a valid DICOM): {os.path.basename(file_path)}")
             stats.increment_pseudo_errors()
             return False
         
-        with pseudo_lock:
-            ds = pseudonymizer.pseudonymize_file(ds)
+        # Includes the wait for the lock, shared by every pseudonymization thread
+        with span('pseudonymize.locked'):
+            with pseudo_lock:
+                ds = pseudonymizer.pseudonymize_file(ds)
         
-        ds.save_as(file_path)
+        with span('pseudonymize.write'):
+            if durable is not None:
+                write_path = durable.temp_path(file_path)
+                size, digest = save_dataset(ds, write_path)
+                # Waited for in every mode: the sort moves the file right after
+                durable.commit(write_path, file_path, wait=True)
+            else:
+                size, digest = save_dataset(ds, file_path)
+        if manifest is not None:
+            manifest.update_file(getattr(ds, 'SeriesInstanceUID', None), ds.SOPInstanceUID, file_path, size, digest)
         stats.increment_pseudo()
         return True
     
@@ -241,35 +436,121 @@ def load_patient_ids(file_path):
 
 
 @click.command()
-@click.option('--file', '-f', required=True, help='CSV or XL Path (Format: PatientID)')
+@click.option('--file', '-f', default=None, help='CSV or XL Path (Format: PatientID)')
+@click.option('--queue', '-q', default=None, help='Shared work queue (SQLite file): with --file, enqueue the (patient, series) jobs')
+@click.option('--worker', is_flag=True, default=False, help='Worker mode: process jobs from --queue until it is empty')
+@click.option('--scp-ip', default=UserConfig.IP, help='IP of the storage SCP receiving the C-MOVEs (default: UserConfig.IP)')
+@click.option('--scp-port', default=UserConfig.PORT, type=int, help='Port of the storage SCP (default: UserConfig.PORT)')
+@click.option('--ae-title', default=None, help='AE title of this storage SCP, as known by the PACS (default: TelemisConfig.CALLING_AET)')
+@click.option('--output-dir', '-o', default='output_dir', help='Output directory, shared between workers (default: output_dir)')
+@click.option('--lease', default=WorkQueue.LEASE_SECONDS, help=f'Job lease duration in seconds (default: {WorkQueue.LEASE_SECONDS})')
 @click.option('--research-pseudo', is_flag=True, default=True, help='Enable pseudonymization')
 @click.option('--max-workers', '-w', default=2, help='Number of parallel patients (default: 2)')
 @click.option('--pseudo-workers', '-pw', default=5, help='Number of parallel pseudonymization workers (default: 5)')
+@click.option('--sort-workers', '-sw', default=2, help='Number of parallel sorting workers (default: 2)')
+@click.option('--max-pending-series', default=8, help='Series waiting for post-processing before transfers pause (default: 8)')
+@click.option('--throttle', multiple=True, help='Bandwidth window "HH:MM-HH:MM=<MB/s>[,<instances/s>]", repeatable (default: TelemisConfig.THROTTLE_SCHEDULE)')
+@click.option('--export-dir', default=None, help='Stream each sorted series into <export-dir>/<PatientID>.<format> archives')
+@click.option('--export-format', type=click.Choice(FORMATS), default='tar', help='Archive format of --export-dir (default: tar)')
+@click.option('--t2map', type=click.Choice(['npy', 'dicom']), default=None, help='Fit the T2 maps of the T2mapping series after the final sort')
+@click.option('--fat-fraction', type=click.Choice(['npy', 'dicom']), default=None, help='Compute the fat-fraction maps of the VIBE Dixon series after the final sort')
+@click.option('--durable', type=click.Choice(DURABILITY_MODES), default=TelemisConfig.DURABILITY, help='Fsync the received files in batches before answering the C-STORE ("response") or recording them in the manifest ("manifest") (default: TelemisConfig.DURABILITY)')
+@click.option('--fsync-window', type=float, default=TelemisConfig.FSYNC_WINDOW, help=f'Seconds a received file waits for others to share its fsync batch (default: {TelemisConfig.FSYNC_WINDOW})')
+@click.option('--fsync-batch', type=int, default=TelemisConfig.FSYNC_BATCH, help=f'Maximum files per fsync batch (default: {TelemisConfig.FSYNC_BATCH})')
+@click.option('--pack', is_flag=True, default=False, help='Append each sorted series to one <series>.zip pack instead of one file per instance')
+@click.option('--sync', is_flag=True, default=False, help='Incremental sync: query only the studies since the last sync, move only the new series')
+@click.option('--sync-db', default=None, help='Sync checkpoints (SQLite file, default: <output-dir>/sync.sqlite)')
+@click.option('--sync-lookback', default=LOOKBACK_DAYS, help=f'Days queried again before the last sync, for late-archived studies (default: {LOOKBACK_DAYS})')
+@click.option('--sync-reset', is_flag=True, default=False, help='Forget the sync checkpoints of the patients of --file first (full re-query)')
+@click.option('--trace', is_flag=True, default=False, help='Record per-stage spans into <trace-dir>/run_process-<time>.trace.json (Chrome trace)')
+@click.option('--profile', is_flag=True, default=False, help='Also run each stage under cProfile, one .prof file per stage (implies --trace)')
+@click.option('--trace-dir', default='traces', help='Directory of the trace and profile files (default: traces)')
 @click.option('--no-series-folders', is_flag=True, default=False, help='Save files directly in patient folder (no series subfolders)')
-def main(file, research_pseudo, max_workers, pseudo_workers, no_series_folders):
-    """Process DICOM images: search, transfer and pseudonymize"""
-    
-    if not os.path.exists(file):
+def main(file, queue, worker, scp_ip, scp_port, ae_title, output_dir, lease, research_pseudo, max_workers,
+         pseudo_workers, sort_workers, max_pending_series, throttle, export_dir, export_format, t2map, fat_fraction,
+         durable, fsync_window, fsync_batch, pack, sync, sync_db, sync_lookback, sync_reset, trace, profile,
+         trace_dir, no_series_folders):
+    """Process DICOM images: search, transfer and pseudonymize
+
+    \b
+    Single host:  run_process -f patients.csv
+    Refresh:      run_process -f patients.csv --sync                   (only the new series)
+    Distributed:  run_process -f patients.csv -q jobs.sqlite            (enqueue once)
+                  run_process -q jobs.sqlite --worker --ae-title RMN-W1 --scp-port 11113 -o /shared/output_dir
+    """
+    if file and not os.path.exists(file):
         logger.error(f"CSV or XL file not found: {file}")
         return
-    
+    if not file and not (queue and worker):
+        logger.error("Either --file or --queue with --worker is required")
+        return
+    if pack and (export_dir or t2map or fat_fraction):
+        logger.error("--export-dir, --t2map and --fat-fraction need series folders, they cannot be combined with --pack")
+        return
+
+    work_queue = None
+    if queue:
+        work_queue = WorkQueue(queue, lease_seconds=lease)
+        if file:
+            added = work_queue.enqueue(load_patient_ids(file), BIOMARKERS)
+            logger.info(f"{added} job(s) added to {queue}: {work_queue.counts()}")
+        if not worker:
+            return
+
+    if trace or profile:
+        tracer.enable(profile=profile, directory=trace_dir, prefix='run_process')
+
     stats = TransferStats()
     pseudonymizer = PseudonymController()
-    
-    mover_global = Move(TelemisConfig)
+
+    # Each worker has its own AE title (the PACS maps it to the worker SCP) and its own temp directory
+    config = type('WorkerConfig', (TelemisConfig,), {'CALLING_AET': ae_title}) if ae_title else TelemisConfig
+    temp_dir = os.path.join(output_dir, f"temp_transit_{config.CALLING_AET}") if worker else None
+
+    schedule = list(throttle) or TelemisConfig.THROTTLE_SCHEDULE
+    throttler = Throttler(schedule) if schedule else None
+    durable_writer = DurableWriter(durable, fsync_window, fsync_batch) if durable else None
+    sync_state = SyncState(sync_db or os.path.join(output_dir, "sync.sqlite"), sync_lookback) if sync else None
+    mover_global = Move(config, output_dir=output_dir, catalog=LocalCatalog(os.path.join(output_dir, "catalog.sqlite")),
+                        throttler=throttler, temp_dir=temp_dir, pack=pack, durable=durable_writer)
     handlers = [(evt.EVT_C_STORE, mover_global._handle_store)]
-    scp = mover_global.ae.start_server((UserConfig.IP, UserConfig.PORT), block=False, evt_handlers=handlers)
-    logger.info(f"DICOM server started at {UserConfig.IP}:{UserConfig.PORT}")
+    scp = mover_global.ae.start_server((scp_ip, scp_port), block=False, evt_handlers=handlers)
+    mover_global.profile.tune_server(scp)
+    logger.info(f"DICOM server {config.CALLING_AET} started at {scp_ip}:{scp_port}")
+
+    # Patient archives are written while the series are sorted, without staging copies
+    archive_sink = ArchiveSink(output_dir, export_dir, export_format) if export_dir else None
+
+    # Each series is pseudonymized and sorted as soon as its transfer has completed
+    pipeline = SeriesPipeline(
+        sort_file=mover_global.sort_file,
+        pseudonymize_file=partial(pseudonymize_file_safe, pseudonymizer=pseudonymizer, stats=stats,
+                                  manifest=mover_global.manifest, durable=durable_writer) if research_pseudo else None,
+        pseudo_workers=pseudo_workers,
+        sort_workers=sort_workers,
+        max_pending=max_pending_series,
+        on_sorted=partial(series_sorted, mover=mover_global, archive_sink=archive_sink),
+    )
     try:
+        if worker:
+            worker_id = f"{config.CALLING_AET}@{socket.gethostname()}:{os.getpid()}"
+            logger.info(f"Worker {worker_id} processing jobs from {queue}")
+            run_worker(work_queue, worker_id, research_pseudo, stats, pipeline, mover_global, max_workers,
+                       sync=sync_state)
+            return
+
         logger.info(f"Starting OPTIMIZED processing from: {file}")
         logger.info(f"Parallel patients: {max_workers}, Pseudo workers: {pseudo_workers}")
         patients = load_patient_ids(file)
         stats.total_patients = len(patients)
+        if sync_state is not None and sync_reset:
+            sync_state.reset(patients)
+            logger.info(f"Sync checkpoints cleared for {len(patients)} patients")
         logger.info(f"Loaded {len(patients)} patients to process")
 
         with ThreadPoolExecutor(max_workers=max_workers) as executor:
             futures = {
-                executor.submit(process_patient, p_id, research_pseudo, stats): p_id
+                executor.submit(process_patient, p_id, research_pseudo, stats, pipeline, mover_global, sync_state): p_id
                 for p_id in patients
             }
             
@@ -292,10 +573,19 @@ def main(file, research_pseudo, max_workers, pseudo_workers, no_series_folders):
     finally:
         scp.shutdown()
         logger.info("DICOM server stopped")
-        
+        if throttler is not None:
+            logger.info(f"Throttling: {throttler.report()}")
+        if len(mover_global.nodes) > 1:
+            for line in mover_global.nodes.report():
+                logger.info(f"Source node {line}")
+
+        pipeline.close()
+        logger.info(f"Pipeline completed: {pipeline.series_done} series, {pipeline.files_sorted} files sorted")
+
+        # Instances that could not be matched to a move are still in temp_transit
         if research_pseudo:
             logger.info("\nStarting PARALLEL pseudonymization phase...")
-            temp_dir = "output_dir/temp_transit"
+            temp_dir = str(mover_global.temp_dir)
             
             if not os.path.exists(temp_dir):
                 logger.warning(f"Temp directory not found: {temp_dir}")
@@ -311,7 +601,8 @@ def main(file, research_pseudo, max_workers, pseudo_workers, no_series_folders):
                 
                 with ThreadPoolExecutor(max_workers=pseudo_workers) as executor:
                     futures = {
-                        executor.submit(pseudonymize_file_safe, file_path, pseudonymizer, stats): file_path
+                        executor.submit(pseudonymize_file_safe, file_path, pseudonymizer, stats, mover_global.manifest,
+                                        durable_writer): file_path
                         for file_path in dicom_files
                     }
                     
@@ -325,10 +616,36 @@ def main(file, research_pseudo, max_workers, pseudo_workers, no_series_folders):
 
         logger.info("\nPerforming final sort...")
         try:
-            mover_global.final_global_sort()
+            # The files sorted here never went through the pipeline: appended to the archives now
+            mover_global.final_global_sort(on_sorted=archive_sink.add_series if archive_sink is not None else None)
             logger.info("Final sort completed")
         except Exception as e:
             logger.error(f"Final sort failed: {e}")
+        if archive_sink is not None:
+            archives, files, size = archive_sink.close()
+            logger.info(f"Export: {files} files ({size / 1024 / 1024:.1f} MB) in {archives} archive(s) in {export_dir}")
+        # Closed last: the pseudonymized files are committed through it too
+        if durable_writer is not None:
+            durable_writer.close()
+            logger.info(f"Durable writes: {durable_writer.report()}")
+
+        if t2map:
+            series_dirs = t2_series_dirs(output_dir)
+            logger.info(f"\nFitting {len(series_dirs)} T2 map(s)...")
+            done, errors = fit_series_tree(series_dirs, workers=pseudo_workers, fmt=t2map)
+            logger.info(f"T2 maps: {len(done)} written, {len(errors)} errors")
+
+        if fat_fraction:
+            patient_dirs = dixon_patient_dirs(output_dir)
+            logger.info(f"\nComputing the fat-fraction maps of {len(patient_dirs)} patient(s)...")
+            done, errors = fat_fraction_tree(patient_dirs, workers=pseudo_workers, fmt=fat_fraction)
+            logger.info(f"Fat-fraction maps: {len(done)} written, {len(errors)} errors")
+
+        if tracer.enabled:
+            logger.info("\nTime per stage:")
+            tracer.log_summary(logger.info)
+            for path in tracer.write():
+                logger.info(f"Trace written: {path}")
         
         logger.info("\n" + "="*60)
         logger.info("PROCESS COMPLETED")
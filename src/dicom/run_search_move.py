@@ -38,6 +38,7 @@ def main(**kwargs):
    
     handlers = [(evt.EVT_C_STORE, mover._handle_store)]
     scp = mover.ae.start_server(("192.168.4.163", 106), block=False, evt_handlers=handlers)
+    mover.profile.tune_server(scp)
     
     try:
         for idx, res in enumerate(results, 1):
@@ -0,0 +1,86 @@
+"""
+PDU Benchmark
+
+Retrieves the same series with C-GET once per maximum PDU length (and per
+repetition) from one node, into a throw-away directory, and measures the
+received throughput. The max PDU advertised by this side bounds the size of
+the P-DATA PDUs the PACS sends the instances in. The instances received are
+only counted, never decoded nor written, so that the network is measured
+rather than pydicom and the disk.
+"""
+
+import tempfile
+from time import perf_counter
+
+from dicom.services.get import Get
+from dicom.services.nodes import NodePool
+
+DEFAULT_PDU_SIZES = (16382, 65536, 262144, 1048576, 0)
+
+
+class BenchmarkResult:
+    def __init__(self, max_pdu, files, size, seconds):
+        self.max_pdu = max_pdu
+        self.files = files
+        self.bytes = size
+        self.seconds = seconds
+
+    @property
+    def mb_per_second(self):
+        return self.bytes / (1024 * 1024) / self.seconds if self.seconds else 0.0
+
+    def __repr__(self):
+        pdu = 'unlimited' if not self.max_pdu else self.max_pdu
+        return (f"max PDU {pdu}: {self.files} files, {self.bytes / 1024 / 1024:.1f} MB in {self.seconds:.2f}s "
+                f"({self.mb_per_second:.1f} MB/s)")
+
+
+class CountingGet(Get):
+    """Get whose C-STORE handler counts the instances and bytes received, then discards them"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bytes_received = 0
+
+    def _handle_store(self, event):
+        with event.request.DataSet.getbuffer() as raw:
+            size = raw.nbytes
+        with self._count_lock:
+            self.files_received += 1
+            self.bytes_received += size
+        return 0x0000
+
+
+def find_node(config, name=None):
+    """Node of the config by name or called AE title, the first node by default"""
+    nodes = NodePool.from_config(config).nodes
+    if name is None:
+        return nodes[0]
+    for node in nodes:
+        if name in (node.name, node.called_aet):
+            return node
+    raise ValueError(f"Unknown node {name!r}, expected one of: {', '.join(node.name for node in nodes)}")
+
+
+def benchmark_pdu(config, criteria, pdu_sizes=DEFAULT_PDU_SIZES, node=None, repeat=1, **profile_changes):
+    """C-GET criteria once per PDU size and repetition, returns the BenchmarkResults"""
+    node = node or find_node(config)
+    node_config = type('BenchmarkConfig', (config,), {'HOST': node.host, 'PORT': node.port,
+                                                      'CALLED_AET': node.called_aet, 'SOURCE_NODES': []})
+    results = []
+    for _ in range(repeat):
+        for max_pdu in pdu_sizes:
+            profile = node.profile.copy(max_pdu=max_pdu, **profile_changes)
+            with tempfile.TemporaryDirectory(prefix='pdu_bench_') as output_dir:
+                # One Get per PDU size: the max PDU is an AE-wide setting
+                service = CountingGet(node_config, output_dir=output_dir, profile=profile)
+                try:
+                    start = perf_counter()
+                    files = service.retrieve_data(criteria) or 0
+                    seconds = perf_counter() - start
+                finally:
+                    # Its storage server (and any idle association) would otherwise outlive the run
+                    service.close_idle()
+                    service.ae.shutdown()
+                results.append(BenchmarkResult(max_pdu, int(files), service.bytes_received, seconds))
+    return results
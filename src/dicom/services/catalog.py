@@ -0,0 +1,313 @@
+"""
+Local DICOM Catalog
+
+SQLite index of the patients, studies, series and instances received into
+output_dir. It is filled at store/sort time or by scanning a tree with
+header-only reads, and answers SearchCriteria queries without contacting
+the PACS.
+"""
+
+import sqlite3
+import threading
+from pathlib import Path
+
+from pydicom.dataset import Dataset
+from pydicom.errors import InvalidDicomError
+
+from dicom.services.search_criteria import SearchCriteria
+from dicom.services.sorter import header_values, process_pool, read_header, scan_files
+
+DEFAULT_CATALOG_PATH = "output_dir/catalog.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS patients (
+    patient_id TEXT PRIMARY KEY,
+    patient_name TEXT,
+    birth_date TEXT
+);
+CREATE TABLE IF NOT EXISTS studies (
+    study_uid TEXT PRIMARY KEY,
+    patient_id TEXT,
+    study_date TEXT,
+    study_time TEXT,
+    study_description TEXT,
+    accession_number TEXT
+);
+CREATE TABLE IF NOT EXISTS series (
+    series_uid TEXT PRIMARY KEY,
+    study_uid TEXT,
+    series_number TEXT,
+    series_description TEXT,
+    series_date TEXT,
+    modality TEXT
+);
+CREATE TABLE IF NOT EXISTS instances (
+    sop_uid TEXT PRIMARY KEY,
+    series_uid TEXT,
+    sop_class_uid TEXT,
+    instance_number TEXT,
+    path TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_studies_patient ON studies (patient_id);
+CREATE INDEX IF NOT EXISTS idx_studies_date ON studies (study_date);
+CREATE INDEX IF NOT EXISTS idx_series_study ON series (study_uid);
+CREATE INDEX IF NOT EXISTS idx_series_modality ON series (modality);
+CREATE INDEX IF NOT EXISTS idx_series_description ON series (series_description);
+CREATE INDEX IF NOT EXISTS idx_instances_series ON instances (series_uid);
+"""
+
+# Columns returned for each query level, as (SQL expression, DICOM keyword)
+PATIENT_COLUMNS = [
+    ("p.patient_id", "PatientID"),
+    ("p.patient_name", "PatientName"),
+    ("p.birth_date", "PatientBirthDate"),
+]
+STUDY_COLUMNS = PATIENT_COLUMNS + [
+    ("st.study_uid", "StudyInstanceUID"),
+    ("st.study_date", "StudyDate"),
+    ("st.study_time", "StudyTime"),
+    ("st.study_description", "StudyDescription"),
+    ("st.accession_number", "AccessionNumber"),
+]
+SERIES_COLUMNS = STUDY_COLUMNS + [
+    ("se.series_uid", "SeriesInstanceUID"),
+    ("se.series_number", "SeriesNumber"),
+    ("se.series_description", "SeriesDescription"),
+    ("se.series_date", "SeriesDate"),
+    ("se.modality", "Modality"),
+]
+IMAGE_COLUMNS = SERIES_COLUMNS + [
+    ("i.sop_uid", "SOPInstanceUID"),
+    ("i.sop_class_uid", "SOPClassUID"),
+    ("i.instance_number", "InstanceNumber"),
+]
+
+
+def _glob_pattern(value):
+    """Translate a DICOM wildcard value (* and ?) into an SQLite GLOB pattern."""
+    return str(value).replace('[', '[[]')
+
+
+def _scan_chunk(paths, tags):
+    """Worker entry point: header-only read of a chunk of files."""
+    headers = []
+    for path in paths:
+        try:
+            headers.append((header_values(read_header(path, tags), tags), path))
+        except (InvalidDicomError, OSError):
+            continue
+    return headers
+
+
+class LocalCatalog:
+    """SQLite catalog of the local DICOM data."""
+
+    TAGS = [
+        'PatientID', 'PatientName', 'PatientBirthDate',
+        'StudyInstanceUID', 'StudyDate', 'StudyTime', 'StudyDescription', 'AccessionNumber',
+        'SeriesInstanceUID', 'SeriesNumber', 'SeriesDescription', 'SeriesDate', 'Modality',
+        'SOPInstanceUID', 'SOPClassUID', 'InstanceNumber',
+    ]
+
+    def __init__(self, db_path=DEFAULT_CATALOG_PATH):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), timeout=30, check_same_thread=False)
+        # Rollback journal: WAL needs shared memory on one host, output_dir may be on a network share
+        self._conn.execute("PRAGMA journal_mode=DELETE")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _insert(self, values, path):
+        v = values.get
+        self._conn.execute(
+            "INSERT OR REPLACE INTO patients VALUES (?, ?, ?)",
+            (v('PatientID'), v('PatientName'), v('PatientBirthDate')))
+        self._conn.execute(
+            "INSERT OR REPLACE INTO studies VALUES (?, ?, ?, ?, ?, ?)",
+            (v('StudyInstanceUID'), v('PatientID'), v('StudyDate'), v('StudyTime'),
+             v('StudyDescription'), v('AccessionNumber')))
+        self._conn.execute(
+            "INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?, ?, ?)",
+            (v('SeriesInstanceUID'), v('StudyInstanceUID'), v('SeriesNumber'),
+             v('SeriesDescription'), v('SeriesDate'), v('Modality')))
+        self._conn.execute(
+            "INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?, ?)",
+            (v('SOPInstanceUID'), v('SeriesInstanceUID'), v('SOPClassUID'),
+             v('InstanceNumber'), str(path)))
+
+    def add_instance(self, values, path):
+        """Record one stored instance from its header values ({keyword: str})"""
+        if not values.get('SOPInstanceUID'):
+            return
+        with self._lock, self._conn:
+            self._insert(values, path)
+
+    def add_dataset(self, dataset, path):
+        """Record one stored instance from a pydicom Dataset"""
+        self.add_instance(header_values(dataset, self.TAGS), path)
+
+    def add_many(self, headers):
+        """Record (values, path) pairs in a single transaction"""
+        with self._lock, self._conn:
+            for values, path in headers:
+                if values.get('SOPInstanceUID'):
+                    self._insert(values, path)
+
+    def relocate(self, paths):
+        """New paths of already indexed instances, as (SOPInstanceUID, path) pairs (e.g. packed or unpacked)"""
+        with self._lock, self._conn:
+            self._conn.executemany("UPDATE instances SET path = ? WHERE sop_uid = ?",
+                                   [(str(path), sop_uid) for sop_uid, path in paths])
+
+    def scan(self, root, workers=None, chunk_size=256):
+        """Index every DICOM file under root with header-only reads, returns the count"""
+        indexed = 0
+        with process_pool(workers) as executor:
+            futures = []
+            chunk = []
+            for path in scan_files(str(root)):
+                chunk.append(path)
+                if len(chunk) >= chunk_size:
+                    futures.append(executor.submit(_scan_chunk, chunk, self.TAGS))
+                    chunk = []
+            if chunk:
+                futures.append(executor.submit(_scan_chunk, chunk, self.TAGS))
+
+            for future in futures:
+                headers = future.result()
+                self.add_many(headers)
+                indexed += len(headers)
+        return indexed
+
+    def known_series(self, expected):
+        """Those series that have all their instances in the catalog.
+
+        expected maps each SeriesInstanceUID to its instance count on the
+        PACS (NumberOfSeriesRelatedInstances): a series missing instances,
+        or without a count, is not known.
+        """
+        expected = {series_uid: count for series_uid, count in dict(expected).items() if count}
+        series_uids = list(expected)
+        known = set()
+        with self._lock:
+            for start in range(0, len(series_uids), 500):
+                chunk = series_uids[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT series_uid, COUNT(*) FROM instances WHERE series_uid IN ({', '.join('?' * len(chunk))}) "
+                    f"GROUP BY series_uid", chunk)
+                known.update(series_uid for series_uid, count in rows if count >= expected[series_uid])
+        return known
+
+    def _conditions(self, criteria, level):
+        """WHERE clauses for the criteria, following the C-FIND matching rules"""
+        clauses, params = [], []
+
+        def match(column, value, case_sensitive=True):
+            if not value:
+                return
+            if not isinstance(value, str):
+                # UID list (e.g. from a CSV or a drill-down): list matching
+                value = '\\'.join(value)
+            if '*' in value or '?' in value:
+                if case_sensitive:
+                    clauses.append(f"{column} GLOB ?")
+                    params.append(_glob_pattern(value))
+                else:
+                    clauses.append(f"UPPER({column}) GLOB ?")
+                    params.append(_glob_pattern(value).upper())
+            elif '\\' in value:
+                values = value.split('\\')
+                clauses.append(f"{column} IN ({', '.join('?' * len(values))})")
+                params.extend(values)
+            elif case_sensitive:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+            else:
+                clauses.append(f"UPPER({column}) = ?")
+                params.append(value.upper())
+
+        def match_date(column, value):
+            if not value:
+                return
+            if '-' in value:
+                start, end = value.split('-', 1)
+                if start:
+                    clauses.append(f"{column} >= ?")
+                    params.append(start)
+                if end:
+                    clauses.append(f"{column} <= ?")
+                    params.append(end)
+            else:
+                match(column, value)
+
+        match("p.patient_id", criteria.patient_id)
+        match("p.patient_name", criteria.patient_name, case_sensitive=False)
+        match_date("p.birth_date", criteria.patient_birth_date)
+        match("st.study_uid", criteria.study_instance_uid)
+        match_date("st.study_date", criteria.study_date)
+        match("st.study_description", criteria.study_description, case_sensitive=False)
+        match("st.accession_number", criteria.accession_number)
+
+        series_clauses = len(clauses)
+        match("se.series_uid", criteria.series_instance_uid)
+        match("se.series_description", criteria.series_description)
+        match_date("se.series_date", criteria.series_date)
+        match("se.modality", criteria.modality)
+        if level == 'IMAGE':
+            match("i.sop_uid", criteria.sop_instance_uid)
+
+        if level == 'STUDY' and len(clauses) > series_clauses:
+            # Series attributes filter the studies that contain a matching series
+            series_filter = " AND ".join(clauses[series_clauses:])
+            clauses[series_clauses:] = [
+                f"EXISTS (SELECT 1 FROM series se WHERE se.study_uid = st.study_uid AND {series_filter})"
+            ]
+        return clauses, params
+
+    def search(self, criteria: SearchCriteria, limit=None):
+        """Answer a search from the catalog, returns Datasets shaped like C-FIND identifiers (at most limit)"""
+        level = (criteria.level or 'STUDY').upper()
+        if level == 'STUDY':
+            columns = STUDY_COLUMNS + [(
+                "(SELECT COUNT(*) FROM series se JOIN instances i ON i.series_uid = se.series_uid "
+                "WHERE se.study_uid = st.study_uid)", "NumberOfStudyRelatedInstances")]
+            tables = "studies st JOIN patients p ON p.patient_id = st.patient_id"
+        elif level == 'SERIES':
+            columns = SERIES_COLUMNS + [(
+                "(SELECT COUNT(*) FROM instances i WHERE i.series_uid = se.series_uid)",
+                "NumberOfSeriesRelatedInstances")]
+            tables = ("series se JOIN studies st ON st.study_uid = se.study_uid "
+                      "JOIN patients p ON p.patient_id = st.patient_id")
+        elif level == 'IMAGE':
+            columns = IMAGE_COLUMNS
+            tables = ("instances i JOIN series se ON se.series_uid = i.series_uid "
+                      "JOIN studies st ON st.study_uid = se.study_uid "
+                      "JOIN patients p ON p.patient_id = st.patient_id")
+        else:
+            raise ValueError(f"Unsupported query level: {level}")
+
+        clauses, params = self._conditions(criteria, level)
+        sql = f"SELECT {', '.join(expr for expr, _ in columns)} FROM {tables}"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        if limit:
+            sql += " LIMIT ?"
+            params = list(params) + [limit]
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+
+        results = []
+        for row in rows:
+            ds = Dataset()
+            ds.QueryRetrieveLevel = level
+            for (_, keyword), value in zip(columns, row):
+                setattr(ds, keyword, value if value is not None else '')
+            results.append(ds)
+        return results
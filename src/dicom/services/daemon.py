@@ -0,0 +1,667 @@
+"""
+Serve Daemon
+
+`dicom-client serve` keeps one process running with the Find/Get/Move
+services built once, their associations kept idle and reused between
+requests (keep_alive), and one storage SCP bound for good: every C-MOVE of
+every job is received on the same port, the moves being told apart by the
+move registry. The files of a move are sorted into output_dir once it has
+completed (never while another move is receiving).
+
+Search, get and move jobs are queued and run by a few worker threads (get
+jobs one at a time, they share the C-GET association). The job API is JSON
+over HTTP, by default on a Unix socket in a directory only the user can
+open (runtime_dir), or on "unix:<path>" / a localhost "host:port". Every
+request carries the bearer token the daemon writes, owner-only, next to it
+(token_path): other local users can neither submit jobs nor read results.
+
+    GET    /status                SCP, workers, jobs per state
+    GET    /jobs                  every job, most recent first
+    POST   /jobs                  {"kind": "search"|"get"|"move", "criteria": {...}, "options": {...}}
+    GET    /jobs/<id>?wait=<s>    one job, waiting up to s seconds for it to finish
+    GET    /jobs/<id>/records     records of a search job, one JSON object per line as they arrive
+    DELETE /jobs/<id>             cancel a queued job
+    POST   /shutdown
+
+Search records are handed over to their reader through a bounded buffer and
+never kept by the daemon. The search/get/move commands of the CLI become
+clients of the daemon when one answers at TelemisConfig.DAEMON_ADDRESS
+(DaemonClient.discover).
+"""
+
+import hmac
+import http.client
+import json
+import logging
+import os
+import queue
+import secrets
+import socket
+import socketserver
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from time import monotonic, time
+from urllib.parse import parse_qs, urlsplit
+
+from pynetdicom import evt
+
+from dicom.services.durability import DurableWriter
+from dicom.services.find import Find
+from dicom.services.get import Get
+from dicom.services.move import Move
+from dicom.services.pack import PackStore
+from dicom.services.records import record_class
+from dicom.services.search_criteria import SearchCriteria, retrieve_requests
+from dicom.services.throttle import Throttler
+
+KINDS = ('search', 'get', 'move')
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = 'queued', 'running', 'done', 'failed', 'cancelled'
+FINISHED = (DONE, FAILED, CANCELLED)
+UNIX_PREFIX = 'unix:'
+MAX_WAIT = 60
+# Search records buffered for their reader
+STREAM_BUFFER = 1000
+
+
+def runtime_dir():
+    """Per-user directory of the daemon socket and token, created 0700 (refused if others can enter it)"""
+    base = os.environ.get('XDG_RUNTIME_DIR')
+    path = os.path.join(base, 'dicom-client') if base else os.path.join(os.path.expanduser('~'), '.dicom-client')
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.stat(path)
+    if info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError(f"{path} must belong to the user and be closed to others (chmod 700)")
+    return path
+
+
+def default_address():
+    return UNIX_PREFIX + os.path.join(runtime_dir(), 'daemon.sock')
+
+
+def token_path(address):
+    """File of the API token of the daemon at address: next to its socket, or in runtime_dir for a port"""
+    kind, target = parse_address(address)
+    if kind == 'unix':
+        return target + '.token'
+    return os.path.join(runtime_dir(), f"daemon-{target[1]}.token")
+
+
+def read_token(address):
+    try:
+        with open(token_path(address)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def parse_address(address):
+    """('unix', path) or ('tcp', (host, port)) of a daemon address"""
+    if address.startswith(UNIX_PREFIX):
+        return 'unix', address[len(UNIX_PREFIX):]
+    host, _, port = address.rpartition(':')
+    return 'tcp', (host or '127.0.0.1', int(port))
+
+
+def criteria_kwargs(criteria):
+    """SearchCriteria keyword arguments of a criteria object, for a job request"""
+    values = {key: value for key, value in vars(criteria).items() if value is not None}
+    if 'anonymize_data' in values:
+        values['anonymize'] = values.pop('anonymize_data')
+    return values
+
+
+class Job:
+    """One queued request and its outcome"""
+
+    def __init__(self, job_id, kind, criteria, options):
+        self.id = job_id
+        self.kind = kind
+        self.criteria = criteria
+        self.options = options
+        self.state = QUEUED
+        self.result = None
+        self.error = None
+        self.created = time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+        self.records = RecordStream() if kind == 'search' else None
+
+    def as_dict(self):
+        return {'id': self.id, 'kind': self.kind, 'state': self.state, 'criteria': self.criteria,
+                'options': self.options, 'result': self.result, 'error': self.error,
+                'created': self.created, 'started': self.started, 'finished': self.finished}
+
+
+class RecordStream:
+    """Records of a running search job handed over to one reader through a bounded buffer.
+
+    The job blocks while the buffer is full; it fails if no reader shows up
+    within MAX_WAIT seconds or if the reader goes away.
+    """
+
+    def __init__(self, size=STREAM_BUFFER):
+        self._queue = queue.Queue(size)
+        self._lock = threading.Lock()
+        self.claimed = False
+        self.closed = False
+
+    def put(self, values):
+        deadline = monotonic() + MAX_WAIT
+        while not self.closed:
+            try:
+                self._queue.put(values, timeout=0.5)
+                return
+            except queue.Full:
+                if not self.claimed and monotonic() > deadline:
+                    raise TimeoutError("Nobody read the search records") from None
+        raise ConnectionError("The reader of the search records went away")
+
+    def claim(self):
+        """True for the first reader only"""
+        with self._lock:
+            claimed, self.claimed = self.claimed, True
+        return not claimed
+
+    def read(self, done):
+        """Records until the job is done (done: its Event) and the buffer is drained"""
+        while True:
+            try:
+                yield self._queue.get(timeout=0.5)
+            except queue.Empty:
+                if done.is_set() and self._queue.empty():
+                    return
+
+
+class JobQueue:
+    """In-memory job queue run by worker threads; the last MAX_FINISHED finished jobs are kept"""
+
+    MAX_FINISHED = 500
+
+    def __init__(self, runner, workers=4):
+        self.runner = runner
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._ids = count(1)
+        self.workers = max(1, workers)
+        self._threads = [threading.Thread(target=self._work, name=f'job-{index}', daemon=True)
+                         for index in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, kind, criteria, options=None):
+        if kind not in KINDS:
+            raise ValueError(f"Unknown job kind {kind!r}, expected one of {KINDS}")
+        SearchCriteria(**criteria)
+        with self._lock:
+            job = Job(next(self._ids), kind, criteria, options or {})
+            self._jobs[job.id] = job
+            self._prune()
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self):
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda job: job.id, reverse=True)
+
+    def counts(self):
+        counts = {}
+        for job in self.jobs():
+            counts[job.state] = counts.get(job.state, 0) + 1
+        return counts
+
+    def cancel(self, job_id):
+        """Cancel a queued job (a running job runs to its end), True if cancelled"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.state != QUEUED:
+                return False
+            job.state = CANCELLED
+            job.finished = time()
+        job.done.set()
+        return True
+
+    def close(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _prune(self):
+        """Forget the oldest finished jobs and the records nobody read MAX_WAIT after their search (caller holds the lock)"""
+        finished = [job_id for job_id, job in self._jobs.items() if job.state in FINISHED]
+        for job_id in finished[:max(0, len(finished) - self.MAX_FINISHED)]:
+            del self._jobs[job_id]
+        for job in self._jobs.values():
+            stale = job.finished is not None and time() - job.finished > MAX_WAIT
+            if stale and job.records is not None and not job.records.claimed:
+                job.records = None
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            with self._lock:
+                if job.state != QUEUED:
+                    continue
+                job.state = RUNNING
+                job.started = time()
+            try:
+                job.result = self.runner(job)
+                job.state = DONE
+            except Exception as e:
+                logging.error(f"Job {job.id} ({job.kind}) failed: {e}")
+                job.error = f"{type(e).__name__}: {e}"
+                job.state = FAILED
+            job.finished = time()
+            job.done.set()
+
+
+class DicomDaemon:
+    """Warm Find/Get/Move services, one storage SCP and the job queue running on them"""
+
+    def __init__(self, config, output_dir="output_dir", scp_address=None, workers=4, keep_alive=60, catalog=None):
+        self.config = config
+        self.find = Find(config)
+        self.find.keep_alive = keep_alive
+        self.get = Get(config, output_dir=output_dir, catalog=catalog)
+        self.get.keep_alive = keep_alive
+        self.move = Move(config, output_dir=output_dir, catalog=catalog)
+        self.move.nodes.keep_alive = keep_alive
+        self.scp = None
+        self.scp_address = scp_address
+        if scp_address is not None:
+            handlers = [(evt.EVT_C_STORE, self.move._handle_store)]
+            self.scp = self.move.ae.start_server(scp_address, block=False, evt_handlers=handlers)
+            self.move.profile.tune_server(self.scp)
+        self._get_lock = threading.Lock()
+        # Moves receive into the shared temp_dir: it is sorted only while no move is running
+        self._sort_condition = threading.Condition()
+        self._moving = 0
+        self._sort_waiting = 0
+        self._sorting = False
+        self.queue = JobQueue(self.run_job, workers)
+        self.started = time()
+
+    def run_job(self, job):
+        criteria = SearchCriteria(**job.criteria)
+        if job.kind == 'search':
+            return self._search(criteria, job.options, job.records)
+        return getattr(self, f"_{job.kind}")(criteria, job.options)
+
+    def _find(self, criteria, limit=None):
+        # iter_search raises its own error: Find.last_error is shared by the jobs running in parallel
+        return list(self.find.iter_search(criteria, limit))
+
+    def _search(self, criteria, options, records):
+        """Streams the records to their reader; the job only keeps their number"""
+        limit = options.get('limit')
+        found = 0
+        for record in self.find.iter_search(criteria, limit):
+            records.put(record.as_dict())
+            found += 1
+        return {'level': criteria.level, 'records': found, 'limit_reached': bool(limit and found >= limit)}
+
+    def _get(self, criteria, options):
+        results = self._find(criteria)
+        requests = retrieve_requests(criteria.level, results)
+        with self._get_lock:
+            self.get.packs = PackStore() if options.get('pack') else None
+            durable = options.get('durable')
+            fsync_window = options.get('fsync_window', self.config.FSYNC_WINDOW)
+            self.get.durable = DurableWriter(durable, fsync_window, self.config.FSYNC_BATCH) if durable else None
+            self.get.manifest.fsync = self.get.durable is not None
+            schedule = options.get('throttle') or self.config.THROTTLE_SCHEDULE
+            self.get.throttler = Throttler(schedule) if schedule else None
+            files = 0
+            try:
+                for request in requests:
+                    files += int(self.get.retrieve_data(request) or 0)
+            finally:
+                if self.get.durable is not None:
+                    self.get.durable.close()
+        return {'matches': len(results), 'files': files}
+
+    @contextmanager
+    def _receiving(self):
+        with self._sort_condition:
+            # A sort waiting goes first, moves would otherwise keep it waiting for ever
+            while self._sort_waiting:
+                self._sort_condition.wait()
+            self._moving += 1
+        try:
+            yield
+        finally:
+            with self._sort_condition:
+                self._moving -= 1
+                self._sort_condition.notify_all()
+
+    def _sort(self):
+        with self._sort_condition:
+            self._sort_waiting += 1
+            while self._moving or self._sorting:
+                self._sort_condition.wait()
+            self._sorting = True
+        try:
+            self.move.final_global_sort()
+        finally:
+            with self._sort_condition:
+                self._sorting = False
+                self._sort_waiting -= 1
+                self._sort_condition.notify_all()
+
+    def _move(self, criteria, options):
+        results = self._find(criteria)
+        destination = options.get('destination')
+        files = 0
+        with self._receiving():
+            for request in retrieve_requests(criteria.level, results):
+                files += int(self.move.move_data(request, destination_aet=destination) or 0)
+        # Sent to another AE: nothing received here to sort
+        if files and destination in (None, self.config.CALLING_AET):
+            self._sort()
+        return {'matches': len(results), 'files': files}
+
+    def status(self):
+        return {'pid': os.getpid(), 'uptime': time() - self.started, 'ae_title': self.config.CALLING_AET,
+                'scp': list(self.scp_address) if self.scp_address else None,
+                'workers': self.queue.workers, 'jobs': self.queue.counts(),
+                'reused_associations': self.move.nodes.reused}
+
+    def close(self):
+        self.queue.close()
+        if self.scp is not None:
+            self.scp.shutdown()
+        self.find.close_idle()
+        self.get.close_idle()
+        self.move.nodes.close_idle()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """JSON job API of the daemon (server.daemon), for the holders of server.token"""
+
+    def log_message(self, format, *args):
+        logging.debug("API %s", format % args)
+
+    def _authorized(self):
+        if hmac.compare_digest(self.headers.get('Authorization', ''), f"Bearer {self.server.token}"):
+            return True
+        self._send(401, {'error': "Missing or wrong API token"})
+        return False
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _job_id(self, path):
+        try:
+            return int(path.rsplit('/', 1)[1])
+        except (IndexError, ValueError):
+            return None
+
+    def _stream_records(self, job, stream):
+        """NDJSON records of a search job, the connection closing at the end (HTTP/1.0)"""
+        if not stream.claim():
+            return self._send(409, {'error': f"Job {job.id} records already read"})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        try:
+            for values in stream.read(job.done):
+                self.wfile.write(json.dumps(values).encode('utf-8') + b'\n')
+        except OSError:
+            # The search stops instead of waiting for a reader that is gone
+            stream.closed = True
+        return None
+
+    def do_GET(self):
+        if not self._authorized():
+            return None
+        daemon = self.server.daemon
+        url = urlsplit(self.path)
+        if url.path.startswith('/jobs/') and url.path.endswith('/records'):
+            job = daemon.queue.get(self._job_id(url.path[:-len('/records')]))
+            stream = job.records if job is not None else None
+            if stream is None:
+                return self._send(404, {'error': f"Not found: {url.path}"})
+            return self._stream_records(job, stream)
+        if url.path == '/status':
+            return self._send(200, daemon.status())
+        if url.path == '/jobs':
+            return self._send(200, [job.as_dict() for job in daemon.queue.jobs()])
+        job = daemon.queue.get(self._job_id(url.path)) if url.path.startswith('/jobs/') else None
+        if job is None:
+            return self._send(404, {'error': f"Not found: {url.path}"})
+        wait = float(parse_qs(url.query).get('wait', ['0'])[0])
+        if wait > 0:
+            job.done.wait(min(wait, MAX_WAIT))
+        return self._send(200, job.as_dict())
+
+    def do_POST(self):
+        if not self._authorized():
+            return None
+        daemon = self.server.daemon
+        if self.path == '/shutdown':
+            self._send(200, {'stopping': True})
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return None
+        if self.path != '/jobs':
+            return self._send(404, {'error': f"Not found: {self.path}"})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+            job = daemon.queue.submit(body.get('kind'), body.get('criteria') or {}, body.get('options'))
+        except (ValueError, TypeError) as e:
+            return self._send(400, {'error': str(e)})
+        return self._send(202, job.as_dict())
+
+    def do_DELETE(self):
+        if not self._authorized():
+            return None
+        daemon = self.server.daemon
+        job_id = self._job_id(self.path) if self.path.startswith('/jobs/') else None
+        if daemon.queue.get(job_id) is None:
+            return self._send(404, {'error': f"Not found: {self.path}"})
+        if not daemon.queue.cancel(job_id):
+            return self._send(409, {'error': f"Job {job_id} is not queued any more"})
+        return self._send(200, daemon.queue.get(job_id).as_dict())
+
+
+class _ApiServer:
+    """Removes the token file (and the Unix socket) once closed"""
+
+    # Clients wait on their jobs and streams: more of them connect at once than the default backlog of 5
+    request_queue_size = 64
+    token_file = None
+
+    def server_close(self):
+        super().server_close()
+        for path in (self.token_file, getattr(self, 'socket_path', None)):
+            if path and os.path.exists(path):
+                os.unlink(path)
+
+
+class _TcpHTTPServer(_ApiServer, ThreadingHTTPServer):
+    pass
+
+
+class _UnixHTTPServer(_ApiServer, socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ('local', 0)
+
+
+def api_server(daemon, address=None):
+    """HTTP server of the job API (default_address if None) and its token, both owner-only"""
+    address = address or default_address()
+    kind, target = parse_address(address)
+    if kind == 'unix':
+        if os.path.exists(target):
+            os.unlink(target)
+        # Created owner-only, no window where others could connect
+        umask = os.umask(0o177)
+        try:
+            server = _UnixHTTPServer(target, _Handler)
+        finally:
+            os.umask(umask)
+        server.socket_path = target
+    else:
+        server = _TcpHTTPServer(target, _Handler)
+    server.daemon = daemon
+    server.token = secrets.token_urlsafe(32)
+    server.token_file = token_path(address)
+    fd = os.open(server.token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        os.fchmod(f.fileno(), 0o600)
+        f.write(server.token)
+    return server
+
+
+class _UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class DaemonClient:
+    """Client of the job API (default_address if None), authenticated with the token of the daemon.
+
+    Request errors raise RuntimeError, an unreachable daemon OSError.
+    """
+
+    def __init__(self, address=None, timeout=MAX_WAIT + 10):
+        self.address = address or default_address()
+        self.timeout = timeout
+        self.token = read_token(self.address)
+
+    @classmethod
+    def discover(cls, address=None, timeout=0.5):
+        """A client of the daemon answering at address, or None (no daemon, or not one of this user)"""
+        try:
+            client = cls(address, timeout=timeout)
+            if client.token is None:
+                return None
+            client.status()
+        except (OSError, RuntimeError, ValueError):
+            return None
+        client.timeout = MAX_WAIT + 10
+        return client
+
+    def _connection(self):
+        kind, target = parse_address(self.address)
+        if kind == 'unix':
+            return _UnixConnection(target, self.timeout)
+        return http.client.HTTPConnection(*target, timeout=self.timeout)
+
+    def _send(self, connection, method, path, body=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        headers = {'Content-Type': 'application/json'} if data is not None else {}
+        if self.token:
+            headers['Authorization'] = f"Bearer {self.token}"
+        connection.request(method, path, body=data, headers=headers)
+        return connection.getresponse()
+
+    @staticmethod
+    def _error(response, payload):
+        return RuntimeError(payload.get('error') if isinstance(payload, dict) else f"HTTP {response.status}")
+
+    def request(self, method, path, body=None):
+        connection = self._connection()
+        try:
+            response = self._send(connection, method, path, body)
+            payload = json.loads(response.read() or b'null')
+        finally:
+            connection.close()
+        if response.status >= 400:
+            raise self._error(response, payload)
+        return payload
+
+    def records(self, job_id):
+        """Values of the records of a search job, as the daemon finds them"""
+        connection = self._connection()
+        try:
+            response = self._send(connection, 'GET', f'/jobs/{job_id}/records')
+            if response.status >= 400:
+                raise self._error(response, json.loads(response.read() or b'null'))
+            for line in response:
+                yield json.loads(line)
+        finally:
+            connection.close()
+
+    def status(self):
+        return self.request('GET', '/status')
+
+    def jobs(self):
+        return self.request('GET', '/jobs')
+
+    def submit(self, kind, criteria, options=None):
+        return self.request('POST', '/jobs', {'kind': kind, 'criteria': criteria_kwargs(criteria),
+                                              'options': options or {}})
+
+    def wait(self, job_id):
+        """The job once finished"""
+        while True:
+            job = self.request('GET', f'/jobs/{job_id}?wait={MAX_WAIT}')
+            if job['state'] in FINISHED:
+                return job
+
+    def cancel(self, job_id):
+        return self.request('DELETE', f'/jobs/{job_id}')
+
+    def shutdown(self):
+        return self.request('POST', '/shutdown')
+
+    def run(self, kind, criteria, options=None):
+        """Submit a job and return its result once done; a failed job raises RuntimeError"""
+        job = self.submit(kind, criteria, options)
+        try:
+            job = self.wait(job['id'])
+        except KeyboardInterrupt:
+            try:
+                self.cancel(job['id'])
+            except (OSError, RuntimeError):
+                pass
+            raise
+        if job['state'] != DONE:
+            raise RuntimeError(job['error'] or f"Job {job['id']} {job['state']}")
+        return job['result']
+
+    def search(self, criteria, limit=None):
+        """Compact records of a search run by the daemon, yielded as they arrive.
+
+        A failed search raises RuntimeError once the records found before the
+        error have been yielded.
+        """
+        job = self.submit('search', criteria, {'limit': limit})
+        cls = record_class(criteria.level)
+        try:
+            for values in self.records(job['id']):
+                yield cls(**values)
+            job = self.wait(job['id'])
+        except KeyboardInterrupt:
+            try:
+                self.cancel(job['id'])
+            except (OSError, RuntimeError):
+                pass
+            raise
+        if job['state'] != DONE:
+            raise RuntimeError(job['error'] or f"Job {job['id']} {job['state']}")
@@ -0,0 +1,358 @@
+"""
+DICOMweb Transport
+
+QIDO-RS searches and WADO-RS retrievals, used by Find, Get and Move instead
+of C-FIND / C-GET / C-MOVE when the source node is configured with
+"transport": "dicomweb" (SOURCE_NODES entry with a "url"). No association,
+and nothing has to connect back to us.
+
+Requests go over a pool of persistent HTTP connections (at most
+max_associations per node). A retrieve is split into one WADO-RS request
+per series, run in parallel over the pool; each multipart/related response
+is parsed as it arrives and every part (one Part 10 file) is streamed in
+blocks to a temporary file, hashed on the way, never held in memory.
+"""
+
+import http.client
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from queue import Empty, LifoQueue
+from urllib.parse import quote, urlencode, urlsplit
+
+from pydicom import Dataset
+
+from dicom.services.network import NetworkProfile
+from dicom.services.records import record_class
+from dicom.services.search_criteria import uid_list
+
+TRANSPORTS = ('dimse', 'dicomweb')
+READ_BLOCK = 1024 * 1024
+PAGE_SIZE = 1000
+ACCEPT_DICOM = 'multipart/related; type="application/dicom"; transfer-syntax=*'
+ACCEPT_JSON = 'application/dicom+json'
+
+STUDY_KEYS = {
+    'patient_id': 'PatientID',
+    'patient_name': 'PatientName',
+    'patient_birth_date': 'PatientBirthDate',
+    'study_date': 'StudyDate',
+    'study_description': 'StudyDescription',
+    'accession_number': 'AccessionNumber',
+    'study_instance_uid': 'StudyInstanceUID',
+}
+SERIES_KEYS = dict(STUDY_KEYS, series_instance_uid='SeriesInstanceUID', series_date='SeriesDate',
+                   series_description='SeriesDescription', modality='Modality')
+IMAGE_KEYS = dict(SERIES_KEYS, sop_instance_uid='SOPInstanceUID')
+QIDO_KEYS = {'STUDY': STUDY_KEYS, 'SERIES': SERIES_KEYS, 'IMAGE': IMAGE_KEYS}
+QIDO_RESOURCES = {'STUDY': 'studies', 'SERIES': 'series', 'IMAGE': 'instances'}
+
+# Errors worth one retry on a new connection: the server closed an idle keep-alive connection
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionResetError,
+                           BrokenPipeError)
+
+
+class DicomWebError(RuntimeError):
+    """HTTP error status of a DICOMweb request"""
+
+    def __init__(self, status, message):
+        super().__init__(f"HTTP {status}: {message}")
+        self.status = status
+
+
+class HttpPool:
+    """Persistent HTTP(S) connections to one server, at most max_connections in use at once"""
+
+    def __init__(self, url, max_connections=4, timeout=60, headers=None):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError(f"Unsupported DICOMweb URL {url!r}")
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.base_path = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.headers = dict(headers or {})
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._idle = LifoQueue()
+        self.opened = 0
+        self.requests = 0
+
+    def _connect(self):
+        cls = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+        self.opened += 1
+        return cls(self.host, self.port, timeout=self.timeout)
+
+    def _send(self, connection, method, path, headers):
+        connection.request(method, self.base_path + path, headers=dict(self.headers, **headers))
+        return connection.getresponse()
+
+    @contextmanager
+    def request(self, method, path, headers=None):
+        """Yield the response of a request; the connection goes back to the pool if it was read to the end"""
+        headers = headers or {}
+        with self._slots:
+            try:
+                connection = self._idle.get_nowait()
+            except Empty:
+                connection = self._connect()
+            try:
+                response = self._send(connection, method, path, headers)
+            except STALE_CONNECTION_ERRORS:
+                connection.close()
+                connection = self._connect()
+                response = self._send(connection, method, path, headers)
+            except Exception:
+                connection.close()
+                raise
+            self.requests += 1
+            try:
+                yield response
+            finally:
+                if response.isclosed() and not response.will_close:
+                    self._idle.put(connection)
+                else:
+                    connection.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Empty:
+                return
+
+
+class MultipartPart:
+    """One part of a multipart/related body; its content must be read (chunks) before the next part"""
+
+    def __init__(self, reader, headers):
+        self._reader = reader
+        self.headers = headers
+        self.content_type = headers.get('content-type', '')
+
+    def chunks(self):
+        return self._reader._body()
+
+
+class MultipartReader:
+    """Parts of a multipart/related response, read in blocks from a file-like object"""
+
+    def __init__(self, fp, boundary, block_size=READ_BLOCK):
+        self.fp = fp
+        self.block_size = block_size
+        # The delimiter of every part, the first one included, is CRLF "--" boundary
+        self.delimiter = b'\r\n--' + boundary.encode('ascii')
+        self.buffer = bytearray(b'\r\n')
+        self.eof = False
+        self.finished = False
+
+    def _fill(self):
+        data = self.fp.read(self.block_size)
+        if not data:
+            self.eof = True
+        self.buffer += data
+        return bool(data)
+
+    def _skip_to_delimiter(self):
+        while True:
+            index = self.buffer.find(self.delimiter)
+            if index >= 0:
+                del self.buffer[:index + len(self.delimiter)]
+                return
+            # The end of the buffer may hold the start of the delimiter
+            del self.buffer[:max(0, len(self.buffer) - len(self.delimiter))]
+            if not self._fill():
+                raise ValueError("Multipart body without boundary")
+
+    def _headers(self):
+        """Headers of the part after a delimiter, or None after the closing delimiter"""
+        while len(self.buffer) < 2 and self._fill():
+            pass
+        if self.buffer[:2] == b'--':
+            self.finished = True
+            return None
+        while True:
+            index = self.buffer.find(b'\r\n\r\n')
+            if index >= 0:
+                break
+            if not self._fill():
+                raise ValueError("Multipart part without headers")
+        lines = bytes(self.buffer[:index]).decode('latin-1').split('\r\n')
+        del self.buffer[:index + 4]
+        headers = {}
+        for line in lines:
+            name, _, value = line.partition(':')
+            if value:
+                headers[name.strip().lower()] = value.strip()
+        return headers
+
+    def _body(self):
+        """Content of the current part, up to the next delimiter, in blocks"""
+        keep = len(self.delimiter)
+        while True:
+            index = self.buffer.find(self.delimiter)
+            if index >= 0:
+                if index:
+                    yield bytes(self.buffer[:index])
+                del self.buffer[:index + len(self.delimiter)]
+                return
+            if len(self.buffer) > keep:
+                yield bytes(self.buffer[:-keep])
+                del self.buffer[:-keep]
+            if not self._fill():
+                raise ValueError("Multipart body truncated")
+
+    def parts(self):
+        self._skip_to_delimiter()
+        while True:
+            headers = self._headers()
+            if headers is None:
+                return
+            part = MultipartPart(self, headers)
+            yield part
+
+
+def multipart_boundary(content_type):
+    """Boundary parameter of a multipart Content-Type header"""
+    for parameter in content_type.split(';')[1:]:
+        name, _, value = parameter.strip().partition('=')
+        if name.lower() == 'boundary':
+            return value.strip('"')
+    raise ValueError(f"No boundary in Content-Type {content_type!r}")
+
+
+class DicomWebClient:
+    """QIDO-RS / WADO-RS client of one DICOMweb service"""
+
+    def __init__(self, url, max_connections=4, timeout=60, headers=None, name=None):
+        self.url = url.rstrip('/')
+        self.name = name or self.url
+        self.max_connections = max_connections
+        self.pool = HttpPool(url, max_connections, timeout, headers)
+
+    @classmethod
+    def from_config(cls, config):
+        """Client of the first "dicomweb" node of config.SOURCE_NODES, None if the nodes use DIMSE"""
+        for spec in getattr(config, 'SOURCE_NODES', None) or []:
+            if spec.get('transport') == 'dicomweb':
+                name = spec.get('name') or spec['url']
+                profile = NetworkProfile.load(config, name=name, overrides=spec.get('network'))
+                return cls(spec['url'], spec.get('max_associations', 4), profile.network_timeout,
+                           spec.get('headers'), name)
+        return None
+
+    def close(self):
+        self.pool.close()
+
+    # QIDO-RS
+
+    def _qido(self, path, params):
+        with self.pool.request('GET', f"{path}?{urlencode(params)}", {'Accept': ACCEPT_JSON}) as response:
+            body = response.read()
+            if response.status == 204:
+                return []
+            if response.status >= 400:
+                raise DicomWebError(response.status, body[:200].decode('utf-8', 'replace'))
+        return [Dataset.from_json(item) for item in json.loads(body or b'[]')]
+
+    def _query_params(self, criteria, level):
+        params = {}
+        for attribute, keyword in QIDO_KEYS[level].items():
+            value = getattr(criteria, attribute, None)
+            if not value:
+                continue
+            # UID list matching is a comma-separated list in QIDO-RS
+            params[keyword] = ','.join(uid_list(value)) if attribute.endswith('_uid') else value
+        params['includefield'] = ','.join(record_class(level).FIELDS)
+        return params
+
+    def iter_search(self, criteria, limit=None, page_size=PAGE_SIZE):
+        """Compact records matching the criteria, page by page (limit/offset), at most limit.
+
+        Servers cap the page size on their own (a shorter page than asked is
+        not the last one): pages are requested until an empty one.
+        """
+        level = (criteria.level or 'STUDY').upper()
+        cls = record_class(level)
+        params = self._query_params(criteria, level)
+        path = f"/{QIDO_RESOURCES[level]}"
+        offset = 0
+        while True:
+            size = min(page_size, limit - offset) if limit else page_size
+            identifiers = self._qido(path, dict(params, limit=size, offset=offset))
+            for identifier in identifiers:
+                yield cls.from_identifier(identifier)
+            offset += len(identifiers)
+            if not identifiers or (limit and offset >= limit):
+                return
+
+    def search(self, criteria, limit=None):
+        return list(self.iter_search(criteria, limit))
+
+    def study_series(self, study_uid):
+        """SeriesInstanceUIDs of a study"""
+        return [str(identifier.SeriesInstanceUID)
+                for identifier in self._qido(f"/studies/{quote(study_uid)}/series",
+                                             {'includefield': 'SeriesInstanceUID'})]
+
+    # WADO-RS
+
+    def targets(self, criteria):
+        """(study, series, instance) WADO-RS targets of a retrieve: one per series, or per instance at IMAGE level"""
+        study_uids = uid_list(criteria.study_instance_uid)
+        if criteria.level == 'IMAGE':
+            return [(study_uids[0], criteria.series_instance_uid, criteria.sop_instance_uid)]
+        if criteria.level == 'SERIES':
+            series_uids = uid_list(criteria.series_instance_uid)
+            if len(study_uids) == 1:
+                study_uids = study_uids * len(series_uids)
+            return [(study_uid, series_uid, None) for study_uid, series_uid in zip(study_uids, series_uids)]
+        return [(study_uid, series_uid, None) for study_uid in study_uids
+                for series_uid in self.study_series(study_uid)]
+
+    def retrieve_target(self, target, store):
+        """WADO-RS retrieve of one series (or instance), store(part) called for each part, returns the count"""
+        study_uid, series_uid, sop_uid = target
+        path = f"/studies/{quote(study_uid)}/series/{quote(series_uid)}"
+        if sop_uid:
+            path += f"/instances/{quote(sop_uid)}"
+        count = 0
+        with self.pool.request('GET', path, {'Accept': ACCEPT_DICOM}) as response:
+            if response.status == 204 or response.status == 404:
+                response.read()
+                return 0
+            if response.status >= 400:
+                raise DicomWebError(response.status, response.read(200).decode('utf-8', 'replace'))
+            reader = MultipartReader(response, multipart_boundary(response.getheader('Content-Type', '')))
+            for part in reader.parts():
+                store(part)
+                count += 1
+            # The connection is reused only once the response has been read to its end
+            while response.read(READ_BLOCK):
+                pass
+        return count
+
+    def retrieve(self, criteria, store, workers=None):
+        """Retrieve the series of the criteria in parallel over the pool, returns (instances, [(target, error)]).
+
+        Raises the connection error when every series failed on one: the
+        server is unreachable rather than missing some series.
+        """
+        targets = self.targets(criteria)
+        received, errors, unreachable = 0, [], []
+        with ThreadPoolExecutor(max_workers=workers or self.max_connections) as executor:
+            futures = {executor.submit(self.retrieve_target, target, store): target for target in targets}
+            for future in as_completed(futures):
+                try:
+                    received += future.result()
+                except Exception as e:
+                    logging.error(f"WADO-RS retrieve of {futures[future]} failed: {e}")
+                    errors.append((futures[future], f"{type(e).__name__}: {e}"))
+                    if isinstance(e, OSError):
+                        unreachable.append(e)
+        if unreachable and len(unreachable) == len(targets):
+            raise unreachable[0]
+        return received, errors
+
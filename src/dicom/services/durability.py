@@ -0,0 +1,181 @@
+"""
+Durable Writes
+
+Received instances are written under a temporary name (.<name>.part, skipped
+by the sorters) and handed to a DurableWriter, whose flusher thread commits
+them in batches: every file of the batch is fsynced, renamed into place, and
+the directories holding them are fsynced once. A batch is flushed after
+`window` seconds or `max_files` files, whichever comes first, so one flush
+covers many instances instead of one per file.
+
+Two modes decide what waits for the flush:
+
+    response  the C-STORE handler blocks until its batch is on disk, the PACS
+              gets Success only for durable instances. C-STOREs of one
+              association are sequential: each one waits for a flush, so keep
+              the window close to the fsync latency of the disk (the batches
+              fill up across associations).
+    manifest  the handler answers at once, the instance is recorded in the
+              series manifest once its batch is on disk. After a host crash
+              the instances not committed are not in the manifests and are
+              simply requested again.
+
+Files rewritten after reception (pseudonymization) go through the same
+writer and wait for their commit whatever the mode, and the sorted folders
+are fsynced once the files have been renamed into them, so that an
+acknowledged instance is never left truncated or lost by a crash.
+"""
+
+import logging
+import os
+import threading
+from pathlib import Path
+from time import monotonic
+
+MODES = ('response', 'manifest')
+DEFAULT_WINDOW = 0.01
+DEFAULT_MAX_FILES = 64
+TEMP_PREFIX = '.'
+TEMP_SUFFIX = '.part'
+
+
+def fsync_path(path):
+    """fsync a file by path"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_directory(path):
+    """fsync a directory, persisting the names created or renamed in it (no-op where unsupported)"""
+    try:
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+    except OSError:
+        # Directories cannot be opened on Windows, renames are journaled by NTFS
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def temp_path(path):
+    """Temporary name of a file being written, hidden from scan_files"""
+    path = Path(path)
+    return path.with_name(f"{TEMP_PREFIX}{path.name}{TEMP_SUFFIX}")
+
+
+class _Pending:
+    __slots__ = ('tmp', 'final', 'on_commit', 'done', 'error')
+
+    def __init__(self, tmp, final, on_commit):
+        self.tmp = tmp
+        self.final = final
+        self.on_commit = on_commit
+        self.done = threading.Event()
+        self.error = None
+
+
+class DurableWriter:
+    """Group commit of written files: fsync, rename into place, fsync the directories"""
+
+    def __init__(self, mode='response', window=DEFAULT_WINDOW, max_files=DEFAULT_MAX_FILES):
+        if mode not in MODES:
+            raise ValueError(f"Unknown durability mode {mode!r}, expected one of {MODES}")
+        self.mode = mode
+        self.window = window
+        self.max_files = max_files
+        self._cond = threading.Condition()
+        self._queue = []
+        self._last = None
+        self._closed = False
+        self.batches = 0
+        self.files = 0
+        self._thread = threading.Thread(target=self._run, name='fsync', daemon=True)
+        self._thread.start()
+
+    temp_path = staticmethod(temp_path)
+
+    def commit(self, tmp, final, on_commit=None, wait=None):
+        """Queue a written file; return once durable in response mode or with wait (OSError if its flush failed)"""
+        pending = _Pending(Path(tmp), Path(final), on_commit)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("DurableWriter is closed")
+            self._queue.append(pending)
+            self._last = pending
+            self._cond.notify_all()
+        if wait or (wait is None and self.mode == 'response'):
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+
+    def drain(self):
+        """Wait until every file queued so far is committed"""
+        with self._cond:
+            last = self._last
+        if last is not None:
+            last.done.wait()
+
+    def close(self):
+        """Commit what is queued and stop the flusher thread"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._queue and not self._closed:
+                self._cond.wait()
+            if not self._queue:
+                return None
+            # The first file waits at most `window` for others to join its batch
+            deadline = monotonic() + self.window
+            while len(self._queue) < self.max_files and not self._closed:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch, self._queue = self._queue[:self.max_files], self._queue[self.max_files:]
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self._flush(batch)
+
+    def _flush(self, batch):
+        error = None
+        try:
+            for pending in batch:
+                fsync_path(pending.tmp)
+            for pending in batch:
+                os.replace(pending.tmp, pending.final)
+            # Both ends of each rename: the new name, and the old one gone when it was in another folder
+            for directory in {path.parent for pending in batch for path in (pending.tmp, pending.final)}:
+                fsync_directory(directory)
+        except OSError as e:
+            logging.error(f"Durable write failed for a batch of {len(batch)} file(s): {e}")
+            error = e
+        self.batches += 1
+        for pending in batch:
+            pending.error = error
+            if error is None:
+                self.files += 1
+                if pending.on_commit is not None:
+                    try:
+                        pending.on_commit()
+                    except Exception as e:
+                        logging.error(f"Commit callback failed for {pending.final}: {e}")
+            pending.done.set()
+
+    def report(self):
+        average = self.files / self.batches if self.batches else 0.0
+        return f"{self.files} files committed in {self.batches} flushes ({average:.1f} files/flush, {self.mode} mode)"
@@ -0,0 +1,297 @@
+"""
+Archive Export
+
+Streams sorted patient (or series) folders into tar or zip archives for
+research partners, without staging copies: every file is copied once, from
+its sorted location straight into the archive. Tar members are copied with
+os.sendfile where the platform supports it (kernel-side copy), zip members
+are stored uncompressed through a large copy buffer.
+"""
+
+import os
+import shutil
+import tarfile
+import threading
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import time
+
+from dicom.services.manifest import MANIFEST_DIR
+from dicom.services.sorter import COPY_BUFFER_SIZE, scan_files
+
+FORMATS = ('tar', 'zip')
+TAR_BLOCK_SIZE = tarfile.BLOCKSIZE
+EXCLUDED_DIRS = {'temp_transit', MANIFEST_DIR}
+MAX_OPEN_ARCHIVES = 64
+
+
+def _sendfile(src, out, size):
+    """Copy size bytes of src into out, in the kernel when possible"""
+    offset = 0
+    try:
+        while offset < size:
+            sent = os.sendfile(out.fileno(), src.fileno(), offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+    except (AttributeError, OSError):
+        # No sendfile (Windows) or not supported between these files: plain buffered copy
+        if offset == 0:
+            shutil.copyfileobj(src, out, COPY_BUFFER_SIZE)
+            return
+        raise
+
+
+class TarWriter:
+    """Sequential tar (PAX) writer: header, member data by sendfile, padding.
+
+    suspend() closes the file between members, the next add() reopens it
+    in append mode.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._part = self.path.with_name(self.path.name + '.part')
+        self._out = open(self._part, 'wb', buffering=0)
+        self.files = 0
+        self.bytes = 0
+
+    def _resume(self):
+        if self._out is None:
+            self._out = open(self._part, 'ab', buffering=0)
+
+    def suspend(self):
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+
+    def add(self, src_path, arcname):
+        self._resume()
+        stat = os.stat(src_path)
+        info = tarfile.TarInfo(arcname)
+        info.size = stat.st_size
+        info.mtime = int(stat.st_mtime)
+        info.mode = 0o644
+        self._out.write(info.tobuf(tarfile.PAX_FORMAT))
+        with open(src_path, 'rb') as src:
+            _sendfile(src, self._out, info.size)
+        remainder = info.size % TAR_BLOCK_SIZE
+        if remainder:
+            self._out.write(b'\0' * (TAR_BLOCK_SIZE - remainder))
+        self.files += 1
+        self.bytes += info.size
+
+    def close(self):
+        self._resume()
+        # End of archive: two zero blocks
+        self._out.write(b'\0' * (2 * TAR_BLOCK_SIZE))
+        self._out.close()
+        os.replace(self._part, self.path)
+
+
+class ZipWriter:
+    """Zip writer storing the members uncompressed (DICOM pixel data hardly compresses).
+
+    suspend() writes the central directory and closes the file, the next
+    add() reopens it in append mode (the directory is rewritten at close).
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._part = self.path.with_name(self.path.name + '.part')
+        self._zip = zipfile.ZipFile(self._part, 'w', compression=zipfile.ZIP_STORED, allowZip64=True)
+        self.files = 0
+        self.bytes = 0
+
+    def _resume(self):
+        if self._zip is None:
+            self._zip = zipfile.ZipFile(self._part, 'a', compression=zipfile.ZIP_STORED, allowZip64=True)
+
+    def suspend(self):
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+
+    def add(self, src_path, arcname):
+        self._resume()
+        info = zipfile.ZipInfo.from_file(src_path, arcname)
+        info.compress_type = zipfile.ZIP_STORED
+        with open(src_path, 'rb') as src, self._zip.open(info, 'w', force_zip64=info.file_size > 0x7FFFFFFF) as dst:
+            shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+        self.files += 1
+        self.bytes += info.file_size
+
+    def close(self):
+        self._resume()
+        self._zip.close()
+        os.replace(self._part, self.path)
+
+
+def open_archive(path, fmt='tar'):
+    """TarWriter or ZipWriter for path"""
+    if fmt == 'tar':
+        return TarWriter(path)
+    if fmt == 'zip':
+        return ZipWriter(path)
+    raise ValueError(f"Unknown archive format {fmt!r}, expected one of {FORMATS}")
+
+
+def export_directory(src_dir, archive_path, fmt='tar', arc_root=None):
+    """Write every file under src_dir into one archive, member names relative to arc_root.
+
+    Returns (files, bytes) written.
+    """
+    src_dir = Path(src_dir)
+    arc_root = Path(arc_root) if arc_root else src_dir.parent
+    writer = open_archive(archive_path, fmt)
+    try:
+        for path in sorted(scan_files(str(src_dir))):
+            writer.add(path, Path(path).relative_to(arc_root).as_posix())
+    finally:
+        writer.close()
+    return writer.files, writer.bytes
+
+
+def export_units(root, level='patient'):
+    """(source folder, archive stem) of every patient or series folder of a sorted tree"""
+    root = Path(root)
+    units = []
+    for patient_dir in sorted(root.iterdir()):
+        if not patient_dir.is_dir() or patient_dir.name.startswith('.') or \
+                patient_dir.name.startswith('temp_transit') or patient_dir.name in EXCLUDED_DIRS:
+            continue
+        if level == 'patient':
+            units.append((patient_dir, patient_dir.name))
+        else:
+            for series_dir in sorted(patient_dir.iterdir()):
+                if series_dir.is_dir():
+                    units.append((series_dir, f"{patient_dir.name}_{series_dir.name}"))
+    return units
+
+
+class ExportReport:
+    def __init__(self):
+        self.archives = 0
+        self.files = 0
+        self.bytes = 0
+        self.errors = []
+        self.elapsed = 0.0
+
+    @property
+    def mb_per_second(self):
+        return self.bytes / (1024 * 1024) / self.elapsed if self.elapsed else 0.0
+
+
+def export_tree(root, dst_dir, fmt='tar', level='patient', workers=2, progress=None):
+    """Export each patient (or series) folder of a sorted tree into its own archive.
+
+    Archives are written in parallel by `workers` threads (the copies run
+    in the kernel or in C and release the GIL). Member names start with the
+    patient folder, e.g. CL0042/3_T2map/<SOPInstanceUID>.dcm.
+    """
+    start = time()
+    root = Path(root)
+    dst_dir = Path(dst_dir)
+    dst_dir.mkdir(parents=True, exist_ok=True)
+    report = ExportReport()
+    units = export_units(root, level)
+
+    def export(unit):
+        src_dir, stem = unit
+        return export_directory(src_dir, dst_dir / f"{stem}.{fmt}", fmt, arc_root=root)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(unit, executor.submit(export, unit)) for unit in units]
+        for (src_dir, stem), future in futures:
+            try:
+                files, size = future.result()
+                report.archives += 1
+                report.files += files
+                report.bytes += size
+            except Exception as e:
+                report.errors.append((str(src_dir), f"{type(e).__name__}: {e}"))
+            if progress:
+                progress(1)
+
+    report.elapsed = time() - start
+    return report
+
+
+class _Archive:
+    def __init__(self, writer):
+        self.writer = writer
+        self.lock = threading.Lock()
+        self.users = 0
+
+
+class ArchiveSink:
+    """Appends sorted series to one archive per patient while the pipeline runs.
+
+    Used as the SeriesPipeline `on_sorted` hook: the files of a series go
+    into <dst_dir>/<PatientID>.<fmt> right after they have been sorted. At
+    most max_open archives keep their file open; the least recently used
+    idle one is suspended first and reopened in append mode when its
+    patient has another series. close() finishes every archive.
+    """
+
+    def __init__(self, root, dst_dir, fmt='tar', max_open=MAX_OPEN_ARCHIVES):
+        self.root = Path(root)
+        self.dst_dir = Path(dst_dir)
+        self.dst_dir.mkdir(parents=True, exist_ok=True)
+        self.fmt = fmt
+        self.max_open = max_open
+        self._lock = threading.Lock()
+        self._archives = {}
+        # Archives with an open file, least recently used first
+        self._open = OrderedDict()
+
+    def _acquire(self, patient):
+        """Archive of a patient, created on first use, marked in use and most recently used"""
+        with self._lock:
+            archive = self._archives.get(patient)
+            if archive is None:
+                archive = self._archives[patient] = _Archive(
+                    open_archive(self.dst_dir / f"{patient}.{self.fmt}", self.fmt))
+            self._open.pop(patient, None)
+            self._open[patient] = archive
+            archive.users += 1
+            self._evict()
+        return archive
+
+    def _release(self, archive):
+        with self._lock:
+            archive.users -= 1
+
+    def _evict(self):
+        """Suspend idle archives beyond max_open (caller holds the lock)"""
+        for patient in list(self._open):
+            if len(self._open) <= self.max_open:
+                return
+            archive = self._open[patient]
+            if archive.users == 0:
+                del self._open[patient]
+                archive.writer.suspend()
+
+    def add_series(self, files):
+        """Append the sorted files of one series to their patient archive"""
+        for path in files:
+            relative = Path(path).relative_to(self.root)
+            archive = self._acquire(relative.parts[0])
+            try:
+                with archive.lock:
+                    archive.writer.add(path, relative.as_posix())
+            finally:
+                self._release(archive)
+
+    def close(self):
+        """Finish every archive, returns (archives, files, bytes)"""
+        with self._lock:
+            archives, self._archives = list(self._archives.values()), {}
+            self._open.clear()
+        for archive in archives:
+            with archive.lock:
+                archive.writer.close()
+        return (len(archives), sum(archive.writer.files for archive in archives),
+                sum(archive.writer.bytes for archive in archives))
@@ -0,0 +1,233 @@
+"""
+Fat Fraction
+
+Fat-fraction maps FF = F / (W + F) of the VIBE Dixon acquisitions (the
+"VIBE*CUISSES" and "VIBE*JAMBES" series), computed over whole volumes with
+NumPy operations instead of per-slice loops.
+
+The water and fat images of an acquisition are paired by ImageType (Siemens
+...\\DIXON\\WATER and ...\\DIXON\\FAT, or W / F), falling back to the
+SeriesDescription suffix (_W / _F): they may be two series or one series
+holding both. In-phase and opposed-phase images are ignored. Both stacks are
+ordered along the slice normal and must cover the same slice positions.
+
+Voxels whose signal W + F is below mask_fraction times its 99th percentile
+(background, air) get FF = 0 and are left out of the mask.
+
+The map is written next to the water series, in a sibling folder
+<series folder>_FFmap (a trailing _W removed), as NumPy arrays (FFmap.npy,
+FFmask.npy, FFmap.json) or as a derived DICOM series (FF in %, RescaleSlope
+0.1). Patients are processed in parallel over a process pool.
+"""
+
+import json
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+import pydicom
+from pydicom.errors import InvalidDicomError
+from pydicom.uid import generate_uid
+
+from dicom.services.sorter import process_pool, scan_files
+from dicom.services.volume import _slice_geometry, find_series_dirs
+
+FF_SUFFIX = '_FFmap'
+FF_PATTERNS = ('*VIBE*CUISSES*', '*VIBE*JAMBES*')
+MASK_FRACTION = 0.05
+DICOM_FF_SCALE = 10.0
+HEADER_TAGS = ['StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID', 'SeriesDescription', 'ImageType',
+               'ImagePositionPatient', 'ImageOrientationPatient', 'PixelSpacing', 'RescaleSlope', 'RescaleIntercept']
+
+IMAGE_TYPE_COMPONENTS = {'WATER': 'W', 'W': 'W', 'FAT': 'F', 'F': 'F',
+                         'IN_PHASE': 'IN', 'IN': 'IN', 'OPP_PHASE': 'OPP', 'OUT_PHASE': 'OPP', 'OPP': 'OPP'}
+DESCRIPTION_SUFFIX = re.compile(r'[_ ](W|F|IN|OPP|WATER|FAT)$', re.IGNORECASE)
+DESCRIPTION_COMPONENTS = {'W': 'W', 'WATER': 'W', 'F': 'F', 'FAT': 'F', 'IN': 'IN', 'OPP': 'OPP'}
+
+
+def component(ds):
+    """'W', 'F', 'IN', 'OPP' or None for a Dixon image, from its ImageType then its SeriesDescription"""
+    image_type = getattr(ds, 'ImageType', None) or []
+    if isinstance(image_type, str):
+        image_type = image_type.split('\\')
+    for value in reversed(list(image_type)):
+        found = IMAGE_TYPE_COMPONENTS.get(str(value).upper())
+        if found:
+            return found
+    match = DESCRIPTION_SUFFIX.search(str(getattr(ds, 'SeriesDescription', '')).strip())
+    return DESCRIPTION_COMPONENTS[match.group(1).upper()] if match else None
+
+
+def acquisition_key(ds):
+    """Images of one Dixon acquisition share their study and their description without the component suffix"""
+    description = DESCRIPTION_SUFFIX.sub('', str(getattr(ds, 'SeriesDescription', '')).strip())
+    return str(getattr(ds, 'StudyInstanceUID', '')), description
+
+
+def fat_fraction(water, fat, mask_fraction=MASK_FRACTION):
+    """FF = F / (W + F) of two stacks of the same shape, returns (FF float32 in [0, 1], mask)"""
+    water = np.asarray(water, dtype=np.float32)
+    fat = np.asarray(fat, dtype=np.float32)
+    total = water + fat
+    threshold = mask_fraction * float(np.percentile(total, 99)) if total.size else 0.0
+    mask = total > max(threshold, 0.0)
+    ff = np.zeros(total.shape, dtype=np.float32)
+    np.divide(fat, total, out=ff, where=mask)
+    np.clip(ff, 0.0, 1.0, out=ff)
+    return ff, mask
+
+
+def _read_pixels(item):
+    path, ds = item
+    pixels = pydicom.dcmread(path).pixel_array.astype(np.float32)
+    slope = float(getattr(ds, 'RescaleSlope', 1) or 1)
+    intercept = float(getattr(ds, 'RescaleIntercept', 0) or 0)
+    if slope != 1 or intercept != 0:
+        pixels = pixels * slope + intercept
+    return pixels
+
+
+def _stack(items, positions, workers):
+    """(slices, rows, columns) float32 stack of (path, header) items ordered along the slice normal"""
+    order = sorted(range(len(items)), key=lambda i: positions[i])
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        slices = list(executor.map(_read_pixels, [items[i] for i in order]))
+    return np.stack(slices), [items[i] for i in order], [positions[i] for i in order]
+
+
+def find_acquisitions(patient_dir, patterns=FF_PATTERNS):
+    """{acquisition key: {'W': [(path, header)], 'F': [...]}} of the Dixon series folders of a patient"""
+    patient_dir = Path(patient_dir)
+    folders = sorted({folder for pattern in patterns for folder in patient_dir.glob(pattern)
+                      if folder.is_dir() and not folder.name.endswith(FF_SUFFIX)})
+    acquisitions = {}
+    for folder in folders:
+        for path in sorted(scan_files(str(folder))):
+            try:
+                ds = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+            except InvalidDicomError:
+                continue
+            kind = component(ds)
+            if kind in ('W', 'F'):
+                acquisitions.setdefault(acquisition_key(ds), {}).setdefault(kind, []).append((path, ds))
+    return acquisitions
+
+
+def output_dir_for(water_dir):
+    water_dir = Path(water_dir)
+    name = DESCRIPTION_SUFFIX.sub('', water_dir.name)
+    return water_dir.with_name(name + FF_SUFFIX)
+
+
+def _write_numpy(out_dir, ff, mask, sidecar):
+    np.save(out_dir / 'FFmap.npy', ff)
+    np.save(out_dir / 'FFmask.npy', mask)
+    with open(out_dir / 'FFmap.json', 'w', encoding='utf-8') as f:
+        json.dump(sidecar, f, indent=1)
+
+
+def _write_dicom(out_dir, ff, water_items):
+    """One derived MR image per slice, header copied from the water source slice"""
+    series_uid = generate_uid()
+    pixels = np.clip(np.rint(ff * 100.0 * DICOM_FF_SCALE), 0, 65535).astype(np.uint16)
+    for index, (path, _) in enumerate(water_items):
+        ds = pydicom.dcmread(path, stop_before_pixels=True)
+        ds.SeriesInstanceUID = series_uid
+        ds.SOPInstanceUID = generate_uid()
+        ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+        ds.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+        ds.SeriesNumber = int(getattr(ds, 'SeriesNumber', 0) or 0) + 2000
+        description = DESCRIPTION_SUFFIX.sub('', str(getattr(ds, 'SeriesDescription', '')).strip())
+        ds.SeriesDescription = f"{description} FF".strip()
+        ds.ImageType = ['DERIVED', 'SECONDARY', 'DIXON', 'FAT_FRACTION']
+        ds.InstanceNumber = index + 1
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 16, 15, 0
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.RescaleSlope = 1.0 / DICOM_FF_SCALE
+        ds.RescaleIntercept = 0
+        ds.RescaleType = '%'
+        ds.WindowCenter = 50
+        ds.WindowWidth = 100
+        ds.add_new('PixelData', 'OW', pixels[index].tobytes())
+        ds.save_as(out_dir / f"{ds.SOPInstanceUID}.dcm", enforce_file_format=True)
+
+
+def fat_fraction_acquisition(water_items, fat_items, fmt='npy', mask_fraction=MASK_FRACTION, workers=4):
+    """FF map of one acquisition from its (path, header) water and fat images, returns (output folder, voxels)"""
+    headers = [ds for _, ds in water_items + fat_items]
+    _, _, _, positions = _slice_geometry(headers)
+    water, water_items, water_positions = _stack(water_items, positions[:len(water_items)], workers)
+    fat, fat_items, fat_positions = _stack(fat_items, positions[len(water_items):], workers)
+    water_dir = Path(water_items[0][0]).parent
+    if water.shape != fat.shape or not np.allclose(water_positions, fat_positions, atol=1e-3):
+        raise ValueError(f"{water_dir}: water {water.shape} and fat {fat.shape} images do not cover the same slices")
+
+    ff, mask = fat_fraction(water, fat, mask_fraction)
+
+    out_dir = output_dir_for(water_dir)
+    out_dir.mkdir(exist_ok=True)
+    if fmt == 'dicom':
+        _write_dicom(out_dir, ff, water_items)
+    else:
+        first = water_items[0][1]
+        _write_numpy(out_dir, ff, mask, {
+            'series_description': DESCRIPTION_SUFFIX.sub('', str(getattr(first, 'SeriesDescription', '')).strip()),
+            'water_series_instance_uid': str(first.SeriesInstanceUID),
+            'fat_series_instance_uid': str(fat_items[0][1].SeriesInstanceUID),
+            'water_sop_instance_uids': [str(ds.SOPInstanceUID) for _, ds in water_items],
+            'slice_positions': water_positions,
+            'pixel_spacing': [float(value) for value in getattr(first, 'PixelSpacing', [1.0, 1.0])],
+            'image_orientation': [float(value) for value in first.ImageOrientationPatient],
+            'shape': list(ff.shape),
+            'model': 'F / (W + F)',
+            'mask_fraction': mask_fraction,
+            'unit': 'fraction',
+        })
+    return str(out_dir), int(np.count_nonzero(mask))
+
+
+def fat_fraction_patient(patient_dir, patterns=FF_PATTERNS, fmt='npy', mask_fraction=MASK_FRACTION, workers=4):
+    """FF maps of every Dixon acquisition of a patient folder, returns ([(output, voxels)], [(acquisition, error)])"""
+    done, errors = [], []
+    for key, images in sorted(find_acquisitions(patient_dir, patterns).items()):
+        if 'W' not in images or 'F' not in images:
+            errors.append((f"{patient_dir}: {key[1]}", f"missing {'water' if 'W' not in images else 'fat'} images"))
+            continue
+        try:
+            done.append(fat_fraction_acquisition(images['W'], images['F'], fmt, mask_fraction, workers))
+        except Exception as e:
+            errors.append((f"{patient_dir}: {key[1]}", f"{type(e).__name__}: {e}"))
+    return done, errors
+
+
+def dixon_patient_dirs(root, patterns=FF_PATTERNS, patients=None):
+    """Patient folders of a sorted tree holding at least one Dixon series folder"""
+    dirs = sorted({path.parent for pattern in patterns for path in find_series_dirs(root, pattern)
+                   if not path.name.endswith(FF_SUFFIX)})
+    if patients is not None:
+        patients = set(patients)
+        dirs = [path for path in dirs if path.name in patients]
+    return dirs
+
+
+def fat_fraction_tree(patient_folders, workers=None, progress=None, **kwargs):
+    """FF maps of several patients over a process pool, returns ([(output, voxels)], [(acquisition, error)])"""
+    done, errors = [], []
+    with process_pool(workers) as executor:
+        futures = {executor.submit(fat_fraction_patient, str(folder), **kwargs): folder for folder in patient_folders}
+        for future in as_completed(futures):
+            folder = futures[future]
+            try:
+                patient_done, patient_errors = future.result()
+            except Exception as e:
+                patient_done, patient_errors = [], [(str(folder), f"{type(e).__name__}: {e}")]
+            for acquisition, error in patient_errors:
+                logging.error(f"Fat fraction failed for {acquisition}: {error}")
+            done.extend(patient_done)
+            errors.extend(patient_errors)
+            if progress:
+                progress(1)
+    return done, errors
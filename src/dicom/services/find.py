@@ -1,36 +1,93 @@
+import copy
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta
+from functools import partial
+from time import monotonic
 from pynetdicom import AE, evt
 from pydicom.dataset import Dataset
 from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelFind
 from dicom.config.server_config import TelemisConfig
+from dicom.services.dicomweb import DicomWebClient
 from dicom.services.search_criteria import SearchCriteria
+from dicom.services.network import NetworkProfile
+from dicom.services.records import InstanceRecord, record_class
+from dicom.services.tracing import span, traced
+
+class FindError(RuntimeError):
+    """C-FIND ended with a failure status (or without a final status)"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
 
 class Find:
-    PENDING_STATUS = 0xFF00
+    PENDING_STATUSES = (0xFF00, 0xFF01)
     SUCCESS_STATUS = 0x0000
+    DATE_FORMAT = "%Y%m%d"
+    EARLIEST_DATE = "19000101"
+    PATIENT_ID_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    MAX_SPLIT_ROUNDS = 12
+    MAX_SUB_QUERIES = 256
+    FIND_MSG_ID = 1
+    # Pending responses accepted after a C-CANCEL (already in flight) before the association is aborted
+    CANCEL_GRACE_RESPONSES = 100
 
     def __init__(self, config):
         self.config = config
         self.ae_factory = self.config.CALLING_AET
+        self.sop_class = StudyRootQueryRetrieveInformationModelFind
+        # A response count reaching MAX_FIND_RESULTS means the PACS truncated the answer
+        self.max_results = getattr(self.config, 'MAX_FIND_RESULTS', None)
+        self.max_associations = getattr(self.config, 'MAX_FIND_ASSOCIATIONS', 4)
+        # Final statuses the PACS uses when it stops at its own match limit (split like a capped answer)
+        self.truncated_statuses = tuple(getattr(self.config, 'FIND_TRUNCATED_STATUSES', ()))
+        # Sub-queries of one split search, at most
+        self.max_sub_queries = getattr(self.config, 'MAX_FIND_SUB_QUERIES', self.MAX_SUB_QUERIES)
+        self.patient_id_alphabet = getattr(self.config, 'PATIENT_ID_ALPHABET', self.PATIENT_ID_ALPHABET)
+        self._local = threading.local()
+        self._pool_lock = threading.Lock()
+        self._pooled = []
+        # With keep_alive > 0 (serve daemon), the associations of _query are kept idle and reused
+        self.keep_alive = getattr(self.config, 'ASSOCIATION_KEEP_ALIVE', 0)
+        self._idle = []
+        # Error of the last search_data call (which returns the records received before it), None if it succeeded
+        self.last_error = None
+        self.profile = NetworkProfile.for_config(config)
+        # QIDO-RS instead of C-FIND when the source node is a "dicomweb" node (paged, no splitting needed)
+        self.web = DicomWebClient.from_config(config)
         self.setup_ae()
 
     def setup_ae(self):
         """Configure Application Entity (AE)"""
         self.ae = AE(ae_title=self.config.CALLING_AET)
         self.ae.add_requested_context(StudyRootQueryRetrieveInformationModelFind)
+        self.profile.apply(self.ae)
+
+    def _associate(self):
+        return self.ae.associate(self.config.HOST, self.config.PORT, ae_title=self.config.CALLED_AET,
+                                 **self.profile.associate_kwargs())
 
     def _establish_connection(self):
         """Establish association with the DICOM server"""
-        self.assoc = self.ae.associate(
-            self.config.HOST, 
-            self.config.PORT,
-            ae_title=self.config.CALLED_AET
-        )
+        self.assoc = self._associate()
         return self.assoc.is_established
 
     def _build_query_dataset(self, search_criteria, query_level):
         """Build the DICOM query dataset based on search criteria"""
         ds = Dataset()
         ds.QueryRetrieveLevel = query_level
+        if query_level == "IMAGE":
+            # Hierarchical query below a single series: unique keys plus the instance return keys
+            ds.StudyInstanceUID = search_criteria.study_instance_uid or ''
+            ds.SeriesInstanceUID = search_criteria.series_instance_uid or ''
+            ds.SOPInstanceUID = search_criteria.sop_instance_uid or ''
+            ds.SOPClassUID = ''
+            ds.InstanceNumber = ''
+            ds.EchoTime = ''
+            return ds
         ds.PatientID = search_criteria.patient_id or ''
         ds.PatientName = search_criteria.patient_name or ''
         ds.StudyDate = search_criteria.study_date or ''
@@ -44,31 +101,336 @@ class Find:
             ds.Modality = search_criteria.modality or ''
             ds.SeriesDescription = search_criteria.series_description or ''
             ds.SeriesNumber = ''
+            ds.NumberOfSeriesRelatedInstances = ''
 
         return ds
 
-    def _perform_find(self, query_dataset):
-        """Perform the C-FIND operation"""
-        responses = self.assoc.send_c_find(query_dataset, self.sop_class)
+    def _perform_find(self, query_dataset, assoc=None, release=True, convert=None, limit=None):
+        """Perform the C-FIND operation, returns (identifiers, truncated)
+
+        convert, if given, turns each identifier into a compact record as
+        soon as it arrives, so the Datasets are never all held in memory.
+        With limit, a C-CANCEL is sent once limit identifiers have arrived;
+        the responses still in flight are dropped until the final status, so
+        the association stays usable (it is aborted if the PACS ignores the
+        cancel). A cancelled query is not reported as truncated.
+
+        The answer is truncated when it reaches MAX_FIND_RESULTS or ends with
+        one of FIND_TRUNCATED_STATUSES; any other failure raises FindError.
+        """
+        assoc = assoc or self.assoc
+        responses = assoc.send_c_find(query_dataset, self.sop_class, msg_id=self.FIND_MSG_ID)
         results = []
+        final_status = None
+        cancelled = False
+        late = 0
         for status, identifier in responses:
-            if status and status.Status == self.PENDING_STATUS:
-                results.append(identifier)
-            elif status and status.Status == self.SUCCESS_STATUS:
+            if not status:
+                continue
+            if status.Status in self.PENDING_STATUSES:
+                if cancelled:
+                    late += 1
+                    if late > self.CANCEL_GRACE_RESPONSES:
+                        logging.warning("C-CANCEL ignored by the PACS, aborting the association")
+                        assoc.abort()
+                        return results, False
+                    continue
+                results.append(convert(identifier) if convert else identifier)
+                if limit and len(results) >= limit:
+                    assoc.send_c_cancel(self.FIND_MSG_ID, query_model=self.sop_class)
+                    cancelled = True
+            else:
+                final_status = status.Status
                 break
-        self.assoc.release()
-        return results
+        if release:
+            assoc.release()
 
-    def search_data(self, criteria: SearchCriteria):
-        """Main entry point"""
-        query_level = criteria.level
-        info_model = "STUDY_ROOT"
-        self.sop_class = StudyRootQueryRetrieveInformationModelFind
+        if cancelled:
+            return results, False
+        if self.max_results and len(results) >= self.max_results:
+            return results, True
+        if final_status in self.truncated_statuses:
+            return results, True
+        if final_status is None:
+            raise FindError(None, "C-FIND interrupted before its final status")
+        if final_status != self.SUCCESS_STATUS:
+            raise FindError(final_status, f"C-FIND failed with status {hex(final_status)}")
+        return results, False
+
+    def _take_idle(self):
+        """An idle association still established and not expired, or None"""
+        with self._pool_lock:
+            while self._idle:
+                assoc, since = self._idle.pop()
+                if assoc.is_established and monotonic() - since <= self.keep_alive:
+                    return assoc
+                if assoc.is_established:
+                    assoc.release()
+        return None
+
+    def _keep_idle(self, assoc):
+        with self._pool_lock:
+            if assoc.is_established and len(self._idle) < self.max_associations:
+                self._idle.append((assoc, monotonic()))
+                return
+        if assoc.is_established:
+            assoc.release()
+
+    def close_idle(self):
+        """Release the idle associations"""
+        with self._pool_lock:
+            idle, self._idle = self._idle, []
+        for assoc, _ in idle:
+            if assoc.is_established:
+                assoc.release()
+        if self.web is not None:
+            self.web.close()
+
+    @traced('find.query')
+    def _query(self, criteria, limit=None):
+        """Run one C-FIND on its own association (an idle one with keep_alive)"""
+        assoc = self._take_idle() if self.keep_alive else None
+        if assoc is None:
+            with span('association', node=self.config.CALLED_AET):
+                assoc = self._associate()
+            if not assoc.is_established:
+                raise ConnectionError(f"Association with {self.config.CALLED_AET} rejected or aborted")
+        query_dataset = self._build_query_dataset(criteria, criteria.level)
+        try:
+            result = self._perform_find(query_dataset, assoc, release=not self.keep_alive,
+                                        convert=record_class(criteria.level).from_identifier, limit=limit)
+        except FindError:
+            if assoc.is_established:
+                assoc.release()
+            raise
+        if self.keep_alive:
+            self._keep_idle(assoc)
+        return result
+
+    def _split_by_date(self, criteria, parts):
+        """Split a StudyDate range into consecutive sub-ranges, None for a single day"""
+        study_date = criteria.study_date or '-'
+        if '-' not in study_date:
+            return None
+        start, end = study_date.split('-', 1)
+        start = datetime.strptime(start or self.EARLIEST_DATE, self.DATE_FORMAT).date()
+        end = datetime.strptime(end, self.DATE_FORMAT).date() if end else date.today()
+        days = (end - start).days + 1
+        if days <= 1:
+            return None
+        parts = min(parts, days)
+        subs = []
+        low = start
+        for index in range(1, parts + 1):
+            high = start + timedelta(days=days * index // parts - 1)
+            sub = copy.copy(criteria)
+            sub.study_date = f"{low.strftime(self.DATE_FORMAT)}-{high.strftime(self.DATE_FORMAT)}"
+            subs.append(sub)
+            low = high + timedelta(days=1)
+        return subs
+
+    def _split_by_patient_prefix(self, criteria, results=()):
+        """Split a 'prefix*' PatientID query into one query per next character of PATIENT_ID_ALPHABET.
+
+        None if the PatientIDs of the truncated answer use a character out of
+        the alphabet at that position: the split would miss such IDs.
+        """
+        patient_id = criteria.patient_id or '*'
+        if not patient_id.endswith('*'):
+            return None
+        prefix = patient_id[:-1]
+        if '*' in prefix or '?' in prefix:
+            return None
+        seen = {str(getattr(record, 'PatientID', None) or '')[len(prefix):][:1] for record in results}
+        foreign = seen - set(self.patient_id_alphabet) - {''}
+        if foreign:
+            logging.info(f"PatientIDs with {''.join(sorted(foreign))!r} after {prefix!r}: not split by PatientID")
+            return None
+        subs = []
+        for char in self.patient_id_alphabet:
+            sub = copy.copy(criteria)
+            sub.patient_id = f"{prefix}{char}*"
+            subs.append(sub)
+        if prefix:
+            # The prefix itself is a valid PatientID, not covered by 'prefix?*'
+            exact = copy.copy(criteria)
+            exact.patient_id = prefix
+            subs.append(exact)
+        return subs
+
+    def _split(self, criteria, results=()):
+        """Narrower queries covering the same matches, or None if it cannot be split.
+
+        An explicit StudyDate range is cut into sub-ranges first, then a
+        'prefix*' PatientID is extended by one character (when the IDs of the
+        truncated results fit the alphabet). Otherwise the whole date range is
+        split (studies without a StudyDate are then lost).
+        """
+        parts = max(2, self.max_associations)
+        if criteria.study_date and '-' in criteria.study_date:
+            subs = self._split_by_date(criteria, parts)
+            if subs:
+                return subs
+        subs = self._split_by_patient_prefix(criteria, results)
+        if subs:
+            return subs
+        if not criteria.study_date:
+            return self._split_by_date(criteria, parts)
+        return None
+
+    @staticmethod
+    def _result_key(identifier):
+        return (
+            getattr(identifier, 'StudyInstanceUID', None),
+            getattr(identifier, 'SeriesInstanceUID', None),
+            getattr(identifier, 'SOPInstanceUID', None),
+        )
+
+    def _iter_split(self, criteria, limit=None):
+        """Run the query, splitting it into parallel sub-queries while the PACS truncates the answers.
+
+        Yields the records of each sub-query as soon as it completes, without
+        duplicates (only the keys of the records already yielded are kept).
+        With limit, each (sub-)query is cancelled after limit records and the
+        search stops once limit records have been yielded. At most
+        MAX_FIND_SUB_QUERIES queries are sent. A failed sub-query does not
+        stop the others: the first error is raised once the records of the
+        others have been yielded.
+        """
+        seen = set()
+        pending = [criteria]
+        rounds = 0
+        queries = 1
+        errors = []
+        with ThreadPoolExecutor(max_workers=self.max_associations) as executor:
+            while pending:
+                rounds += 1
+                next_round = []
+                futures = {executor.submit(self._query, sub, limit): sub for sub in pending}
+                for future in as_completed(futures):
+                    sub = futures[future]
+                    try:
+                        results, truncated = future.result()
+                    except Exception as e:
+                        logging.error(f"C-FIND failed: PatientID={sub.patient_id!r}, "
+                                      f"StudyDate={sub.study_date!r}: {e}")
+                        errors.append(e)
+                        continue
+                    for record in results:
+                        key = self._result_key(record)
+                        if key not in seen:
+                            seen.add(key)
+                            yield record
+                            if limit and len(seen) >= limit:
+                                # The sub-queries not started yet are dropped
+                                executor.shutdown(wait=False, cancel_futures=True)
+                                return
+                    if not truncated:
+                        continue
+                    subs = self._split(sub, results) if rounds < self.MAX_SPLIT_ROUNDS else None
+                    if subs and queries + len(subs) > self.max_sub_queries:
+                        logging.warning(f"C-FIND sub-query cap ({self.max_sub_queries}) reached")
+                        subs = None
+                    if subs:
+                        queries += len(subs)
+                        next_round.extend(subs)
+                    else:
+                        logging.warning(f"C-FIND results may be incomplete, cannot split further: "
+                                        f"PatientID={sub.patient_id!r}, StudyDate={sub.study_date!r}")
+                if next_round:
+                    logging.info(f"C-FIND truncated, splitting into {len(next_round)} sub-queries")
+                pending = next_round
+        if errors:
+            raise errors[0]
+
+    def _search_split(self, criteria, limit=None):
+        return list(self._iter_split(criteria, limit))
+
+    def _pooled_association(self):
+        """Association kept open by the current worker thread and reused between queries"""
+        assoc = getattr(self._local, 'assoc', None)
+        if assoc is None or not assoc.is_established:
+            assoc = self._associate()
+            if not assoc.is_established:
+                raise ConnectionError(f"Association with {self.config.CALLED_AET} rejected or aborted")
+            self._local.assoc = assoc
+            with self._pool_lock:
+                self._pooled.append(assoc)
+        return assoc
+
+    def _release_pooled(self):
+        with self._pool_lock:
+            pooled, self._pooled = self._pooled, []
+        for assoc in pooled:
+            if assoc.is_established:
+                assoc.release()
+        self._local = threading.local()
+
+    def _list_series_instances(self, series, limit=None):
+        """IMAGE-level C-FIND for one (criteria, StudyInstanceUID, SeriesInstanceUID)"""
+        criteria, study_uid, series_uid = series
+        sub = copy.copy(criteria)
+        sub.level = 'IMAGE'
+        sub.study_instance_uid = study_uid
+        sub.series_instance_uid = series_uid
+        query_dataset = self._build_query_dataset(sub, 'IMAGE')
+        identifiers, _ = self._perform_find(query_dataset, self._pooled_association(), release=False, limit=limit)
+        return [InstanceRecord.from_identifier(identifier, study_uid, series_uid) for identifier in identifiers]
+
+    def enumerate_instances(self, criteria: SearchCriteria, limit=None):
+        """List the SOP instances of every series matching the criteria.
+
+        The matching series are found first (at SERIES level), then their
+        instances are queried in parallel over a pool of associations, one
+        per worker thread. Returns compact InstanceRecords, at most limit.
+        """
+        uids = (criteria.study_instance_uid or '', criteria.series_instance_uid or '')
+        if all(uid and '*' not in uid and '?' not in uid for uid in uids):
+            series = [(criteria, *uids)]
+        else:
+            series_criteria = copy.copy(criteria)
+            series_criteria.level = 'SERIES'
+            series = [(criteria, getattr(ds, 'StudyInstanceUID', None), getattr(ds, 'SeriesInstanceUID', None))
+                      for ds in self._search_split(series_criteria, limit)]
+
+        records = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_associations) as executor:
+                for series_records in executor.map(partial(self._list_series_instances, limit=limit), series):
+                    records.extend(series_records)
+                    if limit and len(records) >= limit:
+                        executor.shutdown(wait=True, cancel_futures=True)
+                        break
+        finally:
+            self._release_pooled()
+        return records[:limit] if limit else records
+
+    def iter_search(self, criteria: SearchCriteria, limit=None):
+        """Stream the compact records matching the criteria as the (sub-)queries complete.
+
+        Unlike search_data, errors are raised (after the records already yielded).
+        """
+        if self.web is not None:
+            yield from self.web.iter_search(criteria, limit)
+        elif criteria.level == 'IMAGE':
+            yield from self.enumerate_instances(criteria, limit)
+        else:
+            yield from self._iter_split(criteria, limit)
+
+    @traced('find.search_data')
+    def search_data(self, criteria: SearchCriteria, limit=None):
+        """Main entry point; with limit, at most limit results (the C-FINDs are cancelled early).
+
+        On errors the records already received are returned, and the error is
+        kept in last_error.
+        """
+        self.last_error = None
+        records = []
         try:
-            if self._establish_connection():
-                query_dataset = self._build_query_dataset(criteria, query_level)    
-                return self._perform_find(query_dataset)
-            return []
+            for record in self.iter_search(criteria, limit):
+                records.append(record)
         except Exception as e:
-            logging.error(f"DICOM search error: {e}")
-            return []
\ No newline at end of file
+            # The records of the sub-queries that succeeded are kept
+            logging.error(f"DICOM search error: {e} ({len(records)} result(s) kept)")
+            self.last_error = e
+        return records
@@ -1,8 +1,17 @@
+from io import BytesIO
 from pathlib import Path
+import uuid
 import click
+import pydicom
 from pydicom import Dataset
-from dicom.services.json_file import SeriesMetadataCollector
-from dicom.services.search_criteria import SearchCriteria
+from dicom.services.dicomweb import DicomWebClient
+from dicom.services.durability import temp_path
+from dicom.services.json_file import MetadataRegistry
+from dicom.services.manifest import ManifestStore, hash_buffers, save_dataset, write_chunks
+from dicom.services.network import NetworkProfile
+from dicom.services.pack import PackStore
+from dicom.services.search_criteria import SearchCriteria, list_matching_rejected, retrieve_batches
+from dicom.services.tracing import traced
 # from dicom.services.anonym_service import anonymize_dataset
 from dicom.controllers.anonym_controller import AnonymController
 from dicom.controllers.pseudonym_controller import PseudonymController
@@ -10,6 +19,7 @@ from pynetdicom import AE, evt, StoragePresentationContexts, AllStoragePresentat
 from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelGet, MRImageStorage, MRSpectroscopyStorage
 from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
 import threading
+from functools import partial
 import time
 import logging
 import tqdm
@@ -18,15 +28,36 @@ class Get:
     SUCCESS_STATUS = 0x0000
     MAX_CONTEXTS = 127
 
-    def __init__(self,  config, output_dir="output_dir",ae_factory=None):
+    def __init__(self,  config, output_dir="output_dir",ae_factory=None, catalog=None, throttler=None, profile=None,
+                 pack=False, durable=None):
         self.output_dir = Path(output_dir)
+        self.catalog = catalog
+        self.throttler = throttler
         self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.manifest = ManifestStore(self.output_dir)
+        # Instances are appended to one pack per series instead of one file each
+        self.packs = PackStore() if pack else None
+        # DurableWriter: files are fsynced in batches before they are acknowledged or recorded (not packs)
+        self.durable = durable
+        self.manifest.fsync = durable is not None
         self.config = config
         self.ae_factory = self.config.CALLING_AET
         self.files_received = 0
+        self.duplicates = 0
+        self._count_lock = threading.Lock()
+        # UIDs packed per C-GET, falls back to 1 if the PACS rejects list matching
+        self.batch_size = getattr(self.config, 'RETRIEVE_BATCH_SIZE', 1)
+        self.last_status = None
+        self.profile = profile or NetworkProfile.for_config(config)
+        # With keep_alive > 0 (serve daemon), the association is kept idle after a C-GET and reused
+        self.keep_alive = getattr(self.config, 'ASSOCIATION_KEEP_ALIVE', 0)
+        self.assoc = None
+        self.scp = None
+        self._idle_since = 0.0
+        # WADO-RS instead of C-GET when the source node is a "dicomweb" node
+        self.web = DicomWebClient.from_config(config)
         self._setup_ae()
-        self.metadata_collector = None
-        self.current_patient_dir = None
+        self.metadata_registry = MetadataRegistry()
         self.current_criteria = None
         self.pseudo_controller = PseudonymController()
         self.ano_controller = AnonymController()
@@ -39,20 +70,27 @@ class Get:
         self.ae.add_requested_context(StudyRootQueryRetrieveInformationModelGet)
         self.ae.add_supported_context(MRImageStorage)
         self.ae.add_supported_context(MRSpectroscopyStorage)
+        self.profile.apply(self.ae)
         self.role_mr_image = build_role(MRImageStorage, scp_role=True)
         self.role_mr_spectro = build_role(MRSpectroscopyStorage, scp_role=True)
 
     def _establish_connection(self):
         """DICOM Connection"""
+        if self.assoc is not None and self.assoc.is_established:
+            if self.keep_alive and time.time() - self._idle_since <= self.keep_alive:
+                return True
+            self.assoc.release()
         handlers = [(evt.EVT_C_STORE, self._handle_store)]
-        self.scp = self.ae.start_server(("", 0), block=False, evt_handlers=handlers)
+        if self.scp is None:
+            self.scp = self.ae.start_server(("", 0), block=False, evt_handlers=handlers)
+            self.profile.tune_server(self.scp)
         
         ext_neg = [self.role_mr_image, self.role_mr_spectro]
         # Build optional association kwargs from config (do not break if absent)
         assoc_kwargs = dict(
             ae_title=self.config.CALLED_AET,
             ext_neg=ext_neg,
-            evt_handlers=handlers,
+            **self.profile.associate_kwargs(handlers),
         )
 
         try:
@@ -70,28 +108,76 @@ class Get:
 
         return self.assoc.is_established
 
-    def _save_dicom_file(self, dataset, filename, target_dir=None):
-        """Centralise and save"""
+    def _save_dicom_file(self, dataset, filename, target_dir=None, received=None):
+        """Centralise and save, hashing the file while it is written. Returns (path, size)."""
         if target_dir is None:
             target_dir = self.output_dir
-        filepath = target_dir / filename
-        dataset.save_as(filepath, write_like_original=True)
+        record = partial(self.manifest.record, getattr(dataset, 'SeriesInstanceUID', None), dataset.SOPInstanceUID)
+        if self.packs is not None:
+            buffer = BytesIO()
+            dataset.save_as(buffer, write_like_original=True)
+            data = buffer.getbuffer()
+            size, digest = data.nbytes, hash_buffers(data)
+            filepath = self.packs.add_bytes(target_dir, dataset.SOPInstanceUID, data,
+                                            getattr(dataset, 'SeriesInstanceUID', None))
+            record(filepath, size, digest, received)
+        elif self.durable is not None:
+            filepath = target_dir / filename
+            write_path = self.durable.temp_path(filepath)
+            size, digest = save_dataset(dataset, write_path, write_like_original=True)
+            # Recorded in the manifest once on disk; in response mode the PACS waits for the flush too
+            self.durable.commit(write_path, filepath, partial(record, filepath, size, digest, received))
+        else:
+            filepath = target_dir / filename
+            size, digest = save_dataset(dataset, filepath, write_like_original=True)
+            record(filepath, size, digest, received)
+        if self.catalog is not None:
+            self.catalog.add_dataset(dataset, filepath)
+        return filepath, size
 
 
+    @traced('get.store')
     def _handle_store(self, event):
         """Handle incoming DICOM store request"""
+        with event.request.DataSet.getbuffer() as raw:
+            size = raw.nbytes
+            received = hash_buffers(raw)
+        return self._store(event.dataset, event.file_meta, size, received)
+
+    @traced('get.store')
+    def _store_part(self, part):
+        """Store one Part 10 file of a WADO-RS response: streamed to a temporary file, then stored as a C-STORE"""
+        tmp_path = temp_path(self.output_dir / f"{uuid.uuid4().hex}.dcm")
+        try:
+            size, received = write_chunks(tmp_path, part.chunks())
+            dataset = pydicom.dcmread(tmp_path)
+            self._store(dataset, dataset.file_meta, size, received)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    def _store(self, dataset, file_meta, size, received):
+        """Write one received instance under its patient and series folders, returns the C-STORE status"""
+        if self.manifest.is_duplicate(getattr(dataset, 'SeriesInstanceUID', None),
+                                      file_meta.MediaStorageSOPInstanceUID, received):
+            # Sent again unchanged: nothing to write
+            with self._count_lock:
+                self.files_received += 1
+                self.duplicates += 1
+            if self.throttler is not None:
+                self.throttler.throttle(size)
+            return 0x0000
  
         # Anonymize dataset if requested
-        if self.current_criteria and getattr(self.current_criteria, 'anonymize', True):
-            ds = self.ano_controller.anonymize_file(event.dataset)
+        if self.current_criteria and getattr(self.current_criteria, 'anonymize_data', False):
+            ds = self.ano_controller.anonymize_file(dataset)
         # Apply pseudonymization if requested
         elif self.current_criteria and (getattr(self.current_criteria, 'clinical_pseudo', True) or 
                                         getattr(self.current_criteria, 'research_pseudo', True) or 
                                         getattr(self.current_criteria, 'protocol_pseudo', True)):
-            ds = self.pseudo_controller.pseudonymize_file(event.dataset)
+            ds = self.pseudo_controller.pseudonymize_file(dataset)
         else:
-            ds = event.dataset
-        ds.file_meta = event.file_meta
+            ds = dataset
+        ds.file_meta = file_meta
         # Extract Patient ID to organize files
         patient_id = getattr(ds, 'PatientID', 'Unknown_Patient')
         # Sanitize patient ID for folder name
@@ -108,29 +194,29 @@ class Get:
         patient_dir = self.output_dir / patient_id_safe
         patient_dir.mkdir(exist_ok=True)
         
-        # Initialize metadata collector for this patient if not done yet
-        if self.current_patient_dir != patient_dir:
-            if self.metadata_collector is not None:
-                # Save previous patient's metadata
-                self.metadata_collector.save_to_json()
-            self.current_patient_dir = patient_dir
-            self.metadata_collector = SeriesMetadataCollector(patient_dir)
-        
         # Process series information
         series_number = getattr(ds, 'SeriesNumber', None)
         series_desc = getattr(ds, 'SeriesDescription', 'Unknown_Series')
+        filename = f"{ds.SOPInstanceUID}.dcm"
         if series_number is not None:
             series_desc_safe = str(series_desc).replace(' ', '_').replace('/', '_').replace('\\', '_')
             series_dir = patient_dir / f"{series_number}_{series_desc_safe}"
-            series_dir.mkdir(exist_ok=True)
-            filename = f"{ds.SOPInstanceUID}.dcm"
-            self._save_dicom_file(ds, filename, series_dir)
+            if self.packs is None:
+                series_dir.mkdir(exist_ok=True)
         else:
-            filename = f"{ds.SOPInstanceUID}.dcm"
-            self._save_dicom_file(ds, filename, patient_dir)
+            series_dir = patient_dir
+        try:
+            filepath, file_size = self._save_dicom_file(ds, filename, series_dir, received)
+        except OSError as e:
+            print(f"E: {ds.SOPInstanceUID} not written: {e}")
+            return 0xA700
 
+        with self._count_lock:
             self.files_received += 1
-            self.metadata_collector.add_instance(ds)
+        # Metadata is collected per patient and written once when the retrieval ends
+        self.metadata_registry.add_instance(patient_dir, ds, file_size)
+        if self.throttler is not None:
+            self.throttler.throttle(size)
         return 0x0000
 
     def _build_query_dataset(self, search_criteria, query_level):
@@ -143,12 +229,16 @@ class Get:
             ds.SeriesDate = search_criteria.series_date or ''
             ds.SeriesDescription = search_criteria.series_description or ''
             ds.SeriesNumber = ''
+        elif query_level == "IMAGE":
+            ds.SOPInstanceUID = search_criteria.sop_instance_uid or ''
         return ds
         
 
     def _perform_get(self, query_dataset):
-        """Perform the C-GET operation"""
+        """Perform the C-GET operation, returns the number of files received for this request"""
         start_time = time.time()
+        received_before = self.files_received
+        self.last_status = None
 
         responses = self.assoc.send_c_get(query_dataset, StudyRootQueryRetrieveInformationModelGet)
         pbar = tqdm.tqdm(desc="C-GET", unit="resp", dynamic_ncols=True)
@@ -157,38 +247,100 @@ class Get:
                 pbar.update(1)
                 pbar.set_postfix(files_received=self.files_received,
                         status=(hex(status.Status) if status else "None"))
+                if status:
+                    self.last_status = status.Status
                 if status and status.Status == self.SUCCESS_STATUS:
                     break
         finally:
             pbar.close()
 
-        received = self.files_received
+        received = self.files_received - received_before
         elapsed = time.time() - start_time
 
-        print(f"I: C-GET completed in {elapsed:.1f}s — files received for this study: {received}")
+        print(f"I: C-GET completed in {elapsed:.1f}s — files received for this request: {received}")
+        if self.keep_alive:
+            self._idle_since = time.time()
+            return received
         try:
             self.assoc.release()
         except Exception:
             pass
         return received
 
-    def retrieve_data(self, criteria: SearchCriteria):
-        """Main entry point"""
-        query_level = criteria.level
+    def close_idle(self):
+        """Release the association kept idle"""
+        if self.assoc is not None and self.assoc.is_established:
+            self.assoc.release()
+        if self.web is not None:
+            self.web.close()
+
+    @traced('get.request')
+    def _get_request(self, criteria):
+        """Send one C-GET, returns the number of files received or None if the association failed"""
+        if not self._establish_connection():
+            return None
+        query_ds = self._build_query_dataset(criteria, criteria.level)
+        return self._perform_get(query_ds)
+
+    @traced('get.request')
+    def _web_request(self, criteria):
+        """WADO-RS retrieve of the criteria, series in parallel, returns the number of files received"""
+        start_time = time.time()
+        received_before = self.files_received
+        _, errors = self.web.retrieve(criteria, self._store_part)
+        self.last_status = 0xB000 if errors else self.SUCCESS_STATUS
+        received = self.files_received - received_before
+        print(f"I: WADO-RS retrieve completed in {time.time() - start_time:.1f}s — "
+              f"files received for this request: {received}")
+        return received
+
+    @traced('get.retrieve_data')
+    def retrieve_data(self, criteria: SearchCriteria, batch_size=None):
+        """Main entry point.
+
+        Lists of Study/Series Instance UIDs are packed into C-GET requests of
+        batch_size UIDs. If the PACS rejects UID list matching, the UIDs are
+        retrieved again one per request.
+        """
         # info_model = "STUDY_ROOT"
         self.files_received = 0
+        self.duplicates = 0
         # Store criteria for use in handlers
         self.current_criteria = criteria
+        batch_size = batch_size or self.batch_size
 
         try:
-            if self._establish_connection():
-                query_ds = self._build_query_dataset(criteria, query_level)
-                received = self._perform_get(query_ds)
+            connected = False
+            if self.web is not None:
+                # No batching nor list matching fallback: one request per series over the pooled connections
+                self._web_request(criteria)
+                connected = True
+            else:
+                for batch in retrieve_batches(criteria, batch_size):
+                    received = self._get_request(batch)
+                    if received is None:
+                        continue
+                    connected = True
+                    if list_matching_rejected(batch, self.last_status, received):
+                        print("I: List matching rejected by the PACS, retrieving one UID per request")
+                        self.batch_size = 1
+                        for single in retrieve_batches(batch, 1):
+                            self._get_request(single)
+
+            if connected:
+                if self.durable is not None:
+                    self.durable.drain()
+                if self.packs is not None:
+                    self.packs.close()
+                self.manifest.flush()
+                received = self.files_received
                 click.echo(f"I: Total files received: {received}")
-                # Save metadata for the last patient processed
-                if received > 0 and self.metadata_collector is not None:
+                if self.duplicates:
+                    click.echo(f"I: {self.duplicates} already stored unchanged, skipped")
+                # Write the metadata of every patient received, once
+                if received > 0 and len(self.metadata_registry):
                     print("I: Saving series metadata to JSON...")
-                    self.metadata_collector.save_to_json()
+                    self.metadata_registry.save_all()
                 return received
             return False
         except Exception as e:
@@ -1,49 +1,134 @@
 import json
+import os
+import threading
+from datetime import datetime
 from pathlib import Path
-from typing import Dict, Any, List
+from typing import Dict, Any, Set
 
 class SeriesMetadataCollector:
     """Collect and save metadata about DICOM series during C-GET operations"""
-    
+
     def __init__(self, output_dir: Path):
         self.output_dir = output_dir
         self.patient_id = None
-        self.series_numbers: List[int] = []
-    
-    def add_instance(self, dataset):
+        self.series_numbers: Set[int] = set()
+        self.instances = 0
+        self.bytes = 0
+        self.first_arrival = None
+        self.last_arrival = None
+        self._lock = threading.Lock()
+
+    def add_instance(self, dataset, size: int = 0):
         """Add metadata from a DICOM instance to the collection"""
         # Extract required fields with fallbacks
         patient_id = getattr(dataset, 'PatientID', 'Unknown')
         series_number = getattr(dataset, 'SeriesNumber', None)
-        
-        
-        # Set patient ID (should be the same for all instances in this collector)
-        if self.patient_id is None:
-            self.patient_id = patient_id
-        
-        # Add series number if not already in list
-        if series_number is not None and series_number not in self.series_numbers:
-            self.series_numbers.append(series_number)
-    
+        now = datetime.now()
+
+        with self._lock:
+            # Set patient ID (should be the same for all instances in this collector)
+            if self.patient_id is None:
+                self.patient_id = patient_id
+            if series_number is not None:
+                self.series_numbers.add(int(series_number))
+            self.instances += 1
+            self.bytes += size
+            if self.first_arrival is None:
+                self.first_arrival = now
+            self.last_arrival = now
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Collected metadata as written to the JSON file"""
+        with self._lock:
+            return {
+                "PatientID": self.patient_id or "Unknown",
+                "SeriesNumber": sorted(self.series_numbers),
+                "Instances": self.instances,
+                "Bytes": self.bytes,
+                "FirstArrival": self.first_arrival.isoformat() if self.first_arrival else None,
+                "LastArrival": self.last_arrival.isoformat() if self.last_arrival else None,
+            }
+
+    @staticmethod
+    def _load(json_path: Path):
+        """Metadata of a previous JSON file, None if there is none (or it is unreadable)"""
+        try:
+            with open(json_path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return data if isinstance(data, dict) else None
+
+    def merged_with(self, previous: Dict[str, Any]) -> Dict[str, Any]:
+        """Collected metadata added to the one of a previous retrieval of the same patient"""
+        current = self.to_dict()
+        if not previous or previous.get("PatientID") != current["PatientID"]:
+            return current
+        arrivals = [value for value in (previous.get("FirstArrival"), current["FirstArrival"]) if value]
+        lasts = [value for value in (previous.get("LastArrival"), current["LastArrival"]) if value]
+        return dict(current, **{
+            "SeriesNumber": sorted(set(previous.get("SeriesNumber") or []) | set(current["SeriesNumber"])),
+            "Instances": (previous.get("Instances") or 0) + current["Instances"],
+            "Bytes": (previous.get("Bytes") or 0) + current["Bytes"],
+            "FirstArrival": min(arrivals) if arrivals else None,
+            "LastArrival": max(lasts) if lasts else None,
+        })
+
     def save_to_json(self, filename: str = "series_metadata.json"):
-        """Save collected metadata to a JSON file"""
-        # Sort series numbers for cleaner output
-        self.series_numbers.sort()
-        
-        output_data = {
-            "PatientID": self.patient_id or "Unknown",
-            "SeriesNumber": self.series_numbers
-        }
-        
+        """Save collected metadata to a JSON file, merged with the one of earlier retrievals, atomically replaced"""
         json_path = self.output_dir / filename
-        with open(json_path, 'w', encoding='utf-8') as f:
+        output_data = self.merged_with(self._load(json_path))
+
+        tmp_path = json_path.with_name(f".{filename}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
             # Use separators to avoid extra whitespace
             json.dump(output_data, f, indent=2, ensure_ascii=False, separators=(',', ': '))
+        os.replace(tmp_path, json_path)
         print(f"I: Metadata saved to {json_path}")
         return json_path
-    
+
     def reset(self):
         """Clear collected metadata"""
-        self.patient_id = None
-        self.series_numbers.clear()
-        
\ No newline at end of file
+        with self._lock:
+            self.patient_id = None
+            self.series_numbers.clear()
+            self.instances = 0
+            self.bytes = 0
+            self.first_arrival = None
+            self.last_arrival = None
+
+
+class MetadataRegistry:
+    """One SeriesMetadataCollector per patient directory.
+
+    Instances of several patients may arrive interleaved, so collectors are
+    kept for the whole retrieval and each JSON file is written once at the end.
+    A later retrieval of the same patient (e.g. the next study of a CLI get)
+    adds its series to the file instead of replacing them.
+    """
+
+    def __init__(self):
+        self._collectors: Dict[Path, SeriesMetadataCollector] = {}
+        self._lock = threading.Lock()
+
+    def collector_for(self, patient_dir: Path) -> SeriesMetadataCollector:
+        """Return the collector of a patient directory, creating it if needed"""
+        with self._lock:
+            collector = self._collectors.get(patient_dir)
+            if collector is None:
+                collector = SeriesMetadataCollector(patient_dir)
+                self._collectors[patient_dir] = collector
+            return collector
+
+    def add_instance(self, patient_dir: Path, dataset, size: int = 0):
+        self.collector_for(patient_dir).add_instance(dataset, size)
+
+    def save_all(self, filename: str = "series_metadata.json"):
+        """Write every collected patient's JSON file and forget the collectors"""
+        with self._lock:
+            collectors = list(self._collectors.values())
+            self._collectors.clear()
+        return [collector.save_to_json(filename) for collector in collectors]
+
+    def __len__(self):
+        return len(self._collectors)
@@ -0,0 +1,269 @@
+"""
+Series Manifests
+
+Every stored instance is hashed while it is written and recorded in a
+per-series manifest, output_dir/.manifests/<SeriesInstanceUID>.json:
+
+    {"SeriesInstanceUID": ..., "algorithm": "sha256",
+     "instances": {<SOPInstanceUID>: {"path": <relative to output_dir>, "size": ...,
+                                      "hash": <file on disk>, "received": <dataset as received>}}}
+
+"received" is the hash of the dataset bytes sent by the PACS, used to skip
+instances that are sent again unchanged. "hash" is the hash of the file on
+disk (which differs once the file is pseudonymized), used by `verify`
+without decoding any DICOM. The path of an instance stored in a series pack
+(pack.py) is "<pack>::<SOPInstanceUID>.dcm".
+"""
+
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO, UnsupportedOperation
+from pathlib import Path
+
+from pydicom.filewriter import write_file_meta_info
+
+from dicom.services.durability import fsync_directory
+from dicom.services.pack import is_member, member_size, path_exists, read_member
+
+MANIFEST_DIR = '.manifests'
+HASH_ALGORITHM = 'sha256'
+READ_BUFFER_SIZE = 1024 * 1024
+
+
+def new_hash():
+    return hashlib.new(HASH_ALGORITHM)
+
+
+def hash_buffers(*buffers):
+    """Hash of in-memory buffers (bytes or memoryviews), without copying them"""
+    digest = new_hash()
+    for buffer in buffers:
+        digest.update(buffer)
+    return digest.hexdigest()
+
+
+def hash_file(path):
+    """Hash of a file read in large blocks, no DICOM decoding"""
+    digest = new_hash()
+    with open(path, 'rb', buffering=0) as f:
+        buffer = bytearray(READ_BUFFER_SIZE)
+        view = memoryview(buffer)
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            digest.update(view[:n])
+    return digest.hexdigest()
+
+
+class HashingWriter:
+    """File-like wrapper hashing everything written through it"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.digest = new_hash()
+        self.size = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+    def tell(self):
+        return self.fileobj.tell()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Only no-op seeks: going back would make the hash differ from the file"""
+        position = self.fileobj.tell()
+        if (whence == os.SEEK_SET and offset == position) or (whence == os.SEEK_CUR and offset == 0):
+            return position
+        raise UnsupportedOperation("HashingWriter is write-only and sequential")
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+
+def file_header(file_meta):
+    """Preamble, 'DICM' prefix and File Meta Information of a Part 10 file"""
+    header = BytesIO()
+    header.write(b'\x00' * 128)
+    header.write(b'DICM')
+    write_file_meta_info(header, file_meta, enforce_standard=True)
+    return header.getvalue()
+
+
+def write_chunks(path, chunks):
+    """Write the chunks to path, hashing them on the way. Returns (size, hash)."""
+    with open(path, 'wb') as f:
+        writer = HashingWriter(f)
+        for chunk in chunks:
+            writer.write(chunk)
+    return writer.size, writer.hexdigest()
+
+
+def save_dataset(dataset, path, **kwargs):
+    """dataset.save_as(path) hashing the bytes written. Returns (size, hash)."""
+    with open(path, 'wb') as f:
+        writer = HashingWriter(f)
+        dataset.save_as(writer, **kwargs)
+    return writer.size, writer.hexdigest()
+
+
+class ManifestStore:
+    """Per-series manifests of an output directory, kept in memory and flushed atomically"""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.directory = self.root / MANIFEST_DIR
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._series = {}
+        self._dirty = set()
+        # Durable writes (durability.py): manifests are fsynced before they replace the previous ones
+        self.fsync = False
+
+    def _path(self, series_uid):
+        return self.directory / f"{series_uid}.json"
+
+    def _instances(self, series_uid):
+        """Instances of a series manifest, loaded on first use (caller holds the lock)"""
+        instances = self._series.get(series_uid)
+        if instances is None:
+            path = self._path(series_uid)
+            instances = {}
+            if path.exists():
+                with open(path, encoding='utf-8') as f:
+                    instances = json.load(f).get('instances', {})
+            self._series[series_uid] = instances
+        return instances
+
+    def _relative(self, path):
+        return os.path.relpath(path, self.root)
+
+    def is_duplicate(self, series_uid, sop_uid, received):
+        """True if this SOP instance was already stored with the same content and is still on disk"""
+        with self._lock:
+            entry = self._instances(series_uid).get(sop_uid)
+        return (entry is not None and entry.get('received') == received
+                and path_exists(self.root / entry['path']))
+
+    def record(self, series_uid, sop_uid, path, size, digest, received=None):
+        """Record a newly written instance"""
+        with self._lock:
+            self._instances(series_uid)[sop_uid] = {
+                'path': self._relative(path), 'size': size, 'hash': digest, 'received': received or digest,
+            }
+            self._dirty.add(series_uid)
+
+    def update_file(self, series_uid, sop_uid, path, size, digest):
+        """The file of an instance was rewritten (e.g. pseudonymized): new size and hash"""
+        with self._lock:
+            entry = self._instances(series_uid).get(sop_uid)
+            if entry is None:
+                return
+            entry.update(path=self._relative(path), size=size, hash=digest)
+            self._dirty.add(series_uid)
+
+    def relocate(self, series_uid, sop_uid, path):
+        """The file of an instance was moved (e.g. sorted)"""
+        with self._lock:
+            entry = self._instances(series_uid).get(sop_uid)
+            if entry is None:
+                return
+            entry['path'] = self._relative(path)
+            self._dirty.add(series_uid)
+
+    def flush(self):
+        """Write the modified manifests (temporary file + rename, never half-written)"""
+        # Flushes are serialized so that an older snapshot never replaces a newer one
+        with self._flush_lock:
+            with self._lock:
+                dirty = {series_uid: dict(self._series[series_uid]) for series_uid in self._dirty}
+                self._dirty.clear()
+            if not dirty:
+                return 0
+            self.directory.mkdir(parents=True, exist_ok=True)
+            for series_uid, instances in dirty.items():
+                path = self._path(series_uid)
+                tmp_path = path.with_suffix('.json.tmp')
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump({'SeriesInstanceUID': series_uid, 'algorithm': HASH_ALGORITHM, 'instances': instances},
+                              f, indent=1)
+                    if self.fsync:
+                        f.flush()
+                        os.fsync(f.fileno())
+                os.replace(tmp_path, path)
+            if self.fsync:
+                fsync_directory(self.directory)
+            return len(dirty)
+
+    def instances(self, series_uid):
+        """Copy of the {SOPInstanceUID: entry} manifest of a series"""
+        with self._lock:
+            return dict(self._instances(series_uid))
+
+    def series_uids(self):
+        """Series with a manifest on disk"""
+        if not self.directory.is_dir():
+            return []
+        return sorted(path.name[:-len('.json')] for path in self.directory.glob('*.json'))
+
+
+class VerifyReport:
+    def __init__(self):
+        self.ok = 0
+        self.missing = []
+        self.size_mismatch = []
+        self.hash_mismatch = []
+
+    @property
+    def failed(self):
+        return len(self.missing) + len(self.size_mismatch) + len(self.hash_mismatch)
+
+
+def _check_entry(root, entry, full):
+    """'ok', 'missing', 'size' or 'hash' for one manifest entry"""
+    path = root / entry['path']
+    if is_member(path):
+        size = member_size(path)
+        if size is None:
+            return 'missing'
+    else:
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            return 'missing'
+    if size != entry['size']:
+        return 'size'
+    if full and (hash_buffers(read_member(path)) if is_member(path) else hash_file(path)) != entry['hash']:
+        return 'hash'
+    return 'ok'
+
+
+def verify(root, series_uids=None, full=True, workers=8, progress=None):
+    """Compare the manifests of root against the files on disk.
+
+    With full=False only the presence and size of the files are checked.
+    Files are hashed by a thread pool (hashlib releases the GIL).
+    """
+    store = ManifestStore(root)
+    report = VerifyReport()
+    failures = {'missing': report.missing, 'size': report.size_mismatch, 'hash': report.hash_mismatch}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for series_uid in series_uids or store.series_uids():
+            entries = list(store.instances(series_uid).items())
+            results = executor.map(lambda item: _check_entry(store.root, item[1], full), entries)
+            for (sop_uid, entry), result in zip(entries, results):
+                if result == 'ok':
+                    report.ok += 1
+                else:
+                    failures[result].append((series_uid, sop_uid, entry['path']))
+            if progress:
+                progress(len(entries))
+    return report
@@ -1,23 +1,49 @@
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 from time import sleep
 from time import time
 import pydicom
 import click
 from pydicom import Dataset
+from pydicom.errors import InvalidDicomError
 from pynetdicom import AE, evt, StoragePresentationContexts
 from pynetdicom.sop_class import StudyRootQueryRetrieveInformationModelMove
-from dicom.services.search_criteria import SearchCriteria
+from dicom.services.search_criteria import SearchCriteria, list_matching_rejected, retrieve_batches, uid_list
+from dicom.services.durability import TEMP_PREFIX, TEMP_SUFFIX, fsync_directory, temp_path
 from dicom.services.json_file import SeriesMetadataCollector
+from dicom.services.manifest import ManifestStore, file_header, hash_buffers, write_chunks
+from dicom.services.move_registry import move_registry
+from dicom.services.nodes import NodePool
+from dicom.services.pack import PackStore
+from dicom.services.sorter import (MANIFEST_TAGS, SORT_TAGS, clean_name, read_header, scan_files, series_dir,
+                                    SortReport, sort_file, sort_tree)
+from dicom.services.tracing import span, traced
 from dicom.controllers.anonym_controller import AnonymController
 from dicom.controllers.pseudonym_controller import PseudonymController
 
 class Move:
-    def __init__(self, config, output_dir="output_dir"):
+    def __init__(self, config, output_dir="output_dir", registry=None, catalog=None, throttler=None, nodes=None,
+                 temp_dir=None, pack=False, durable=None):
         self.config = config
+        self.registry = registry or move_registry
+        self.nodes = nodes or NodePool.from_config(config)
+        self.catalog = catalog
+        self.throttler = throttler
         self.output_dir = Path(output_dir)
         self.output_dir.mkdir(parents=True, exist_ok=True)
-        self.temp_dir = self.output_dir / "temp_transit"
+        # Workers sharing an output_dir each receive into their own temp_dir
+        self.temp_dir = Path(temp_dir) if temp_dir else self.output_dir / "temp_transit"
         self.temp_dir.mkdir(parents=True, exist_ok=True)
+        self.manifest = ManifestStore(self.output_dir)
+        # Sorted instances are appended to one pack per series instead of one file each
+        self.packs = PackStore() if pack else None
+        # DurableWriter: received files are fsynced in batches before they are acknowledged or recorded
+        self.durable = durable
+        self.manifest.fsync = durable is not None
         self.ano_controller = AnonymController()
         self.pseudo_controller = PseudonymController()
         
@@ -26,108 +52,327 @@ class Move:
         self.ae.supported_contexts = StoragePresentationContexts
         
         self.files_received = 0
+        self.duplicates = 0
+        self._count_lock = threading.Lock()
+        # UIDs packed per C-MOVE, falls back to 1 if the PACS rejects list matching
+        self.batch_size = getattr(self.config, 'RETRIEVE_BATCH_SIZE', 1)
         self.current_criteria = None
         self.metadata_collector = None
         self.current_patient_dir = None
-        self.ae.dimse_timeout = 1200
-        self.ae.network_timeout = 1200 
-        self.ae.acse_timeout = 1200    
+        # Timeouts and max PDU of the storage SCP; the associations use the profile of their node
+        self.profile = self.nodes.nodes[0].profile
+        self.profile.apply(self.ae)
 
+    @traced('move.store')
     def _handle_store(self, event):
         ds = event.dataset
-        ds.file_meta = event.file_meta
-        
-        patient_id = self.clean_name(getattr(ds, 'PatientID', 'Unknown_Patient'))
-        patient_path = self.temp_dir / patient_id
-        patient_path.mkdir(exist_ok=True, parents=True)
-        
-        filename = f"{ds.SOPInstanceUID}.dcm"
-        ds.save_as(patient_path / filename, enforce_file_format=True)
-        
-        self.files_received += 1
+        series_uid = getattr(ds, 'SeriesInstanceUID', None)
+        sop_uid = ds.SOPInstanceUID
+        record = self.registry.match(event.request, ds)
+
+        # The dataset is written as received (no re-encoding) and hashed on the way
+        with event.request.DataSet.getbuffer() as raw:
+            size = raw.nbytes
+            received = hash_buffers(raw)
+            if self.manifest.is_duplicate(series_uid, sop_uid, received):
+                # Sent again unchanged: nothing to write
+                if record is not None:
+                    record.add_duplicate(series_uid)
+                with self._count_lock:
+                    self.files_received += 1
+                    self.duplicates += 1
+                if self.throttler is not None:
+                    self.throttler.throttle(size)
+                return 0x0000
+
+            patient_id = self.clean_name(getattr(ds, 'PatientID', 'Unknown_Patient'))
+            patient_path = self.temp_dir / patient_id
+            patient_path.mkdir(exist_ok=True, parents=True)
+            file_path = patient_path / f"{sop_uid}.dcm"
+            write_path = self.durable.temp_path(file_path) if self.durable is not None else file_path
+            with span('move.store.write'):
+                file_size, digest = write_chunks(write_path, (file_header(event.file_meta), raw))
+        if self.durable is not None:
+            # Recorded in the manifest once on disk; in response mode the PACS waits for the flush too
+            try:
+                with span('move.store.fsync'):
+                    self.durable.commit(write_path, file_path, partial(
+                        self.manifest.record, series_uid, sop_uid, file_path, file_size, digest, received))
+            except OSError as e:
+                print(f"E: {sop_uid} not flushed to disk: {e}")
+                return 0xA700
+        else:
+            self.manifest.record(series_uid, sop_uid, file_path, file_size, digest, received)
+
+        if record is not None:
+            record.add_file(file_path, series_uid)
+        with self._count_lock:
+            self.files_received += 1
+        if self.throttler is not None:
+            # Delaying the response slows the PACS down to the scheduled rate
+            self.throttler.throttle(size)
         return 0x0000
 
 
-    def move_data(self, criteria: SearchCriteria, destination_aet=None):
+    @traced('move.move_data')
+    def move_data(self, criteria: SearchCriteria, destination_aet=None, batch_size=None):
+        """Send the C-MOVE request(s) and return the number of instances received for them"""
+        return sum(record.files_received for record in self.move_tracked(criteria, destination_aet, batch_size))
+
+    @traced('move.move_tracked')
+    def move_tracked(self, criteria: SearchCriteria, destination_aet=None, batch_size=None, on_series_complete=None):
+        """Send the C-MOVE request(s) for the criteria and return their MoveRecords once completed.
+
+        Lists of Study/Series Instance UIDs are packed into requests of
+        batch_size UIDs (UID list matching). If the PACS rejects such a
+        request, its UIDs are moved again one per request and list matching
+        is disabled for this instance.
+
+        With several source nodes the batches are spread over them in
+        parallel, within the concurrency cap of each node.
+
+        on_series_complete(record, series_uid), if given, is called for each
+        series of a SERIES/IMAGE-level request as soon as that request has
+        completed, while the next ones are still moving (possibly from
+        several threads).
+        """
         self.current_criteria = criteria
-        self.files_received = 0
-        
+        batch_size = batch_size or self.batch_size
+        batches = list(retrieve_batches(criteria, batch_size))
+        move_batch = partial(self._move_batch, destination_aet=destination_aet, on_series_complete=on_series_complete)
+
+        if len(self.nodes) > 1 and len(batches) > 1:
+            workers = min(len(batches), self.nodes.capacity)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                return [record for records in executor.map(move_batch, batches) for record in records]
+        return [record for batch in batches for record in move_batch(batch)]
+
+    def _move_batch(self, batch, destination_aet=None, on_series_complete=None):
+        """Move one batch of UIDs, again one UID per request if list matching is rejected"""
+        record = self._move_request(batch, destination_aet)
+        if not list_matching_rejected(batch, record.status, record.files_received):
+            self._series_complete(record, on_series_complete)
+            return [record]
+        print("I: List matching rejected by the PACS, moving one UID per request")
+        self.batch_size = 1
+        records = []
+        for single in retrieve_batches(batch, 1):
+            records.append(self._move_request(single, destination_aet))
+            self._series_complete(records[-1], on_series_complete)
+        return records
+
+    @staticmethod
+    def _series_complete(record, on_series_complete):
+        if on_series_complete is None:
+            return
+        for series_uid in sorted(record.series_uids):
+            try:
+                on_series_complete(record, series_uid)
+            except Exception as e:
+                print(f"E: Post-processing of series {series_uid} not started: {e}")
+
+    def _move_request(self, criteria, destination_aet=None):
+        """Send one C-MOVE on the best source node and return its MoveRecord once the move has completed"""
+        if self.nodes.transport == 'dicomweb':
+            return self._web_request(criteria)
         dest = destination_aet or self.config.CALLING_AET
-        assoc = self.ae.associate(self.config.HOST, self.config.PORT, ae_title=self.config.CALLED_AET)
-        
-        if assoc.is_established:
-            ds = Dataset()
-            ds.QueryRetrieveLevel = criteria.level
-            ds.StudyInstanceUID = criteria.study_instance_uid or ''
-            if criteria.level == 'SERIES':
-                ds.SeriesInstanceUID = criteria.series_instance_uid or ''
-                
-            responses = assoc.send_c_move(ds, dest, StudyRootQueryRetrieveInformationModelMove)
-            for (status, identifier) in responses:
-                if status:
-                    print(f"I: Move Status: {hex(status.Status)}")
-            assoc.release()
-        return self.files_received
-    
+        series_uids = uid_list(criteria.series_instance_uid) if criteria.level in ('SERIES', 'IMAGE') else []
+        record = self.registry.register(self.config.CALLING_AET, uid_list(criteria.study_instance_uid), series_uids)
+        try:
+            with self.nodes.association(self.ae) as (node, assoc):
+                ds = Dataset()
+                ds.QueryRetrieveLevel = criteria.level
+                ds.StudyInstanceUID = criteria.study_instance_uid or ''
+                if criteria.level in ('SERIES', 'IMAGE'):
+                    ds.SeriesInstanceUID = criteria.series_instance_uid or ''
+                if criteria.level == 'IMAGE':
+                    ds.SOPInstanceUID = criteria.sop_instance_uid or ''
+
+                with span('move.request', node=node.name, level=criteria.level):
+                    responses = assoc.send_c_move(ds, dest, StudyRootQueryRetrieveInformationModelMove,
+                                                  msg_id=record.msg_id)
+                    for (status, identifier) in responses:
+                        if status:
+                            record.status = status.Status
+                            print(f"I: Move Status: {hex(status.Status)} ({node.name})")
+        except ConnectionError as e:
+            print(f"E: C-MOVE not sent: {e}")
+        finally:
+            if self.durable is not None:
+                # The files of the move keep their temporary names until their batch is committed
+                self.durable.drain()
+            self.registry.complete(record)
+            self.manifest.flush()
+        return record
+
+    def _web_request(self, criteria):
+        """WADO-RS retrieve of the criteria on the best dicomweb node, in place of a C-MOVE (same MoveRecord)"""
+        series_uids = uid_list(criteria.series_instance_uid) if criteria.level in ('SERIES', 'IMAGE') else []
+        record = self.registry.register(self.config.CALLING_AET, uid_list(criteria.study_instance_uid), series_uids)
+        try:
+            # Raises ConnectionError when every node is down: no slot to give back
+            node = self.nodes.acquire()
+            start = time()
+            try:
+                with span('move.request', node=node.name, level=criteria.level):
+                    received, errors = node.web.retrieve(criteria, partial(self._store_part, record))
+            except Exception as e:
+                print(f"E: WADO-RS retrieve failed on {node.name}: {e}")
+                self.nodes.release(node, failed=isinstance(e, OSError))
+            else:
+                # Same statuses as a C-MOVE: success, or warning when some series failed
+                record.status = 0xB000 if errors else 0x0000
+                print(f"I: Move Status: {hex(record.status)} ({node.name}, {received} instances)")
+                self.nodes.release(node, latency=time() - start)
+        except ConnectionError as e:
+            print(f"E: WADO-RS retrieve not sent: {e}")
+        finally:
+            if self.durable is not None:
+                self.durable.drain()
+            self.registry.complete(record)
+            self.manifest.flush()
+        return record
+
+    @traced('move.store')
+    def _store_part(self, record, part):
+        """Store one Part 10 file of a WADO-RS response, streamed to a temporary file then moved into place"""
+        tmp_path = temp_path(self.temp_dir / f"{uuid.uuid4().hex}.dcm")
+        try:
+            with span('move.store.write'):
+                file_size, digest = write_chunks(tmp_path, part.chunks())
+            ds = read_header(tmp_path, SORT_TAGS + MANIFEST_TAGS)
+        except Exception:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        series_uid = getattr(ds, 'SeriesInstanceUID', None)
+        sop_uid = ds.SOPInstanceUID
+        if self.manifest.is_duplicate(series_uid, sop_uid, digest):
+            tmp_path.unlink()
+            record.add_duplicate(series_uid)
+            with self._count_lock:
+                self.files_received += 1
+                self.duplicates += 1
+            return
+
+        patient_path = self.temp_dir / self.clean_name(getattr(ds, 'PatientID', 'Unknown_Patient'))
+        patient_path.mkdir(exist_ok=True, parents=True)
+        file_path = patient_path / f"{sop_uid}.dcm"
+        if self.durable is not None:
+            try:
+                with span('move.store.fsync'):
+                    self.durable.commit(tmp_path, file_path, partial(
+                        self.manifest.record, series_uid, sop_uid, file_path, file_size, digest))
+            except OSError as e:
+                print(f"E: {sop_uid} not flushed to disk: {e}")
+                return
+        else:
+            os.replace(tmp_path, file_path)
+            self.manifest.record(series_uid, sop_uid, file_path, file_size, digest)
+
+        record.add_file(file_path, series_uid)
+        with self._count_lock:
+            self.files_received += 1
+        if self.throttler is not None:
+            # Reading the response more slowly slows the server down to the scheduled rate
+            self.throttler.throttle(file_size)
+
 
     def clean_name(self, name):
             """Supprime les caractères interdits pour les dossiers Windows."""
-            if not name:
-                return "Unknown"
-            name = str(name)
-            forbidden_chars = ['\\', '/', ':', '*', '?', '"', '<', '>', '|']
-            for char in forbidden_chars:
-                name = name.replace(char, '_')
-            return name.strip()
+            return clean_name(name)
 
 
-    def final_global_sort(self):
-        start_time = time()
+    @traced('sort.file')
+    def sort_file(self, file_path):
+        """Move one received file into output_dir/<PatientID>/<SeriesNumber>_<SeriesDescription>"""
+        tags = self.catalog.TAGS if self.catalog is not None else SORT_TAGS + MANIFEST_TAGS
+        if self.packs is not None:
+            ds = read_header(file_path, tags)
+            destination = self.packs.add_file(series_dir(ds, self.output_dir), ds.SOPInstanceUID, file_path,
+                                               getattr(ds, 'SeriesInstanceUID', None))
+            os.unlink(file_path)
+        else:
+            destination, ds = sort_file(file_path, self.output_dir, tags=tags)
+        self.manifest.relocate(getattr(ds, 'SeriesInstanceUID', None), getattr(ds, 'SOPInstanceUID', None), destination)
+        if self.catalog is not None:
+            self.catalog.add_dataset(ds, destination)
+        return destination
 
-        click.echo(click.style("\nBegin sorting...", fg='magenta', bold=True))
-        
-        all_files = list(self.temp_dir.rglob("*.dcm"))
-        total = len(all_files)
-        click.echo(f"I: {total} fichiers à traiter.")
+    def sync_sorted(self, paths):
+        """fsync the folders a series was sorted into (durable mode), so that its renames survive a crash.
 
-        with click.progressbar(all_files, label="Sorting..") as bar:
+        A crash before the temp folder is synced only leaves a second copy in
+        temp_dir, sorted again by the next run.
+        """
+        if self.durable is None or self.packs is not None:
+            return
+        for directory in {Path(path).parent for path in paths}:
+            fsync_directory(directory)
+
+    def _pack_remaining(self, on_sorted=None):
+        """Pack the files left in temp_dir, then close every pack (central directory and index)"""
+        report = SortReport()
+        start = time()
+        files = list(scan_files(str(self.temp_dir)))
+        with click.progressbar(files, label="Packing..") as bar:
             for file_path in bar:
                 try:
-                    ds = pydicom.dcmread(file_path, force=True)
-
-                    p_id = self.clean_name(getattr(ds, 'PatientID', 'Unknown'))
-                    p_dir = self.output_dir / p_id
-                    p_dir.mkdir(parents=True, exist_ok=True)
-# ORGANIZED BY SERIES
-                    s_num = getattr(ds, 'SeriesNumber', '0')
-                    s_desc = self.clean_name(getattr(ds, 'SeriesDescription', 'NoDesc'))
-                    s_dir = p_dir / f"{s_num}_{s_desc}"
-                    s_dir.mkdir(parents=True, exist_ok=True)
-                    destination = s_dir / file_path.name
-# NOT ORGANIZED BY SERIES
-                    # destination = p_dir / file_path.name
-
-                    # if self.current_patient_dir != p_dir:
-                    #     if self.metadata_collector:
-                    #         self.metadata_collector.save_to_json()
-                    #     self.current_patient_dir = p_dir
-                    #     self.metadata_collector = SeriesMetadataCollector(p_dir)
-
-                    # self.metadata_collector.add_instance(ds)
-
-                    file_path.rename(destination)
-
+                    destination = self.sort_file(file_path)
+                    if on_sorted is not None:
+                        on_sorted([destination])
+                    report.sorted += 1
+                except InvalidDicomError:
+                    report.skipped += 1
                 except Exception as e:
-                    click.echo(f"\nE: Erreur sur {file_path.name}: {e}")
+                    report.errors.append((file_path, f"{type(e).__name__}: {e}"))
+        self.packs.close()
+        report.elapsed = time() - start
+        return report
+
+    @traced('sort.final_global_sort')
+    def final_global_sort(self, workers=None, on_sorted=None):
+        """Sort the files left in temp_dir; on_sorted, if given, receives their destination paths"""
+        start_time = time()
+
+        click.echo(click.style("\nBegin sorting...", fg='magenta', bold=True))
+        if self.durable is not None:
+            self.durable.drain()
+        
+        if self.packs is not None:
+            report = self._pack_remaining(on_sorted)
+        else:
+            with click.progressbar(length=sum(1 for _ in scan_files(str(self.temp_dir))), label="Sorting..") as bar:
+                report = sort_tree(self.temp_dir, self.output_dir, mode='move', workers=workers,
+                                   progress=bar.update, catalog=self.catalog, manifest=self.manifest,
+                                   fsync=self.durable is not None, on_sorted=on_sorted)
+        self.manifest.flush()
+        click.echo(f"I: {report.sorted} fichiers triés, {report.skipped} ignorés.")
+        for path, error in report.errors:
+            click.echo(f"E: Erreur sur {Path(path).name}: {error}")
 
         if self.metadata_collector: 
             self.metadata_collector.save_to_json()
         
         click.echo(click.style("Globally sorted successfully.", fg='green', bold=True))
         elapsed = time() - start_time
-        click.echo(click.style(f"Elapsed time for sorting: {elapsed:.2f} seconds", fg='cyan', bold=True))
-        for item in self.temp_dir.iterdir():
-            if item.is_dir():
-                for subitem in item.iterdir():
-                    subitem.unlink()
-                item.rmdir()
+        click.echo(click.style(f"Elapsed time for sorting: {elapsed:.2f} seconds ({report.files_per_second:.0f} files/s)", fg='cyan', bold=True))
+        self._clean_temp_dir()
+
+    def _clean_temp_dir(self):
+        """Remove the folders emptied by the sort; files not sorted (skipped or failed) stay in temp_dir"""
+        for root, dirs, files in os.walk(self.temp_dir, topdown=False):
+            for name in files:
+                if name.startswith(TEMP_PREFIX) and name.endswith(TEMP_SUFFIX):
+                    # Write interrupted before it was acknowledged
+                    os.unlink(os.path.join(root, name))
+            if root != str(self.temp_dir):
+                try:
+                    os.rmdir(root)
+                except OSError:
+                    pass
+        kept = list(scan_files(str(self.temp_dir)))
+        if kept:
+            click.echo(f"E: {len(kept)} fichier(s) non trié(s) conservé(s) dans {self.temp_dir}")
+            for path in kept:
+                click.echo(f"E:   {path}")
+        return kept
@@ -0,0 +1,99 @@
+import itertools
+import threading
+
+
+class MoveRecord:
+    """Tracks the instances received for one outstanding C-MOVE request"""
+
+    def __init__(self, msg_id, originator_aet, study_uids=(), series_uids=()):
+        self.msg_id = msg_id
+        self.originator_aet = originator_aet
+        self.study_uids = set(study_uids)
+        self.series_uids = set(series_uids)
+        self.files_received = 0
+        self.files = []
+        self.files_by_series = {}
+        self.duplicates_by_series = {}
+        self.status = None
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def add_file(self, file_path, series_uid=None):
+        """Count a stored instance for this move"""
+        with self._lock:
+            self.files_received += 1
+            self.files.append(file_path)
+            self.files_by_series.setdefault(series_uid, []).append(file_path)
+
+    def add_duplicate(self, series_uid=None):
+        """Count an instance already stored unchanged (nothing written)"""
+        with self._lock:
+            self.files_received += 1
+            self.duplicates_by_series[series_uid] = self.duplicates_by_series.get(series_uid, 0) + 1
+
+    def matches(self, study_uid, series_uid):
+        """Check whether an instance with these UIDs belongs to this move"""
+        if self.series_uids:
+            return series_uid in self.series_uids
+        return study_uid in self.study_uids
+
+    def wait(self, timeout=None):
+        """Block until the C-MOVE has completed"""
+        return self.done.wait(timeout)
+
+
+class MoveRegistry:
+    """Matches incoming C-STORE requests to the C-MOVE that triggered them.
+
+    A single storage SCP usually receives the sub-operations of several
+    parallel C-MOVEs. The store handler looks up the originating move with
+    the Move Originator Message ID/AE sent by the PACS, and falls back on the
+    Study/Series Instance UIDs when the PACS does not fill them in.
+    """
+
+    MAX_MSG_ID = 0xFFFF
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._msg_ids = itertools.count(1)
+        self._active = {}
+
+    def _next_msg_id(self):
+        """Message IDs must be unique between the moves in flight"""
+        while True:
+            msg_id = next(self._msg_ids) % self.MAX_MSG_ID + 1
+            if msg_id not in self._active:
+                return msg_id
+
+    def register(self, originator_aet, study_uids=(), series_uids=()):
+        """Open a record for a new C-MOVE and reserve its message ID"""
+        with self._lock:
+            msg_id = self._next_msg_id()
+            record = MoveRecord(msg_id, originator_aet, study_uids, series_uids)
+            self._active[msg_id] = record
+        return record
+
+    def complete(self, record):
+        """Close a record once the final C-MOVE response has arrived"""
+        with self._lock:
+            self._active.pop(record.msg_id, None)
+        record.done.set()
+
+    def match(self, request, dataset):
+        """Find the move record for an incoming C-STORE request, or None"""
+        msg_id = request.MoveOriginatorMessageID
+        originator = request.MoveOriginatorApplicationEntityTitle
+        study_uid = getattr(dataset, 'StudyInstanceUID', None)
+        series_uid = getattr(dataset, 'SeriesInstanceUID', None)
+
+        with self._lock:
+            record = self._active.get(msg_id) if msg_id is not None else None
+            if record is not None and (not originator or originator == record.originator_aet):
+                return record
+            for record in self._active.values():
+                if record.matches(study_uid, series_uid):
+                    return record
+        return None
+
+
+move_registry = MoveRegistry()
@@ -0,0 +1,156 @@
+"""
+Network Profiles
+
+Maximum PDU length, TCP socket buffers and ACSE/DIMSE/network timeouts of
+the associations with a PACS node. A profile is resolved per node, each
+level overriding the previous one:
+
+    1. TelemisConfig.NETWORK_PROFILE
+    2. the profile file (TelemisConfig.NETWORK_PROFILE_FILE, or the
+       DICOM_NETWORK_PROFILE environment variable):
+           {"default": {"max_pdu": 0, "recv_buffer": 8388608},
+            "nodes": {"TELEMISQR@192.168.0.170:106": {"max_pdu": 262144}}}
+       nodes are looked up by node name, then by called AE title
+    3. the "network" entry of the node in TelemisConfig.SOURCE_NODES
+    4. DICOM_MAX_PDU, DICOM_SEND_BUFFER, DICOM_RECV_BUFFER, DICOM_ACSE_TIMEOUT,
+       DICOM_DIMSE_TIMEOUT, DICOM_NETWORK_TIMEOUT environment variables
+
+max_pdu is in bytes, 0 meaning unlimited. Buffers are in bytes, None keeps
+the OS default (the kernel may cap them, see net.core.rmem_max/wmem_max).
+On the associations this side requests, recv_buffer is best effort.
+"""
+
+import json
+import logging
+import os
+import socket
+
+from pynetdicom import evt
+
+PROFILE_FILE_ENV = 'DICOM_NETWORK_PROFILE'
+DEFAULT_PROFILE = {
+    'max_pdu': 16382,
+    'send_buffer': None,
+    'recv_buffer': None,
+    'acse_timeout': 60,
+    'dimse_timeout': 1200,
+    'network_timeout': 1200,
+}
+ENVIRONMENT = {
+    'max_pdu': 'DICOM_MAX_PDU',
+    'send_buffer': 'DICOM_SEND_BUFFER',
+    'recv_buffer': 'DICOM_RECV_BUFFER',
+    'acse_timeout': 'DICOM_ACSE_TIMEOUT',
+    'dimse_timeout': 'DICOM_DIMSE_TIMEOUT',
+    'network_timeout': 'DICOM_NETWORK_TIMEOUT',
+}
+INTEGER_KEYS = ('max_pdu', 'send_buffer', 'recv_buffer')
+
+
+def _parse(key, value):
+    if value in (None, '', 'none', 'None'):
+        return None
+    return int(value) if key in INTEGER_KEYS else float(value)
+
+
+def _read_profile_file(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+class NetworkProfile:
+    """Network settings of the associations with one node"""
+
+    def __init__(self, max_pdu=16382, send_buffer=None, recv_buffer=None, acse_timeout=60, dimse_timeout=1200,
+                 network_timeout=1200):
+        self.max_pdu = int(max_pdu)
+        self.send_buffer = send_buffer
+        self.recv_buffer = recv_buffer
+        self.acse_timeout = acse_timeout
+        self.dimse_timeout = dimse_timeout
+        self.network_timeout = network_timeout
+
+    @classmethod
+    def load(cls, config, name=None, called_aet=None, overrides=None):
+        """Profile of a node, from the config, the profile file, the node overrides and the environment"""
+        values = dict(DEFAULT_PROFILE)
+        values.update(getattr(config, 'NETWORK_PROFILE', None) or {})
+
+        path = os.environ.get(PROFILE_FILE_ENV) or getattr(config, 'NETWORK_PROFILE_FILE', None)
+        if path:
+            data = _read_profile_file(path)
+            values.update(data.get('default', {}))
+            nodes = data.get('nodes', {})
+            values.update(nodes.get(name) or nodes.get(called_aet) or {})
+
+        values.update(overrides or {})
+        for key, variable in ENVIRONMENT.items():
+            if os.environ.get(variable) is not None:
+                values[key] = os.environ[variable]
+
+        unknown = set(values) - set(DEFAULT_PROFILE)
+        if unknown:
+            raise ValueError(f"Unknown network profile setting(s): {', '.join(sorted(unknown))}")
+        return cls(**{key: _parse(key, value) for key, value in values.items()})
+
+    @classmethod
+    def for_config(cls, config):
+        """Profile of the HOST/PORT/CALLED_AET node of a config"""
+        return cls.load(config, name=f"{config.CALLED_AET}@{config.HOST}:{config.PORT}",
+                        called_aet=config.CALLED_AET)
+
+    def copy(self, **changes):
+        values = dict(vars(self))
+        values.update(changes)
+        return NetworkProfile(**values)
+
+    def apply(self, ae):
+        """AE-wide settings: timeouts, and the max PDU advertised by its storage SCP"""
+        ae.maximum_pdu_size = self.max_pdu
+        ae.acse_timeout = self.acse_timeout
+        ae.dimse_timeout = self.dimse_timeout
+        ae.network_timeout = self.network_timeout
+        ae.connection_timeout = self.acse_timeout
+
+    def tune_socket(self, sock):
+        """Set the TCP buffer sizes of a socket (best effort)"""
+        for option, size in ((socket.SO_SNDBUF, self.send_buffer), (socket.SO_RCVBUF, self.recv_buffer)):
+            if size:
+                try:
+                    sock.setsockopt(socket.SOL_SOCKET, option, size)
+                except OSError as e:
+                    logging.warning(f"Cannot set socket buffer {option} to {size}: {e}")
+
+    def tune_server(self, server):
+        """Buffers of a listening storage SCP, inherited by the sockets it accepts"""
+        if server is not None and server.socket is not None:
+            self.tune_socket(server.socket)
+
+    def _on_connection_open(self, event):
+        """Buffers of a requesting socket, set once connected (pynetdicom gives no earlier hook).
+
+        Best effort for recv_buffer: the TCP window scale is negotiated during
+        the handshake from the system default, so a larger SO_RCVBUF may not
+        widen the window the PACS sees. The storage SCP is not affected.
+        """
+        sock = getattr(event.assoc.dul.socket, 'socket', None)
+        if sock is not None:
+            self.tune_socket(sock)
+
+    def associate_kwargs(self, evt_handlers=None):
+        """ae.associate() keyword arguments: max PDU, and a handler sizing the socket buffers once connected"""
+        handlers = list(evt_handlers or [])
+        if self.send_buffer or self.recv_buffer:
+            handlers.append((evt.EVT_CONN_OPEN, self._on_connection_open))
+        kwargs = {'max_pdu': self.max_pdu}
+        if handlers:
+            kwargs['evt_handlers'] = handlers
+        return kwargs
+
+    def apply_association(self, assoc):
+        """Per-association timeouts, for an AE shared between nodes with different profiles"""
+        assoc.dimse_timeout = self.dimse_timeout
+        assoc.network_timeout = self.network_timeout
+
+    def __repr__(self):
+        return ("NetworkProfile(" + ", ".join(f"{key}={value}" for key, value in vars(self).items()) + ")")
@@ -0,0 +1,261 @@
+"""
+Source PACS Nodes
+
+Several equivalent nodes (replicas) can serve the same archive. Each node has
+a weight and a cap on concurrent associations. Requests go to the available
+node with the lowest recent latency, weighted by its load, and fail over to
+the next node when a node refuses or aborts the association.
+
+With keep_alive > 0, associations are not released after use but kept idle
+for that many seconds and handed to the next request on the same node and
+AE (long-running processes such as the serve daemon), saving the
+association set-up of every request.
+
+A node with "transport": "dicomweb" is a DICOMweb service (its "url") queried
+over QIDO-RS / WADO-RS instead of DIMSE: its max_associations caps the pooled
+HTTP connections. The nodes of a pool all use the same transport.
+"""
+
+import logging
+import threading
+from contextlib import contextmanager
+from time import monotonic
+from urllib.parse import urlsplit
+
+from dicom.services.dicomweb import TRANSPORTS, DicomWebClient
+from dicom.services.network import NetworkProfile
+from dicom.services.tracing import span
+
+
+class SourceNode:
+    """One source PACS node and its recent behaviour"""
+
+    LATENCY_SMOOTHING = 0.3
+
+    def __init__(self, host=None, port=0, called_aet=None, weight=1, max_associations=4, name=None, profile=None,
+                 transport='dimse', url=None, headers=None):
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Unknown transport {transport!r}, expected one of {TRANSPORTS}")
+        self.transport = transport
+        self.url = url
+        if transport == 'dicomweb':
+            if not url:
+                raise ValueError("A dicomweb node needs a url")
+            parts = urlsplit(url)
+            host, port = host or parts.hostname, port or parts.port or (443 if parts.scheme == 'https' else 80)
+        self.host = host
+        self.port = int(port)
+        self.called_aet = called_aet
+        self.weight = max(float(weight), 0.01)
+        self.max_associations = max(int(max_associations), 1)
+        self.name = name or (url if transport == 'dicomweb' else f"{called_aet}@{host}:{port}")
+        self.profile = profile or NetworkProfile()
+        self.headers = headers
+        self._web = None
+        self._web_lock = threading.Lock()
+        self.in_flight = 0
+        self.latency = None
+        self.failures = 0
+        self.down_until = 0.0
+        self.requests = 0
+
+    @property
+    def web(self):
+        """QIDO-RS / WADO-RS client of a dicomweb node (one pooled connection per association slot), else None"""
+        if self.transport != 'dicomweb':
+            return None
+        with self._web_lock:
+            if self._web is None:
+                self._web = DicomWebClient(self.url, self.max_associations, self.profile.network_timeout,
+                                           self.headers, self.name)
+            return self._web
+
+    def record_latency(self, seconds):
+        """Exponential moving average of the association set-up time"""
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += self.LATENCY_SMOOTHING * (seconds - self.latency)
+
+    def cost(self):
+        """Expected cost of sending one more request to this node"""
+        return ((self.latency or 0.0) * (self.in_flight + 1) / self.weight, self.in_flight / self.weight)
+
+    def __repr__(self):
+        return f"SourceNode({self.name}, weight={self.weight:g}, max_associations={self.max_associations})"
+
+
+class NodePool:
+    """Hands out source nodes to concurrent requests, with per-node caps and failover"""
+
+    def __init__(self, nodes, retry_delay=30.0, keep_alive=0.0):
+        if not nodes:
+            raise ValueError("At least one source node is required")
+        self.nodes = list(nodes)
+        self.retry_delay = retry_delay
+        self.keep_alive = keep_alive
+        self._condition = threading.Condition()
+        # node -> [(ae, association, idle since)], most recently used last
+        self._idle = {}
+        self.reused = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """Nodes of config.SOURCE_NODES, or the single HOST/PORT/CALLED_AET node"""
+        specs = getattr(config, 'SOURCE_NODES', None) or [
+            {'host': config.HOST, 'port': config.PORT, 'called_aet': config.CALLED_AET}
+        ]
+        nodes = []
+        for spec in specs:
+            spec = dict(spec)
+            network = spec.pop('network', None)
+            node = SourceNode(**spec)
+            node.profile = NetworkProfile.load(config, name=node.name, called_aet=node.called_aet, overrides=network)
+            nodes.append(node)
+        if len({node.transport for node in nodes}) > 1:
+            raise ValueError("SOURCE_NODES mixes DIMSE and DICOMweb nodes")
+        return cls(nodes, getattr(config, 'NODE_RETRY_DELAY', 30.0), getattr(config, 'ASSOCIATION_KEEP_ALIVE', 0))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @property
+    def transport(self):
+        """'dimse' or 'dicomweb', the same for every node"""
+        return self.nodes[0].transport
+
+    @property
+    def capacity(self):
+        """Total number of concurrent associations allowed over all nodes"""
+        return sum(node.max_associations for node in self.nodes)
+
+    def acquire(self, exclude=()):
+        """Reserve a slot on the best available node, waiting while they are all busy.
+
+        Raises ConnectionError when every node not in `exclude` is down.
+        """
+        with self._condition:
+            while True:
+                now = monotonic()
+                candidates = [node for node in self.nodes if node not in exclude and node.down_until <= now]
+                if not candidates:
+                    raise ConnectionError("No source node available: " + ", ".join(node.name for node in self.nodes))
+                free = [node for node in candidates if node.in_flight < node.max_associations]
+                if free:
+                    node = min(free, key=SourceNode.cost)
+                    node.in_flight += 1
+                    node.requests += 1
+                    return node
+                self._condition.wait()
+
+    def release(self, node, latency=None, failed=False):
+        """Give the slot back, recording the latency or taking a failed node out for retry_delay.
+
+        A failed node is only taken out while another node is up: the last
+        one stays available, so a transient refusal only fails the request
+        that met it.
+        """
+        with self._condition:
+            node.in_flight -= 1
+            if failed:
+                node.failures += 1
+                now = monotonic()
+                if any(other is not node and other.down_until <= now for other in self.nodes):
+                    node.down_until = now + self.retry_delay
+            elif latency is not None:
+                node.failures = 0
+                node.record_latency(latency)
+            self._condition.notify_all()
+
+    def _take_idle(self, node, ae):
+        """An idle association of ae on node still established, closing the expired ones"""
+        expired, found = [], None
+        with self._condition:
+            idle = self._idle.get(node, [])
+            now = monotonic()
+            for entry in list(idle):
+                entry_ae, assoc, since = entry
+                if not assoc.is_established or now - since > self.keep_alive:
+                    idle.remove(entry)
+                    expired.append(assoc)
+                elif found is None and entry_ae is ae:
+                    idle.remove(entry)
+                    found = assoc
+            # Idle associations count against the cap of the node on the PACS side
+            while idle and node.in_flight + len(idle) > node.max_associations:
+                expired.append(idle.pop(0)[1])
+        for assoc in expired:
+            if assoc.is_established:
+                assoc.release()
+        if found is not None:
+            self.reused += 1
+        return found
+
+    def _keep_idle(self, node, ae, assoc):
+        """Keep an association whose request is done for reuse, False if the node has no room for it"""
+        with self._condition:
+            idle = self._idle.setdefault(node, [])
+            # in_flight still counts the request handing the association back
+            if node.in_flight + len(idle) > node.max_associations:
+                return False
+            idle.append((ae, assoc, monotonic()))
+            return True
+
+    def close_idle(self):
+        """Release the idle associations"""
+        with self._condition:
+            idle, self._idle = self._idle, {}
+        for entries in idle.values():
+            for _, assoc, _ in entries:
+                if assoc.is_established:
+                    assoc.release()
+
+    @contextmanager
+    def association(self, ae, **kwargs):
+        """Yield (node, association) on the best node, failing over to the others.
+
+        The association is released on exit if the caller has not done so,
+        or kept idle for the next request with keep_alive.
+        """
+        tried = set()
+        while True:
+            node = self.acquire(exclude=tried)
+            assoc = self._take_idle(node, ae) if self.keep_alive else None
+            if assoc is not None:
+                latency = None
+                break
+            start = monotonic()
+            try:
+                associate_kwargs = dict(kwargs)
+                associate_kwargs.update(node.profile.associate_kwargs(kwargs.get('evt_handlers')))
+                with span('association', node=node.name):
+                    assoc = ae.associate(node.host, node.port, ae_title=node.called_aet, **associate_kwargs)
+            except Exception as e:
+                logging.debug("Association with %s failed: %s", node.name, e)
+                assoc = None
+            if assoc is not None and assoc.is_established:
+                node.profile.apply_association(assoc)
+                latency = monotonic() - start
+                break
+            self.release(node, failed=True)
+            tried.add(node)
+            logging.warning(f"Source node {node.name} refused the association, failing over")
+
+        reusable = False
+        try:
+            yield node, assoc
+            reusable = bool(self.keep_alive) and assoc.is_established
+        finally:
+            if assoc.is_established and not (reusable and self._keep_idle(node, ae, assoc)):
+                assoc.release()
+            self.release(node, latency=latency)
+
+    def report(self):
+        """One line per node: requests served, recent latency and state"""
+        now = monotonic()
+        lines = []
+        for node in self.nodes:
+            latency = f"{node.latency * 1000:.0f} ms" if node.latency is not None else "n/a"
+            state = "down" if node.down_until > now else "up"
+            lines.append(f"{node.name}: {node.requests} requests, latency {latency}, {state}")
+        return lines
@@ -0,0 +1,512 @@
+"""
+Packed Series Containers
+
+One container per series instead of one file per instance, to cut the inode
+count and the small-file overhead of very large cohorts. A pack sits where
+the series folder would be:
+
+    <PatientID>/<SeriesNumber>_<SeriesDescription>.zip        stored (uncompressed) zip,
+                                                              one <SOPInstanceUID>.dcm member per instance
+    <PatientID>/<SeriesNumber>_<SeriesDescription>.zip.idx    {"SeriesInstanceUID": ...,
+                                                               "instances": {<SOPInstanceUID>: [offset, size]}}
+
+The index holds the offset of the local header of each member: an instance
+is read by SOPInstanceUID with two positioned reads, without parsing the
+zip. Packs are plain zips (any unzip tool opens them) and `unpack` restores
+the standard folder layout.
+
+The manifest and catalog path of a packed instance is "<pack>::<SOP>.dcm".
+A pack has a single writer process. The central directory and the index are
+written when the pack is closed; a pack left without them by a killed run
+is rebuilt from its local headers when it is next opened.
+"""
+
+import json
+import os
+import shutil
+import struct
+import threading
+import zipfile
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from pathlib import Path
+from time import time
+
+from pydicom.errors import InvalidDicomError
+
+from dicom.services.sorter import COPY_BUFFER_SIZE, MANIFEST_TAGS, read_header, scan_files
+
+PACK_SUFFIX = '.zip'
+INDEX_SUFFIX = '.idx'
+MEMBER_SEPARATOR = '::'
+MAX_OPEN_PACKS = 64
+
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+
+
+def pack_path(series_dir):
+    """Pack of a series folder: <series_dir>.zip"""
+    series_dir = Path(series_dir)
+    return series_dir.with_name(series_dir.name + PACK_SUFFIX)
+
+
+def index_path(pack):
+    pack = Path(pack)
+    return pack.with_name(pack.name + INDEX_SUFFIX)
+
+
+def member_path(pack, sop_uid):
+    """Manifest/catalog path of a packed instance"""
+    return f"{pack}{MEMBER_SEPARATOR}{sop_uid}.dcm"
+
+
+def split_member(path):
+    """(pack, SOPInstanceUID) of a packed instance path, (path, None) for a plain file"""
+    pack, separator, member = str(path).partition(MEMBER_SEPARATOR)
+    if not separator:
+        return path, None
+    return Path(pack), member[:-len('.dcm')] if member.endswith('.dcm') else member
+
+
+def is_member(path):
+    return MEMBER_SEPARATOR in str(path)
+
+
+def _scan_local_headers(f):
+    """(SOPInstanceUID, header offset, size) of the members of a pack, from their local headers"""
+    offset = 0
+    while True:
+        f.seek(offset)
+        header = f.read(LOCAL_HEADER.size)
+        if len(header) < LOCAL_HEADER.size:
+            return
+        fields = LOCAL_HEADER.unpack(header)
+        if fields[0] != LOCAL_HEADER_SIGNATURE:
+            return
+        flags, size, name_length, extra_length = fields[3], fields[9], fields[10], fields[11]
+        if flags & 0x08 or size == 0xFFFFFFFF:
+            # Sizes in a data descriptor or a zip64 extra: never written by SeriesPack, stop there
+            return
+        name = f.read(name_length).decode('utf-8')
+        end = offset + LOCAL_HEADER.size + name_length + extra_length + size
+        f.seek(0, os.SEEK_END)
+        if end > f.tell():
+            # Member cut short by a killed run
+            return
+        yield name[:-len('.dcm')], offset, size
+        offset = end
+
+
+def _file_crc(path):
+    crc = 0
+    with open(path, 'rb') as f:
+        while chunk := f.read(COPY_BUFFER_SIZE):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def _member_data_offset(f, header_offset):
+    f.seek(header_offset)
+    fields = LOCAL_HEADER.unpack(f.read(LOCAL_HEADER.size))
+    if fields[0] != LOCAL_HEADER_SIGNATURE:
+        raise zipfile.BadZipFile(f"No member at offset {header_offset}")
+    return header_offset + LOCAL_HEADER.size + fields[10] + fields[11]
+
+
+def salvage(path):
+    """Rewrite a pack without central directory (killed writer) from its local headers, returns the member count"""
+    path = Path(path)
+    part = path.with_name(path.name + '.part')
+    count = 0
+    with open(path, 'rb') as src, zipfile.ZipFile(part, 'w', compression=zipfile.ZIP_STORED,
+                                                  allowZip64=True) as dst:
+        for sop_uid, offset, size in list(_scan_local_headers(src)):
+            src.seek(_member_data_offset(src, offset))
+            dst.writestr(f"{sop_uid}.dcm", src.read(size))
+            count += 1
+    os.replace(part, path)
+    return count
+
+
+def _read_sidecar(pack):
+    try:
+        with open(index_path(pack), encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+_index_cache = {}
+_index_cache_lock = threading.Lock()
+
+
+def load_index(pack):
+    """{"SeriesInstanceUID": ..., "instances": {SOP: [offset, size]}} of a pack.
+
+    The sidecar index is used when it is at least as recent as the pack,
+    otherwise the index is rebuilt from the zip central directory (or the
+    local headers). Cached per (pack, mtime, size).
+    """
+    pack = Path(pack)
+    stat = os.stat(pack)
+    key = (str(pack), stat.st_mtime_ns, stat.st_size)
+    with _index_cache_lock:
+        index = _index_cache.get(key)
+    if index is not None:
+        return index
+
+    index = _read_sidecar(pack)
+    sidecar_mtime = os.stat(index_path(pack)).st_mtime_ns if index is not None else None
+    if index is None or sidecar_mtime < stat.st_mtime_ns:
+        series_uid = index.get('SeriesInstanceUID') if index else None
+        try:
+            with zipfile.ZipFile(pack) as zf:
+                instances = {info.filename[:-len('.dcm')]: [info.header_offset, info.file_size]
+                             for info in zf.infolist()}
+        except zipfile.BadZipFile:
+            with open(pack, 'rb') as f:
+                instances = {sop_uid: [offset, size] for sop_uid, offset, size in _scan_local_headers(f)}
+        index = {'SeriesInstanceUID': series_uid, 'instances': instances}
+
+    with _index_cache_lock:
+        _index_cache[key] = index
+    return index
+
+
+class SeriesPack:
+    """Appendable pack of one series, members stored uncompressed"""
+
+    def __init__(self, path, series_uid=None):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        sidecar = _read_sidecar(self.path) or {}
+        self.series_uid = series_uid or sidecar.get('SeriesInstanceUID')
+        if self.path.exists():
+            # Append mode would start a second archive after a pack without central directory
+            if not zipfile.is_zipfile(self.path):
+                salvage(self.path)
+            self._zip = zipfile.ZipFile(self.path, 'a', compression=zipfile.ZIP_STORED, allowZip64=True)
+        else:
+            self._zip = zipfile.ZipFile(self.path, 'w', compression=zipfile.ZIP_STORED, allowZip64=True)
+        self.instances = {info.filename[:-len('.dcm')]: [info.header_offset, info.file_size]
+                          for info in self._zip.infolist()}
+        # CRC-32 of each member, to recognise an instance sent again unchanged
+        self._crcs = {info.filename[:-len('.dcm')]: info.CRC for info in self._zip.infolist()}
+        self.lock = threading.Lock()
+        self.users = 0
+        self.closed = False
+
+    def __contains__(self, sop_uid):
+        return sop_uid in self.instances
+
+    def __len__(self):
+        return len(self.instances)
+
+    def _added(self, sop_uid, info):
+        self.instances[sop_uid] = [info.header_offset, info.file_size]
+        self._crcs[sop_uid] = info.CRC
+        # Reach the OS at once: a killed process loses no member that was acknowledged
+        self._zip.fp.flush()
+        return member_path(self.path, sop_uid)
+
+    def _unchanged(self, sop_uid, size, crc):
+        """True if the instance is already packed with this size and CRC-32 (crc: callable, only called if needed)"""
+        entry = self.instances.get(sop_uid)
+        return entry is not None and entry[1] == size and self._crcs.get(sop_uid) == crc()
+
+    def add_bytes(self, sop_uid, data):
+        """Append an instance from memory, returns its member path.
+
+        An instance already packed unchanged is not appended again; a
+        changed one is appended and replaces the previous one in the index.
+        """
+        if self._unchanged(sop_uid, len(data), lambda: zlib.crc32(data)):
+            return member_path(self.path, sop_uid)
+        info = zipfile.ZipInfo(f"{sop_uid}.dcm")
+        info.compress_type = zipfile.ZIP_STORED
+        info.file_size = len(data)
+        with self._zip.open(info, 'w', force_zip64=False) as dst:
+            dst.write(data)
+        return self._added(sop_uid, info)
+
+    def add_file(self, sop_uid, src_path):
+        """Append an instance from a file, streamed, returns its member path (skipped if packed unchanged)"""
+        if self._unchanged(sop_uid, os.path.getsize(src_path), lambda: _file_crc(src_path)):
+            return member_path(self.path, sop_uid)
+        info = zipfile.ZipInfo.from_file(src_path, f"{sop_uid}.dcm")
+        info.compress_type = zipfile.ZIP_STORED
+        with open(src_path, 'rb') as src, self._zip.open(info, 'w', force_zip64=False) as dst:
+            shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+        return self._added(sop_uid, info)
+
+    def write_index(self):
+        tmp_path = index_path(self.path).with_name(index_path(self.path).name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'SeriesInstanceUID': self.series_uid, 'instances': self.instances}, f)
+        os.replace(tmp_path, index_path(self.path))
+
+    def close(self):
+        """Write the central directory, then the index (newer than the pack, so it is trusted)"""
+        if self.closed:
+            return
+        self._zip.close()
+        self.write_index()
+        self.closed = True
+
+
+class PackStore:
+    """Packs being written, shared by the store/sort threads.
+
+    At most max_open packs stay open; the least recently used idle pack is
+    closed first. close() must be called once the transfer is over.
+    """
+
+    def __init__(self, max_open=MAX_OPEN_PACKS):
+        self.max_open = max_open
+        self._lock = threading.Lock()
+        self._packs = OrderedDict()
+
+    @contextmanager
+    def _open(self, path, series_uid=None):
+        with self._lock:
+            pack = self._packs.pop(path, None)
+            if pack is None:
+                pack = SeriesPack(path, series_uid)
+            self._packs[path] = pack
+            pack.users += 1
+            self._evict()
+        try:
+            with pack.lock:
+                if series_uid and not pack.series_uid:
+                    pack.series_uid = series_uid
+                yield pack
+        finally:
+            with self._lock:
+                pack.users -= 1
+
+    def _evict(self):
+        """Close idle packs beyond max_open (caller holds the lock)"""
+        for path in list(self._packs):
+            if len(self._packs) <= self.max_open:
+                return
+            pack = self._packs[path]
+            if pack.users == 0:
+                del self._packs[path]
+                pack.close()
+
+    def add_file(self, series_dir, sop_uid, src_path, series_uid=None):
+        """Append a file to the pack of series_dir, returns its member path"""
+        with self._open(pack_path(series_dir), series_uid) as pack:
+            return pack.add_file(sop_uid, src_path)
+
+    def add_bytes(self, series_dir, sop_uid, data, series_uid=None):
+        """Append an encoded instance to the pack of series_dir, returns its member path"""
+        with self._open(pack_path(series_dir), series_uid) as pack:
+            return pack.add_bytes(sop_uid, data)
+
+    def close(self):
+        """Close every pack, returns the number closed"""
+        with self._lock:
+            packs = list(self._packs.values())
+            self._packs.clear()
+        for pack in packs:
+            with pack.lock:
+                pack.close()
+        return len(packs)
+
+
+class PackReader:
+    """Random access to the instances of a pack by SOPInstanceUID"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        index = load_index(self.path)
+        self.series_uid = index.get('SeriesInstanceUID')
+        self.instances = index['instances']
+        self._file = open(self.path, 'rb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def __contains__(self, sop_uid):
+        return sop_uid in self.instances
+
+    def __len__(self):
+        return len(self.instances)
+
+    def sop_uids(self):
+        return list(self.instances)
+
+    def size(self, sop_uid):
+        return self.instances[sop_uid][1]
+
+    def read(self, sop_uid):
+        """Bytes of the Part 10 file of an instance"""
+        offset, size = self.instances[sop_uid]
+        fd = self._file.fileno()
+        header = os.pread(fd, LOCAL_HEADER.size, offset)
+        fields = LOCAL_HEADER.unpack(header)
+        if fields[0] != LOCAL_HEADER_SIGNATURE:
+            raise zipfile.BadZipFile(f"{self.path}: no member at offset {offset}")
+        return os.pread(fd, size, offset + LOCAL_HEADER.size + fields[10] + fields[11])
+
+    def dataset(self, sop_uid, **kwargs):
+        """pydicom Dataset of an instance (dcmread keyword arguments, e.g. stop_before_pixels)"""
+        import pydicom
+        from pydicom.filebase import DicomBytesIO
+        return pydicom.dcmread(DicomBytesIO(self.read(sop_uid)), **kwargs)
+
+
+def read_member(path):
+    """Bytes of a packed instance given its "<pack>::<SOP>.dcm" path"""
+    pack, sop_uid = split_member(path)
+    with PackReader(pack) as reader:
+        return reader.read(sop_uid)
+
+
+def member_size(path):
+    """Size of a packed instance, None if the pack or the instance is missing"""
+    pack, sop_uid = split_member(path)
+    try:
+        entry = load_index(pack)['instances'].get(sop_uid)
+    except FileNotFoundError:
+        return None
+    return entry[1] if entry else None
+
+
+def path_exists(path):
+    """os.path.exists for plain files and packed instances"""
+    if is_member(path):
+        return member_size(path) is not None
+    return os.path.exists(path)
+
+
+def find_packs(root):
+    """Every pack under root"""
+    return sorted(Path(path) for path in scan_files(str(root)) if path.endswith(PACK_SUFFIX))
+
+
+def pack_series_dir(series_dir, remove=True):
+    """Append the DICOM files of a series folder to its pack.
+
+    Returns (packed, skipped, relocations) where relocations are the
+    (SeriesInstanceUID, SOPInstanceUID, old path, member path) of the packed
+    files. With remove the files (and the folder, once empty) are deleted.
+    """
+    series_dir = Path(series_dir)
+    packed, skipped, relocations = 0, 0, []
+    pack = None
+    try:
+        for path in sorted(scan_files(str(series_dir))):
+            try:
+                ds = read_header(path, MANIFEST_TAGS)
+            except (InvalidDicomError, OSError):
+                skipped += 1
+                continue
+            series_uid = getattr(ds, 'SeriesInstanceUID', None)
+            if pack is None:
+                pack = SeriesPack(pack_path(series_dir), series_uid)
+            member = pack.add_file(ds.SOPInstanceUID, path)
+            relocations.append((series_uid, ds.SOPInstanceUID, path, member))
+            packed += 1
+    finally:
+        if pack is not None:
+            pack.close()
+    if remove:
+        for _, _, path, _ in relocations:
+            os.unlink(path)
+        try:
+            series_dir.rmdir()
+        except OSError:
+            pass
+    return packed, skipped, relocations
+
+
+def unpack_pack(pack, remove=True):
+    """Extract a pack into its series folder (<pack> without .zip).
+
+    Returns (extracted, relocations) with the (SeriesInstanceUID,
+    SOPInstanceUID, member path, file path) of the instances. With remove
+    the pack and its index are deleted.
+    """
+    pack = Path(pack)
+    series_dir = pack.with_name(pack.name[:-len(PACK_SUFFIX)])
+    series_dir.mkdir(parents=True, exist_ok=True)
+    relocations = []
+    with PackReader(pack) as reader:
+        for sop_uid in reader.sop_uids():
+            destination = series_dir / f"{sop_uid}.dcm"
+            tmp_path = destination.with_name(destination.name + '.tmp')
+            with open(tmp_path, 'wb') as f:
+                f.write(reader.read(sop_uid))
+            os.replace(tmp_path, destination)
+            relocations.append((reader.series_uid, sop_uid, member_path(pack, sop_uid), str(destination)))
+    if remove:
+        pack.unlink()
+        index_path(pack).unlink(missing_ok=True)
+    return len(relocations), relocations
+
+
+def series_folders(root):
+    """Series folders of a sorted tree (<PatientID>/<series>), excluding temp and manifest folders"""
+    from dicom.services.export import export_units
+    return [folder for folder, _ in export_units(root, level='series')]
+
+
+class PackReport:
+    def __init__(self):
+        self.packs = 0
+        self.files = 0
+        self.skipped = 0
+        self.errors = []
+        self.elapsed = 0.0
+
+
+def _apply(tasks, function, report, workers, progress, manifest, catalog):
+    """Run function over tasks on a thread pool, following the relocated instances in the manifest and catalog"""
+    start = time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(function, task): task for task in tasks}
+        for future in as_completed(futures):
+            try:
+                files, skipped, relocations = future.result()
+            except Exception as e:
+                report.errors.append((futures[future], f"{type(e).__name__}: {e}"))
+            else:
+                report.packs += 1 if files else 0
+                report.files += files
+                report.skipped += skipped
+                if manifest is not None:
+                    for series_uid, sop_uid, _, path in relocations:
+                        manifest.relocate(series_uid, sop_uid, path)
+                if catalog is not None:
+                    catalog.relocate([(sop_uid, path) for _, sop_uid, _, path in relocations])
+            if progress:
+                progress(1)
+    if manifest is not None:
+        manifest.flush()
+    report.elapsed = time() - start
+    return report
+
+
+def pack_tree(root, workers=4, progress=None, manifest=None, catalog=None, remove=True):
+    """Pack every series folder of a sorted tree, returns a PackReport"""
+    return _apply(series_folders(root), lambda folder: pack_series_dir(folder, remove), PackReport(), workers,
+                  progress, manifest, catalog)
+
+
+def unpack_tree(root, workers=4, progress=None, manifest=None, catalog=None, remove=True):
+    """Restore the series folders of every pack of a tree, returns a PackReport"""
+    def unpack(pack):
+        extracted, relocations = unpack_pack(pack, remove)
+        return extracted, 0, relocations
+    return _apply(find_packs(root), unpack, PackReport(), workers, progress, manifest, catalog)
@@ -0,0 +1,153 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class _SeriesJob:
+    def __init__(self, files, on_done=None):
+        self.files = list(files)
+        self.remaining = len(self.files)
+        self.on_done = on_done
+        # Files that failed pseudonymization or sort
+        self.errors = 0
+        self.done = threading.Event()
+
+
+class SeriesPipeline:
+    """Streams each received series through pseudonymization and the final sort.
+
+    A series is submitted as soon as its C-MOVE has completed, so the
+    post-processing of one series overlaps with the transfer of the next.
+    Both stages run on bounded pools, and `max_pending` caps the number of
+    series in flight: `submit` blocks the transfer threads when the
+    post-processing falls behind. `on_sorted`, if given, receives the
+    sorted paths of each series (e.g. to append them to an archive), and the
+    `on_done` of a submit receives its job once the series is sorted.
+    """
+
+    def __init__(self, sort_file, pseudonymize_file=None, pseudo_workers=5, sort_workers=2, max_pending=8,
+                 on_sorted=None):
+        self.sort_file = sort_file
+        self.pseudonymize_file = pseudonymize_file
+        self.on_sorted = on_sorted
+        self._pseudo_pool = ThreadPoolExecutor(max_workers=pseudo_workers, thread_name_prefix="pseudo")
+        self._sort_pool = ThreadPoolExecutor(max_workers=sort_workers, thread_name_prefix="sort")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self.series_done = 0
+        self.files_sorted = 0
+
+    def submit(self, files, on_done=None):
+        """Queue the files of one completed series, returns a job whose `done` event is set once sorted"""
+        self._slots.acquire()
+        job = _SeriesJob(files, on_done)
+        if self.pseudonymize_file is None or not job.files:
+            self._sort_pool.submit(self._sort_series, job)
+            return job
+
+        for file_path in job.files:
+            future = self._pseudo_pool.submit(self.pseudonymize_file, file_path)
+            future.add_done_callback(lambda future, job=job: self._file_pseudonymized(job, future))
+        return job
+
+    def _file_pseudonymized(self, job, future):
+        failed = future.exception() is not None or future.result() is False
+        with self._lock:
+            job.errors += failed
+            job.remaining -= 1
+            ready = job.remaining == 0
+        if ready:
+            self._sort_pool.submit(self._sort_series, job)
+
+    def _sort_series(self, job):
+        try:
+            sorted_files = []
+            for file_path in job.files:
+                try:
+                    sorted_files.append(self.sort_file(file_path))
+                    with self._lock:
+                        self.files_sorted += 1
+                except Exception as e:
+                    job.errors += 1
+                    logger.error(f"Sort failed for {file_path}: {e}")
+            if self.on_sorted is not None and sorted_files:
+                try:
+                    self.on_sorted(sorted_files)
+                except Exception as e:
+                    job.errors += 1
+                    logger.error(f"Post-sort step failed: {e}")
+        finally:
+            with self._lock:
+                self.series_done += 1
+            self._slots.release()
+            if job.on_done is not None:
+                try:
+                    job.on_done(job)
+                except Exception as e:
+                    logger.error(f"Series completion step failed: {e}")
+            job.done.set()
+
+    def close(self):
+        """Wait for every queued series to go through both stages"""
+        self._pseudo_pool.shutdown(wait=True)
+        self._sort_pool.shutdown(wait=True)
+
+
+class SeriesGroup:
+    """Series of one unit of work (e.g. one queue job) streamed through a pipeline.
+
+    `on_done(errors)` runs once, when the group is closed and every series
+    submitted to it has been sorted, with the number of files that failed
+    on the way. Groups nest: a group can be the pipeline of another one.
+    Without a pipeline, nothing is submitted and on_done runs at close.
+    """
+
+    def __init__(self, pipeline, on_done=None):
+        self.pipeline = pipeline
+        self.on_done = on_done
+        self.errors = 0
+        self._pending = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self.done = threading.Event()
+
+    def submit(self, files, on_done=None):
+        if self.pipeline is None:
+            return None
+        with self._lock:
+            self._pending += 1
+
+        def series_done(job):
+            try:
+                if on_done is not None:
+                    on_done(job)
+            finally:
+                self._series_done(job.errors)
+        return self.pipeline.submit(files, on_done=series_done)
+
+    def _series_done(self, errors):
+        with self._lock:
+            self.errors += errors
+            self._pending -= 1
+            finished = self._closed and self._pending == 0
+        if finished:
+            self._finish()
+
+    def close(self):
+        """No more series for this group: on_done runs now, or once the series in flight are sorted"""
+        with self._lock:
+            self._closed = True
+            finished = self._pending == 0
+        if finished:
+            self._finish()
+
+    def _finish(self):
+        try:
+            if self.on_done is not None:
+                self.on_done(self.errors)
+        except Exception as e:
+            logger.error(f"Group completion step failed: {e}")
+        finally:
+            self.done.set()
@@ -0,0 +1,125 @@
+class CompactRecord:
+    """Compact C-FIND result keeping only the queried keys, in __slots__.
+
+    Attributes use the DICOM keywords so that code written for pydicom
+    identifiers (getattr(ds, 'SeriesInstanceUID', None)) works unchanged.
+    FIELDS maps each keyword to the type its value is converted to.
+    """
+
+    __slots__ = ()
+    FIELDS = {}
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+    @classmethod
+    def _values(cls, identifier):
+        values = {}
+        for keyword, cast in cls.FIELDS.items():
+            raw = getattr(identifier, keyword, None)
+            if raw is None or raw == '':
+                values[keyword] = None
+                continue
+            try:
+                values[keyword] = cast(raw)
+            except (TypeError, ValueError):
+                values[keyword] = None
+        return values
+
+    @classmethod
+    def from_identifier(cls, identifier):
+        """Build a record from a C-FIND identifier (or catalog Dataset)"""
+        return cls(**cls._values(identifier))
+
+    @classmethod
+    def columns(cls):
+        return list(cls.__slots__)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        values = ", ".join(f"{name}={getattr(self, name)}" for name in self.__slots__
+                           if getattr(self, name) is not None)
+        return f"{type(self).__name__}({values})"
+
+    __str__ = __repr__
+
+
+STUDY_FIELDS = {
+    'PatientID': str,
+    'PatientName': str,
+    'StudyInstanceUID': str,
+    'StudyDate': str,
+    'StudyDescription': str,
+    'AccessionNumber': str,
+    'NumberOfStudyRelatedInstances': int,
+}
+SERIES_FIELDS = dict(STUDY_FIELDS, **{
+    'SeriesInstanceUID': str,
+    'SeriesNumber': int,
+    'SeriesDate': str,
+    'SeriesDescription': str,
+    'Modality': str,
+    'NumberOfSeriesRelatedInstances': int,
+})
+
+
+class StudyRecord(CompactRecord):
+    """Compact result of a STUDY-level C-FIND"""
+
+    __slots__ = tuple(STUDY_FIELDS)
+    FIELDS = STUDY_FIELDS
+
+
+class SeriesRecord(CompactRecord):
+    """Compact result of a SERIES-level C-FIND"""
+
+    __slots__ = tuple(SERIES_FIELDS)
+    FIELDS = SERIES_FIELDS
+
+
+class InstanceRecord(CompactRecord):
+    """Compact result of an IMAGE-level C-FIND"""
+
+    __slots__ = ('StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID',
+                 'InstanceNumber', 'EchoTime', 'SOPClassUID')
+    FIELDS = {
+        'StudyInstanceUID': str,
+        'SeriesInstanceUID': str,
+        'SOPInstanceUID': str,
+        'InstanceNumber': int,
+        'EchoTime': float,
+        'SOPClassUID': str,
+    }
+
+    def __init__(self, StudyInstanceUID=None, SeriesInstanceUID=None, SOPInstanceUID=None,
+                 InstanceNumber=None, EchoTime=None, SOPClassUID=None):
+        self.StudyInstanceUID = StudyInstanceUID
+        self.SeriesInstanceUID = SeriesInstanceUID
+        self.SOPInstanceUID = SOPInstanceUID
+        self.InstanceNumber = InstanceNumber
+        self.EchoTime = EchoTime
+        self.SOPClassUID = SOPClassUID
+
+    @classmethod
+    def from_identifier(cls, identifier, study_uid=None, series_uid=None):
+        """Build a record from a C-FIND identifier, keeping only the instance keys"""
+        values = cls._values(identifier)
+        values['StudyInstanceUID'] = values['StudyInstanceUID'] or study_uid
+        values['SeriesInstanceUID'] = values['SeriesInstanceUID'] or series_uid
+        return cls(**values)
+
+    def __repr__(self):
+        return (f"InstanceRecord(SOPInstanceUID={self.SOPInstanceUID}, InstanceNumber={self.InstanceNumber}, "
+                f"EchoTime={self.EchoTime}, SOPClassUID={self.SOPClassUID}, SeriesInstanceUID={self.SeriesInstanceUID})")
+
+    __str__ = __repr__
+
+
+RECORD_CLASSES = {'STUDY': StudyRecord, 'SERIES': SeriesRecord, 'IMAGE': InstanceRecord}
+
+
+def record_class(level):
+    return RECORD_CLASSES[(level or 'STUDY').upper()]
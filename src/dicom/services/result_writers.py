@@ -0,0 +1,96 @@
+"""
+Search Result Writers
+
+Write compact search records (records.py) row by row as JSON lines, CSV or
+Parquet, so that a large inventory is never held in memory or formatted as
+a whole. Parquet needs pyarrow (optional dependency: pip install pyarrow);
+its rows are written in row groups of BATCH_ROWS.
+"""
+
+import csv
+import json
+import sys
+
+FORMATS = ('jsonl', 'csv', 'parquet')
+BATCH_ROWS = 10000
+
+
+class _TextWriter:
+    """Text output to path, or to stdout without path"""
+
+    def __init__(self, path, record_cls):
+        self.path = path
+        self.out = open(path, 'w', encoding='utf-8', newline='') if path else sys.stdout
+        self.columns = record_cls.columns()
+        self.rows = 0
+
+    def close(self):
+        if self.path:
+            self.out.close()
+        else:
+            self.out.flush()
+
+
+class JsonlWriter(_TextWriter):
+    def write(self, record):
+        self.out.write(json.dumps(record.as_dict(), ensure_ascii=False))
+        self.out.write('\n')
+        self.rows += 1
+
+
+class CsvWriter(_TextWriter):
+    def __init__(self, path, record_cls):
+        super().__init__(path, record_cls)
+        self._writer = csv.writer(self.out)
+        self._writer.writerow(self.columns)
+
+    def write(self, record):
+        self._writer.writerow(['' if value is None else value
+                               for value in (getattr(record, name) for name in self.columns)])
+        self.rows += 1
+
+
+class ParquetWriter:
+    def __init__(self, path, record_cls, batch_rows=BATCH_ROWS):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise RuntimeError("Parquet output needs pyarrow (pip install pyarrow)") from e
+        self._pa = pa
+        types = {int: pa.int64(), float: pa.float64()}
+        self.schema = pa.schema([(name, types.get(record_cls.FIELDS.get(name), pa.string()))
+                                 for name in record_cls.columns()])
+        self._writer = pq.ParquetWriter(path, self.schema)
+        self.batch_rows = batch_rows
+        self._columns = {name: [] for name in self.schema.names}
+        self.rows = 0
+
+    def write(self, record):
+        for name, values in self._columns.items():
+            values.append(getattr(record, name))
+        self.rows += 1
+        if self.rows % self.batch_rows == 0:
+            self._flush()
+
+    def _flush(self):
+        if not self._columns[self.schema.names[0]]:
+            return
+        self._writer.write_table(self._pa.Table.from_pydict(self._columns, schema=self.schema))
+        self._columns = {name: [] for name in self.schema.names}
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+WRITERS = {'jsonl': JsonlWriter, 'csv': CsvWriter, 'parquet': ParquetWriter}
+
+
+def open_writer(fmt, record_cls, path=None):
+    """Writer for fmt; path None writes jsonl/csv to stdout (parquet needs a path)"""
+    if fmt not in WRITERS:
+        raise ValueError(f"Unknown format {fmt!r}, expected one of {FORMATS}")
+    if fmt == 'parquet' and not path:
+        raise ValueError("Parquet output needs an output file")
+    return WRITERS[fmt](path, record_cls)
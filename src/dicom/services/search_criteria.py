@@ -1,10 +1,14 @@
+import copy
+
+
 class SearchCriteria:
     def __init__(self, level=None, patient_id=None, patient_name=None,
                  study_date=None, study_description=None, series_description=None,
                  accession_number=None, modality=None, series_instance_uid=None,
                  study_instance_uid=None, patient_birth_date=None, series_date=None,
                  number_of_study_related_instances=None, clinical_pseudo=None,
-                 research_pseudo=None, protocol_pseudo=None, anonymize=None):
+                 research_pseudo=None, protocol_pseudo=None, anonymize=None,
+                 sop_instance_uid=None):
         self.level = level
         self.patient_id = patient_id
         self.patient_name = patient_name
@@ -21,4 +25,82 @@ class SearchCriteria:
         self.clinical_pseudo = clinical_pseudo
         self.research_pseudo = research_pseudo
         self.protocol_pseudo = protocol_pseudo
-        self.anonymize_data = anonymize
\ No newline at end of file
+        self.anonymize_data = anonymize
+        self.sop_instance_uid = sop_instance_uid
+
+
+def uid_list(value):
+    """UIDs of a criteria field as a list, whether it holds one UID, a list or a backslash-separated string"""
+    if not value:
+        return []
+    if isinstance(value, str):
+        return [uid for uid in value.split('\\') if uid]
+    return list(value)
+
+
+def retrieve_batches(criteria, batch_size):
+    """Split a retrieve with lists of Study/Series UIDs into requests of at most batch_size UIDs.
+
+    At SERIES level the StudyInstanceUID of a request must be unique, so the
+    series are grouped by study: study_instance_uid is either a single UID
+    or a list parallel to series_instance_uid.
+    """
+    batch_size = max(1, batch_size or 1)
+
+    def chunks(uids):
+        for start in range(0, len(uids), batch_size):
+            chunk = uids[start:start + batch_size]
+            yield chunk[0] if len(chunk) == 1 else chunk
+
+    study_uids = uid_list(criteria.study_instance_uid)
+    if criteria.level == 'STUDY' and len(study_uids) > 1:
+        for chunk in chunks(study_uids):
+            sub = copy.copy(criteria)
+            sub.study_instance_uid = chunk
+            yield sub
+        return
+
+    series_uids = uid_list(criteria.series_instance_uid)
+    if criteria.level == 'SERIES' and (len(series_uids) > 1 or len(study_uids) > 1):
+        if len(study_uids) == 1:
+            study_uids = study_uids * len(series_uids)
+        if len(study_uids) != len(series_uids):
+            raise ValueError("study_instance_uid must be a single UID or one UID per series")
+        by_study = {}
+        for study_uid, series_uid in zip(study_uids, series_uids):
+            by_study.setdefault(study_uid, []).append(series_uid)
+        for study_uid, uids in by_study.items():
+            for chunk in chunks(uids):
+                sub = copy.copy(criteria)
+                sub.study_instance_uid = study_uid
+                sub.series_instance_uid = chunk
+                yield sub
+        return
+
+    yield criteria
+
+
+def list_matching_rejected(criteria, status, received):
+    """True when a retrieve with several UIDs failed without any instance, i.e. the PACS refused UID list matching"""
+    uids = uid_list(criteria.series_instance_uid if criteria.level == 'SERIES' else criteria.study_instance_uid)
+    if len(uids) < 2 or received or status is None:
+        return False
+    # 0xA900: identifier does not match SOP class, 0xCxxx: unable to process
+    return status == 0xA900 or 0xC000 <= status <= 0xCFFF
+
+
+def retrieve_requests(level, results):
+    """Retrieve criteria for C-FIND results: their Study or Series UIDs packed in one request, one per instance"""
+    if level == 'IMAGE':
+        return [SearchCriteria(level='IMAGE', study_instance_uid=record.StudyInstanceUID,
+                               series_instance_uid=record.SeriesInstanceUID, sop_instance_uid=record.SOPInstanceUID)
+                for record in results]
+    if level == 'SERIES':
+        pairs = [(record.StudyInstanceUID, record.SeriesInstanceUID) for record in results
+                 if getattr(record, 'StudyInstanceUID', None) and getattr(record, 'SeriesInstanceUID', None)]
+        if not pairs:
+            return []
+        return [SearchCriteria(level='SERIES', study_instance_uid=[study_uid for study_uid, _ in pairs],
+                               series_instance_uid=[series_uid for _, series_uid in pairs])]
+    study_uids = [record.StudyInstanceUID for record in results if getattr(record, 'StudyInstanceUID', None)]
+    return [SearchCriteria(level='STUDY', study_instance_uid=study_uids)] if study_uids else []
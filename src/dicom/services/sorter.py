@@ -0,0 +1,227 @@
+"""
+DICOM Sorting Service
+
+Sorts DICOM files into the output_dir/<PatientID>/<SeriesNumber>_<SeriesDescription>
+layout. Only the few header tags needed to build the destination are parsed,
+and the files are spread over a process pool.
+"""
+
+import errno
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from time import time
+
+import pydicom
+from pydicom.errors import InvalidDicomError
+
+from dicom.services.durability import fsync_directory
+
+SORT_TAGS = ['PatientID', 'SeriesNumber', 'SeriesDescription']
+MANIFEST_TAGS = ['SeriesInstanceUID', 'SOPInstanceUID']
+SKIPPED_NAMES = {'Thumbs.db', 'DICOMDIR'}
+FORBIDDEN_CHARS = ['\\', '/', ':', '*', '?', '"', '<', '>', '|']
+COPY_BUFFER_SIZE = 1024 * 1024
+# Forking a process that runs pynetdicom/daemon threads can copy a held lock into the workers:
+# start them from a clean server process (spawn where forkserver is not available, e.g. Windows)
+POOL_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+def process_pool(workers=None):
+    """ProcessPoolExecutor whose workers are not forked from the (possibly multithreaded) caller"""
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(POOL_START_METHOD))
+
+
+def clean_name(name):
+    """Remove characters that are forbidden in Windows folder names."""
+    if not name:
+        return "Unknown"
+    name = str(name)
+    for char in FORBIDDEN_CHARS:
+        name = name.replace(char, '_')
+    return name.strip()
+
+
+def read_header(file_path, tags=SORT_TAGS):
+    """Read only the requested tags, stopping before the pixel data.
+
+    Files without the Part 10 preamble (written by some SCUs) are read
+    again with force=True, and kept if any of the tags was found.
+    """
+    try:
+        return pydicom.dcmread(file_path, stop_before_pixels=True, specific_tags=tags)
+    except InvalidDicomError:
+        dataset = pydicom.dcmread(file_path, stop_before_pixels=True, specific_tags=tags, force=True)
+        if not any(tag in dataset for tag in tags):
+            raise
+        return dataset
+
+
+def header_values(dataset, tags):
+    """Plain {keyword: str} view of the requested tags, cheap to send between processes."""
+    values = {}
+    for tag in tags:
+        value = getattr(dataset, tag, None)
+        values[tag] = None if value is None or value == '' else str(value)
+    return values
+
+
+def series_dir(dataset, dst_root):
+    """Destination folder of an instance in the sorted layout."""
+    p_id = clean_name(getattr(dataset, 'PatientID', 'Unknown'))
+    s_num = getattr(dataset, 'SeriesNumber', '0')
+    s_desc = clean_name(getattr(dataset, 'SeriesDescription', 'NoDesc'))
+    return Path(dst_root) / p_id / f"{s_num}_{s_desc}"
+
+
+def scan_files(root, exclude=None):
+    """Recursively yield the candidate DICOM files under root, skipping the exclude folder."""
+    exclude = os.path.abspath(exclude) if exclude else None
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') or entry.name in SKIPPED_NAMES:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    if exclude and os.path.abspath(entry.path) == exclude:
+                        continue
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry.path
+
+
+def place_file(src, dst, mode='move'):
+    """Move, hardlink or copy src to dst.
+
+    Renames and hardlinks only work within a filesystem, so when src and dst
+    are on different devices the file is stream-copied instead (and the
+    source removed in 'move' mode). Nothing is done when dst already is src
+    (re-sorting a sorted tree).
+    """
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    try:
+        if mode == 'move':
+            os.replace(src, dst)
+            return
+        if mode == 'link':
+            if os.path.exists(dst):
+                os.unlink(dst)
+            os.link(src, dst)
+            return
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        shutil.copyfileobj(fsrc, fdst, COPY_BUFFER_SIZE)
+    shutil.copystat(src, dst)
+    if mode == 'move':
+        os.unlink(src)
+
+
+def sort_file(file_path, dst_root, mode='move', tags=SORT_TAGS):
+    """Place one file in the sorted layout, returns its destination and the header read."""
+    dataset = read_header(file_path, tags)
+    target_dir = series_dir(dataset, dst_root)
+    target_dir.mkdir(parents=True, exist_ok=True)
+    destination = target_dir / os.path.basename(file_path)
+    place_file(file_path, destination, mode)
+    return destination, dataset
+
+
+def _sort_chunk(paths, dst_root, mode, tags, collect, fsync=False):
+    """Worker entry point: sort a chunk of files, returns (sorted, skipped, errors, headers)."""
+    done, skipped, errors, headers = 0, 0, [], []
+    directories = set()
+    for path in paths:
+        try:
+            destination, dataset = sort_file(path, dst_root, mode, tags)
+            done += 1
+            if fsync:
+                directories.update((destination.parent, os.path.dirname(path)))
+            if collect:
+                headers.append((header_values(dataset, tags), str(destination)))
+        except InvalidDicomError:
+            skipped += 1
+        except Exception as e:
+            errors.append((path, f"{type(e).__name__}: {e}"))
+    # The renames of the chunk survive a crash once their folders are synced, once per folder
+    for directory in directories:
+        fsync_directory(directory)
+    return done, skipped, errors, headers
+
+
+class SortReport:
+    def __init__(self):
+        self.sorted = 0
+        self.skipped = 0
+        self.errors = []
+        self.elapsed = 0.0
+
+    @property
+    def files_per_second(self):
+        return self.sorted / self.elapsed if self.elapsed else 0.0
+
+
+def sort_tree(src_root, dst_root, mode='move', workers=None, chunk_size=256, progress=None, catalog=None,
+              manifest=None, fsync=False, on_sorted=None):
+    """Sort every DICOM file under src_root into dst_root using a process pool.
+
+    Args:
+        src_root: Folder to scan (e.g. output_dir/temp_transit or a third-party export)
+        dst_root: Root of the sorted layout
+        mode: 'move' (rename), 'link' (hardlink, source kept) or 'copy'
+        workers: Number of worker processes (default: CPU count)
+        chunk_size: Number of files handed to a worker at once
+        progress: Optional callable receiving the number of files processed per chunk
+        catalog: Optional LocalCatalog updated with the sorted instances
+        manifest: Optional ManifestStore whose paths follow the moved files (flushed by the caller)
+        fsync: fsync the source and destination folders of each chunk (durable mode)
+        on_sorted: Optional callable receiving the destination paths of each chunk (e.g. an archive export)
+
+    Returns:
+        SortReport with counts, errors and throughput
+    """
+    start = time()
+    report = SortReport()
+    dst_root = str(dst_root)
+    tags = catalog.TAGS if catalog is not None else SORT_TAGS
+    if manifest is not None:
+        tags = tags + [tag for tag in MANIFEST_TAGS if tag not in tags]
+    collect = catalog is not None or manifest is not None or on_sorted is not None
+
+    with process_pool(workers) as executor:
+        futures = []
+        chunk = []
+        for path in scan_files(str(src_root), exclude=dst_root):
+            chunk.append(path)
+            if len(chunk) >= chunk_size:
+                futures.append(executor.submit(_sort_chunk, chunk, dst_root, mode, tags, collect, fsync))
+                chunk = []
+        if chunk:
+            futures.append(executor.submit(_sort_chunk, chunk, dst_root, mode, tags, collect, fsync))
+
+        for future in futures:
+            done, skipped, errors, headers = future.result()
+            if headers and catalog is not None:
+                catalog.add_many(headers)
+            if manifest is not None:
+                for values, destination in headers:
+                    manifest.relocate(values['SeriesInstanceUID'], values['SOPInstanceUID'], destination)
+            if headers and on_sorted is not None:
+                try:
+                    on_sorted([destination for _, destination in headers])
+                except Exception as e:
+                    report.errors.append((headers[0][1], f"{type(e).__name__}: {e}"))
+            report.sorted += done
+            report.skipped += skipped
+            report.errors.extend(errors)
+            if progress:
+                progress(done + skipped + len(errors))
+
+    report.elapsed = time() - start
+    return report
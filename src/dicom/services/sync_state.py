@@ -0,0 +1,131 @@
+"""
+Incremental Sync State
+
+Remembers, for each (patient, series pattern), the last successful sync and
+the series already transferred, so that a re-run of the same cohort only
+queries the studies dated since then and only moves the series it has not
+got yet.
+
+The C-FIND of a sync covers StudyDate >= (last sync day - lookback days):
+studies are often archived days after their StudyDate, the lookback keeps
+them in the query window. The series found are then diffed against the
+series already synced (and the local catalog), and only the new ones are
+moved. A series counts as synced once received and through the pipeline
+(pseudonymized, sorted), and the checkpoint moves forward only when every
+new series of the (patient, pattern) is.
+
+The state is a SQLite database (rollback journal, it may be shared by
+workers on several hosts), every update is one transaction: a run killed
+halfway keeps the checkpoints of the work that completed.
+"""
+
+import sqlite3
+import threading
+from datetime import date, timedelta
+from pathlib import Path
+from time import time
+
+DATE_FORMAT = "%Y%m%d"
+LOOKBACK_DAYS = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoints (
+    patient_id TEXT NOT NULL,
+    pattern TEXT NOT NULL,
+    synced_through TEXT NOT NULL,
+    updated REAL,
+    PRIMARY KEY (patient_id, pattern)
+);
+CREATE TABLE IF NOT EXISTS synced_series (
+    patient_id TEXT NOT NULL,
+    series_uid TEXT NOT NULL,
+    study_uid TEXT,
+    pattern TEXT,
+    synced REAL,
+    PRIMARY KEY (patient_id, series_uid)
+);
+"""
+
+
+class SyncState:
+    """SQLite checkpoints of the incremental sync"""
+
+    def __init__(self, db_path, lookback_days=LOOKBACK_DAYS):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.lookback_days = lookback_days
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(db_path), timeout=30, isolation_level=None, check_same_thread=False)
+        # Rollback journal: WAL needs shared memory on one host, output_dir may be on a network share
+        self._conn.execute("PRAGMA journal_mode=DELETE")
+        self._conn.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def checkpoint(self, patient_id, pattern):
+        """Day (YYYYMMDD) of the last successful sync of (patient, pattern), None if never synced"""
+        with self._lock:
+            row = self._conn.execute("SELECT synced_through FROM checkpoints WHERE patient_id = ? AND pattern = ?",
+                                     (patient_id, pattern)).fetchone()
+        return row[0] if row else None
+
+    def study_date_range(self, patient_id, pattern):
+        """StudyDate range matching for the next query, None (everything) on the first sync"""
+        synced_through = self.checkpoint(patient_id, pattern)
+        if synced_through is None:
+            return None
+        start = date(int(synced_through[:4]), int(synced_through[4:6]), int(synced_through[6:8]))
+        return f"{(start - timedelta(days=self.lookback_days)).strftime(DATE_FORMAT)}-"
+
+    def synced_series(self, patient_id, series_uids):
+        """Those of series_uids already transferred for the patient"""
+        series_uids = list(series_uids)
+        known = set()
+        with self._lock:
+            # SQLite limits the number of bound parameters per statement
+            for start in range(0, len(series_uids), 500):
+                chunk = series_uids[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT series_uid FROM synced_series WHERE patient_id = ? "
+                    f"AND series_uid IN ({', '.join('?' * len(chunk))})", [patient_id, *chunk])
+                known.update(row[0] for row in rows)
+        return known
+
+    def _write(self, statements):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for sql, params in statements:
+                    self._conn.executemany(sql, params)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def record_series(self, patient_id, pattern, series):
+        """Record transferred (StudyInstanceUID, SeriesInstanceUID) pairs"""
+        now = time()
+        self._write([("INSERT OR REPLACE INTO synced_series VALUES (?, ?, ?, ?, ?)",
+                      [(patient_id, series_uid, study_uid, pattern, now) for study_uid, series_uid in series])])
+
+    def advance(self, patient_id, pattern, series=(), synced_through=None):
+        """Record the transferred series and move the checkpoint forward, in one transaction"""
+        now = time()
+        synced_through = synced_through or date.today().strftime(DATE_FORMAT)
+        self._write([
+            ("INSERT OR REPLACE INTO synced_series VALUES (?, ?, ?, ?, ?)",
+             [(patient_id, series_uid, study_uid, pattern, now) for study_uid, series_uid in series]),
+            ("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?)",
+             [(patient_id, pattern, synced_through, now)]),
+        ])
+
+    def reset(self, patient_ids=None):
+        """Forget the checkpoints (of some patients): their next sync queries everything again"""
+        if patient_ids is None:
+            self._write([("DELETE FROM checkpoints", [()]), ("DELETE FROM synced_series", [()])])
+            return
+        rows = [(p_id,) for p_id in patient_ids]
+        self._write([("DELETE FROM checkpoints WHERE patient_id = ?", rows),
+                     ("DELETE FROM synced_series WHERE patient_id = ?", rows)])
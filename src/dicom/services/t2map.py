@@ -0,0 +1,201 @@
+"""
+T2 Mapping
+
+Mono-exponential fit S(TE) = S0 * exp(-TE / T2) of multi-echo series (the
+17-echo "T2mapping 2D TRA" acquisitions), voxel-wise but vectorized: the
+echo stack of a whole chunk of voxels is fitted at once with weighted
+log-linear least squares (closed form, no per-voxel loop). The volume is
+read memory-mapped (see volume.py) and processed in chunks of voxels, so
+memory stays bounded whatever the series size.
+
+Optional noise floor: the magnitude signal is corrected in quadrature,
+sqrt(S^2 - floor^2), and echoes below floor_factor * floor are left out of
+the fit of that voxel.
+
+The maps are written next to the source series, in a sibling folder
+<series folder>_T2map, as NumPy arrays (T2map.npy, S0map.npy, T2map.json)
+or as a derived DICOM series (T2 in ms, RescaleSlope 0.1).
+"""
+
+import json
+import logging
+from concurrent.futures import as_completed
+from pathlib import Path
+
+import numpy as np
+import pydicom
+from pydicom.uid import generate_uid
+
+from dicom.services.sorter import process_pool, scan_files
+from dicom.services.volume import find_series_dirs, load_volume
+
+T2MAP_SUFFIX = '_T2map'
+T2MAP_PATTERN = '*T2mapping*'
+CHUNK_VOXELS = 1 << 16
+MAX_T2 = 1000.0
+DICOM_T2_SCALE = 10.0
+
+
+def estimate_noise_floor(first_echo, background_fraction=0.05):
+    """Noise sigma from the darkest voxels of the first echo (Rayleigh background: mean = sigma * 1.2533)"""
+    values = np.asarray(first_echo, dtype=np.float64).ravel()
+    count = max(int(values.size * background_fraction), 1)
+    background = np.partition(values, count - 1)[:count]
+    return float(background.mean() / np.sqrt(np.pi / 2))
+
+
+def fit_chunk(signal, echo_times, noise_floor=None, floor_factor=2.0, max_t2=MAX_T2):
+    """Fit a (echoes, voxels) block, returns (T2, S0) float32 arrays of shape (voxels,).
+
+    Weighted least squares on ln(S): the weights S^2 compensate the
+    variance of the log transform. Voxels with fewer than two usable
+    echoes, or a non-decaying signal, get T2 = 0.
+    """
+    signal = signal.astype(np.float64, copy=False)
+    te = np.asarray(echo_times, dtype=np.float64)[:, None]
+
+    if noise_floor:
+        usable = signal > floor_factor * noise_floor
+        signal = np.sqrt(np.maximum(signal * signal - noise_floor * noise_floor, 0.0))
+    else:
+        usable = signal > 0
+    safe = np.where(usable, signal, 1.0)
+    log_signal = np.log(safe)
+    weights = np.where(usable, safe * safe, 0.0)
+
+    sw = weights.sum(axis=0)
+    sx = (weights * te).sum(axis=0)
+    sy = (weights * log_signal).sum(axis=0)
+    sxx = (weights * te * te).sum(axis=0)
+    sxy = (weights * te * log_signal).sum(axis=0)
+    denominator = sw * sxx - sx * sx
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (sw * sxy - sx * sy) / denominator
+        intercept = (sy - slope * sx) / sw
+        t2 = -1.0 / slope
+        s0 = np.exp(intercept)
+
+    valid = (usable.sum(axis=0) >= 2) & (denominator > 0) & (slope < 0) & np.isfinite(t2)
+    t2 = np.where(valid, np.clip(t2, 0.0, max_t2), 0.0)
+    s0 = np.where(valid, s0, 0.0)
+    return t2.astype(np.float32), s0.astype(np.float32)
+
+
+def fit_volume(echoes, echo_times, noise_floor=None, floor_factor=2.0, chunk_voxels=CHUNK_VOXELS,
+               skip_echoes=0, max_t2=MAX_T2):
+    """Fit a (echoes, slices, rows, columns) stack chunk by chunk, returns (T2, S0) maps"""
+    n_echoes = echoes.shape[0]
+    spatial = echoes.shape[1:]
+    flat = echoes.reshape(n_echoes, -1)
+    echo_times = list(echo_times)[skip_echoes:]
+    t2 = np.zeros(flat.shape[1], dtype=np.float32)
+    s0 = np.zeros(flat.shape[1], dtype=np.float32)
+    for start in range(0, flat.shape[1], chunk_voxels):
+        stop = start + chunk_voxels
+        t2[start:stop], s0[start:stop] = fit_chunk(flat[skip_echoes:, start:stop], echo_times,
+                                                   noise_floor, floor_factor, max_t2)
+    return t2.reshape(spatial), s0.reshape(spatial)
+
+
+def output_dir_for(series_dir):
+    series_dir = Path(series_dir)
+    return series_dir.with_name(series_dir.name + T2MAP_SUFFIX)
+
+
+def _write_numpy(out_dir, t2, s0, geometry, fit):
+    np.save(out_dir / 'T2map.npy', t2)
+    np.save(out_dir / 'S0map.npy', s0)
+    sidecar = {key: geometry[key] for key in ('series_instance_uid', 'series_description', 'pixel_spacing',
+                                              'slice_spacing', 'slice_positions', 'image_orientation', 'affine')}
+    sidecar.update(fit, shape=list(t2.shape), unit='ms')
+    with open(out_dir / 'T2map.json', 'w', encoding='utf-8') as f:
+        json.dump(sidecar, f, indent=1)
+
+
+def _write_dicom(out_dir, series_dir, t2, geometry):
+    """One derived MR image per slice, header copied from the first-echo source slice"""
+    series_uid = generate_uid()
+    paths = [Path(path) for path in scan_files(str(series_dir))]
+    sources = {path.stem: path for path in paths}
+    if not all(sop_uid in sources for sop_uid in geometry['sop_instance_uids'][0]):
+        # Files not named <SOPInstanceUID>.dcm
+        sources = {str(pydicom.dcmread(path, stop_before_pixels=True, specific_tags=['SOPInstanceUID']).SOPInstanceUID): path
+                   for path in paths}
+    pixels = np.clip(np.rint(t2 * DICOM_T2_SCALE), 0, 65535).astype(np.uint16)
+    for index, sop_uid in enumerate(geometry['sop_instance_uids'][0]):
+        ds = pydicom.dcmread(sources[sop_uid], stop_before_pixels=True)
+        ds.SeriesInstanceUID = series_uid
+        ds.SOPInstanceUID = generate_uid()
+        ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+        ds.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+        ds.SeriesNumber = int(getattr(ds, 'SeriesNumber', 0) or 0) + 1000
+        ds.SeriesDescription = f"{getattr(ds, 'SeriesDescription', '')} T2map".strip()
+        ds.ImageType = ['DERIVED', 'SECONDARY', 'T2_MAP']
+        ds.InstanceNumber = index + 1
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 16, 15, 0
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.RescaleSlope = 1.0 / DICOM_T2_SCALE
+        ds.RescaleIntercept = 0
+        ds.RescaleType = 'ms'
+        for keyword in ('EchoTime', 'EchoNumbers', 'WindowCenter', 'WindowWidth'):
+            if keyword in ds:
+                delattr(ds, keyword)
+        ds.add_new('PixelData', 'OW', pixels[index].tobytes())
+        ds.save_as(out_dir / f"{ds.SOPInstanceUID}.dcm", enforce_file_format=True)
+
+
+def fit_series(series_dir, root=None, fmt='npy', noise_floor=None, floor_factor=2.0, skip_echoes=0,
+               chunk_voxels=CHUNK_VOXELS):
+    """Fit the T2 map of one series folder and write it next to it, returns (output folder, fitted voxels)
+
+    noise_floor: None (no correction), a value in stored pixel units, or 'auto'.
+    """
+    volume = load_volume(series_dir, root=root)
+    if volume.array.ndim != 4 or volume.array.shape[0] - skip_echoes < 2:
+        raise ValueError(f"{series_dir}: at least two echoes are needed, got {volume.echo_times}")
+    echoes = volume.array
+    if noise_floor == 'auto':
+        noise_floor = estimate_noise_floor(echoes[skip_echoes])
+    elif noise_floor is not None:
+        noise_floor = float(noise_floor)
+
+    t2, s0 = fit_volume(echoes, volume.echo_times, noise_floor, floor_factor, chunk_voxels, skip_echoes)
+
+    out_dir = output_dir_for(series_dir)
+    out_dir.mkdir(exist_ok=True)
+    fit = {'model': 'mono-exponential, weighted log-linear', 'echo_times': volume.echo_times[skip_echoes:],
+           'noise_floor': noise_floor, 'floor_factor': floor_factor, 'skip_echoes': skip_echoes}
+    if fmt == 'dicom':
+        _write_dicom(out_dir, series_dir, t2, volume.geometry)
+    else:
+        _write_numpy(out_dir, t2, s0, volume.geometry, fit)
+    return str(out_dir), int(np.count_nonzero(t2))
+
+
+def t2_series_dirs(root, pattern=T2MAP_PATTERN, patients=None):
+    """Multi-echo series folders of a sorted tree, without the T2 map folders themselves"""
+    dirs = [path for path in find_series_dirs(root, pattern) if not path.name.endswith(T2MAP_SUFFIX)]
+    if patients is not None:
+        patients = set(patients)
+        dirs = [path for path in dirs if path.parent.name in patients]
+    return dirs
+
+
+def fit_series_tree(series_dirs, workers=None, progress=None, **kwargs):
+    """Fit several series over a process pool, returns ([(series, output, voxels)], [(series, error)])"""
+    done, errors = [], []
+    with process_pool(workers) as executor:
+        futures = {executor.submit(fit_series, str(series_dir), **kwargs): series_dir for series_dir in series_dirs}
+        for future in as_completed(futures):
+            series_dir = futures[future]
+            try:
+                out_dir, voxels = future.result()
+                done.append((str(series_dir), out_dir, voxels))
+            except Exception as e:
+                logging.error(f"T2 fit failed for {series_dir}: {e}")
+                errors.append((str(series_dir), f"{type(e).__name__}: {e}"))
+            if progress:
+                progress(1)
+    return done, errors
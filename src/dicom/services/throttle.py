@@ -0,0 +1,175 @@
+"""
+Bandwidth Throttling
+
+Token buckets on the received bytes/s and instances/s of the storage
+handlers. Sleeping in the C-STORE handler delays the response to the PACS,
+which paces the whole transfer. The limits follow a time-of-day schedule,
+e.g. 20 MB/s during clinical hours and unlimited at night.
+"""
+
+import threading
+from datetime import datetime, time as dtime
+from time import monotonic, sleep
+
+MB = 1024 * 1024
+
+
+class TokenBucket:
+    """Token bucket allowing short bursts of `burst` seconds worth of tokens"""
+
+    def __init__(self, rate=None, burst=1.0):
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._last = monotonic()
+        self.rate = None
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        """Change the rate (None for unlimited)"""
+        if rate is not None and rate <= 0:
+            raise ValueError(f"Invalid rate {rate}, expected a positive rate or None for unlimited")
+        with self._lock:
+            if rate != self.rate:
+                previous, self.rate = self.rate, rate
+                # A bucket that was unlimited starts full
+                self._tokens = self._capacity() if previous is None else min(self._tokens, self._capacity())
+                self._last = monotonic()
+
+    def _capacity(self):
+        return self.rate * self.burst if self.rate else 0.0
+
+    def reserve(self, amount):
+        """Take `amount` tokens without waiting, returns the seconds to wait before using them"""
+        with self._lock:
+            if self.rate is None:
+                return 0.0
+            now = monotonic()
+            self._tokens = min(self._capacity(), self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Tokens may go negative: the caller waits for its own debt, later callers queue behind it
+            self._tokens -= amount
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def consume(self, amount):
+        """Take `amount` tokens, sleeping as long as needed. Returns the time slept."""
+        wait = self.reserve(amount)
+        if wait > 0:
+            sleep(wait)
+        return wait
+
+
+class ThrottleWindow:
+    """Limits applied between two times of day (the window may span midnight)"""
+
+    def __init__(self, start, end, bytes_per_second=None, instances_per_second=None):
+        self.start = start
+        self.end = end
+        self.bytes_per_second = bytes_per_second
+        self.instances_per_second = instances_per_second
+
+    def contains(self, moment):
+        if self.start <= self.end:
+            return self.start <= moment < self.end
+        return moment >= self.start or moment < self.end
+
+
+def parse_window(spec):
+    """Parse 'HH:MM-HH:MM=<MB/s>[,<instances/s>]', 'unlimited' or '-' meaning no limit.
+
+    Example: '08:00-19:00=20' for 20 MB/s during the day, '08:00-19:00=20,50'
+    to also cap the transfer at 50 instances/s.
+    """
+    try:
+        hours, limits = spec.split('=', 1)
+        start, end = (dtime.fromisoformat(part.strip()) for part in hours.split('-', 1))
+        values = [value.strip() for value in limits.split(',')]
+        values += [''] * (2 - len(values))
+    except ValueError:
+        raise ValueError(f"Invalid throttle window {spec!r}, expected HH:MM-HH:MM=<MB/s>[,<instances/s>]")
+
+    def limit(value, scale):
+        if value in ('', '-', 'unlimited'):
+            return None
+        try:
+            rate = float(value)
+        except ValueError:
+            raise ValueError(f"Invalid throttle window {spec!r}, expected HH:MM-HH:MM=<MB/s>[,<instances/s>]")
+        if rate <= 0:
+            raise ValueError(f"Invalid throttle window {spec!r}: limits must be positive, "
+                             f"'unlimited' (or '-') means no limit")
+        return rate * scale
+
+    return ThrottleWindow(start, end, limit(values[0], MB), limit(values[1], 1))
+
+
+class ThrottleSchedule:
+    """Ordered list of windows, the first one containing the current time applies"""
+
+    def __init__(self, windows=()):
+        self.windows = [parse_window(window) if isinstance(window, str) else window for window in windows]
+
+    def limits_at(self, moment=None):
+        """(bytes/s, instances/s) in force at a time of day, None meaning unlimited"""
+        moment = moment or datetime.now().time()
+        for window in self.windows:
+            if window.contains(moment):
+                return window.bytes_per_second, window.instances_per_second
+        return None, None
+
+    def __bool__(self):
+        return bool(self.windows)
+
+
+class Throttler:
+    """Paces the storage handlers according to a ThrottleSchedule and reports the effective rate"""
+
+    def __init__(self, schedule):
+        self.schedule = schedule if isinstance(schedule, ThrottleSchedule) else ThrottleSchedule(schedule)
+        self.byte_bucket = TokenBucket()
+        self.instance_bucket = TokenBucket()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.instances = 0
+        # Wall-clock time during which at least one handler was waiting
+        self.throttled_seconds = 0.0
+        self._waiting = 0
+        self._waiting_since = 0.0
+        self._started = None
+
+    def throttle(self, nbytes):
+        """Account for one received instance of `nbytes` and wait if over the current limits"""
+        bytes_rate, instance_rate = self.schedule.limits_at()
+        self.byte_bucket.set_rate(bytes_rate)
+        self.instance_bucket.set_rate(instance_rate)
+        with self._lock:
+            if self._started is None:
+                self._started = monotonic()
+            self.bytes += nbytes
+            self.instances += 1
+        # Both buckets are refilled while waiting: the longer wait satisfies the two limits
+        wait = max(self.byte_bucket.reserve(nbytes), self.instance_bucket.reserve(1))
+        if wait <= 0:
+            return 0.0
+        with self._lock:
+            if self._waiting == 0:
+                self._waiting_since = monotonic()
+            self._waiting += 1
+        try:
+            sleep(wait)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+                if self._waiting == 0:
+                    self.throttled_seconds += monotonic() - self._waiting_since
+        return wait
+
+    def report(self):
+        """One-line summary of the effective rate and the time spent throttled"""
+        elapsed = monotonic() - self._started if self._started is not None else 0.0
+        mb_per_second = self.bytes / MB / elapsed if elapsed else 0.0
+        instances_per_second = self.instances / elapsed if elapsed else 0.0
+        return (f"{self.instances} instances, {self.bytes / MB:.1f} MB in {elapsed:.1f}s "
+                f"({mb_per_second:.2f} MB/s, {instances_per_second:.1f} instances/s), "
+                f"throttled {self.throttled_seconds:.1f}s")
+
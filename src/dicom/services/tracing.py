@@ -0,0 +1,186 @@
+"""
+Span Tracing
+
+Lightweight spans around the stages of a transfer (C-FIND, C-MOVE, store
+handlers, pseudonymization, sort), written as a Chrome trace file that
+opens in chrome://tracing or https://ui.perfetto.dev:
+
+    with span('move.request', node=node.name):
+        ...
+
+    @traced('find.search_data')
+    def search_data(self, criteria): ...
+
+Tracing is off by default and a span then costs one attribute lookup.
+Once enabled, the events are appended to the trace file every
+FLUSH_EVENTS spans, so memory does not grow with the length of the run;
+only per-stage totals (count, time, longest span) are kept for the
+summary. With profiling on, every outermost span of a thread also runs under
+cProfile and the statistics are accumulated per stage, one .prof file per
+stage (readable with pstats or snakeviz).
+"""
+
+import cProfile
+import functools
+import json
+import logging
+import os
+import pstats
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from time import perf_counter_ns, strftime
+
+logger = logging.getLogger(__name__)
+
+
+FLUSH_EVENTS = 10000
+
+
+class Tracer:
+    def __init__(self, flush_events=FLUSH_EVENTS):
+        self.enabled = False
+        self.profiling = False
+        self.flush_events = flush_events
+        # Events not yet written to the trace file
+        self._events = []
+        # span name -> [count, total seconds, max seconds]
+        self._totals = {}
+        self._threads = {}
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._local = threading.local()
+        self._origin = perf_counter_ns()
+        self._stem = None
+        self._stream = None
+        self._written = 0
+
+    def enable(self, profile=False, directory='traces', prefix='trace'):
+        """Start recording into <directory>/<prefix>-<time>.trace.json"""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            self._stem = directory / f"{prefix}-{strftime('%Y%m%d-%H%M%S')}"
+            self._stream = open(f"{self._stem}.trace.json", 'w', encoding='utf-8')
+            self._stream.write('{"displayTimeUnit": "ms", "traceEvents": [\n')
+            self._written = 0
+        self.profiling = profile
+        self._origin = perf_counter_ns()
+        self.enabled = True
+
+    def _start_profile(self):
+        """cProfile for the outermost span of this thread, None if nested or unavailable"""
+        if not self.profiling or getattr(self._local, 'profiling', False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python >= 3.12: a single profiler at a time, another thread is being profiled
+            return None
+        self._local.profiling = True
+        return profile
+
+    def _stop_profile(self, name, profile):
+        profile.disable()
+        self._local.profiling = False
+        with self._lock:
+            if name in self._stats:
+                self._stats[name].add(profile)
+            else:
+                self._stats[name] = pstats.Stats(profile)
+
+    def _flush(self):
+        """Append the pending events to the trace file (caller holds the lock)"""
+        if self._stream is None or not self._events:
+            return
+        for event in self._events:
+            self._stream.write((',\n' if self._written else '') + json.dumps(event))
+            self._written += 1
+        self._events.clear()
+
+    @contextmanager
+    def span(self, name, **args):
+        if not self.enabled:
+            yield
+            return
+        profile = self._start_profile()
+        start = perf_counter_ns()
+        try:
+            yield
+        finally:
+            end = perf_counter_ns()
+            if profile is not None:
+                self._stop_profile(name, profile)
+            tid = threading.get_ident()
+            event = {'name': name, 'cat': name.split('.', 1)[0], 'ph': 'X', 'pid': os.getpid(),
+                     'tid': tid, 'ts': (start - self._origin) / 1000, 'dur': (end - start) / 1000}
+            if args:
+                event['args'] = {key: str(value) for key, value in args.items()}
+            seconds = (end - start) / 1e9
+            with self._lock:
+                totals = self._totals.setdefault(name, [0, 0.0, 0.0])
+                totals[0] += 1
+                totals[1] += seconds
+                totals[2] = max(totals[2], seconds)
+                if tid not in self._threads:
+                    self._threads[tid] = threading.current_thread().name
+                self._events.append(event)
+                if len(self._events) >= self.flush_events:
+                    self._flush()
+
+    def summary(self):
+        """{span name: (count, total seconds, max seconds)}"""
+        with self._lock:
+            return {name: tuple(totals) for name, totals in self._totals.items()}
+
+    def write(self):
+        """Finish the trace file and, when profiling, write one .prof per stage. Returns the paths.
+
+        Recording stops: spans started later are not traced.
+        """
+        self.enabled = False
+        with self._lock:
+            if self._stream is None:
+                return []
+            self._flush()
+            pid = os.getpid()
+            for tid, name in self._threads.items():
+                self._events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}})
+            self._flush()
+            self._stream.write('\n]}\n')
+            self._stream.close()
+            self._stream = None
+            stem, stats = self._stem, dict(self._stats)
+        paths = [Path(f"{stem}.trace.json")]
+        for name, stage_stats in stats.items():
+            path = Path(f"{stem}.{name}.prof")
+            stage_stats.dump_stats(path)
+            paths.append(path)
+        return paths
+
+    def log_summary(self, log=logger.info):
+        for name, (count, total, longest) in sorted(self.summary().items(), key=lambda item: -item[1][1]):
+            log(f"{name:<28} {count:>7} spans  {total:>9.2f} s total  {total / count * 1000:>9.1f} ms mean  "
+                f"{longest * 1000:>9.1f} ms max")
+
+
+tracer = Tracer()
+
+
+def span(name, **args):
+    """Context manager timing a block under name (no-op while tracing is off)"""
+    return tracer.span(name, **args)
+
+
+def traced(name):
+    """Decorator: the whole call is one span"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return function(*args, **kwargs)
+            with tracer.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
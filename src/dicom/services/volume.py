@@ -0,0 +1,215 @@
+"""
+Series Volumes
+
+Assembles a sorted series folder into a NumPy array of shape
+(echoes, slices, rows, columns), or (slices, rows, columns) for a single
+echo. Slices are ordered along the slice normal by ImagePositionPatient and
+grouped by EchoTime (EchoNumbers when EchoTime is missing).
+
+The array is cached next to the series as a .npy file, loaded memory-mapped
+(no copy in RAM), with a JSON geometry sidecar:
+
+    <series folder>/.volume.npy
+    <series folder>/.volume.json
+
+The cache is rebuilt when the series changes: its fingerprint is the series
+manifest (output_dir/.manifests) or, without manifest, the names, sizes and
+modification times of the files.
+"""
+
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pydicom
+
+from dicom.services.manifest import ManifestStore
+from dicom.services.sorter import scan_files
+
+VOLUME_FILE = '.volume.npy'
+GEOMETRY_FILE = '.volume.json'
+GEOMETRY_TAGS = ['SeriesInstanceUID', 'SOPInstanceUID', 'ImagePositionPatient', 'ImageOrientationPatient',
+                 'PixelSpacing', 'SliceThickness', 'EchoTime', 'EchoNumbers', 'Rows', 'Columns',
+                 'RescaleSlope', 'RescaleIntercept', 'InstanceNumber', 'SeriesDescription']
+
+
+class SeriesVolume:
+    """A cached series volume: `array` (read-only memmap) and its `geometry`"""
+
+    def __init__(self, array, geometry, path):
+        self.array = array
+        self.geometry = geometry
+        self.path = path
+
+    @property
+    def echo_times(self):
+        return self.geometry['echo_times']
+
+    @property
+    def affine(self):
+        """4x4 voxel (column, row, slice) to patient (LPS, mm) matrix"""
+        return np.array(self.geometry['affine'])
+
+    def echo(self, index):
+        """(slices, rows, columns) view of one echo"""
+        return self.array[index] if self.array.ndim == 4 else self.array
+
+    def __repr__(self):
+        return (f"SeriesVolume({self.geometry.get('series_description')}, shape={self.array.shape}, "
+                f"dtype={self.array.dtype}, echoes={len(self.echo_times)})")
+
+
+def _fingerprint(series_dir, files, root):
+    """Hash of the series manifest, or of the file listing when there is no manifest"""
+    digest = hashlib.sha256()
+    series_uids = set()
+    for path in files[:1]:
+        series_uids.add(str(pydicom.dcmread(path, stop_before_pixels=True,
+                                            specific_tags=['SeriesInstanceUID']).SeriesInstanceUID))
+    store = ManifestStore(root)
+    instances = {}
+    for series_uid in series_uids:
+        instances.update(store.instances(series_uid))
+    names = {os.path.basename(path) for path in files}
+    entries = sorted((sop_uid, entry['hash']) for sop_uid, entry in instances.items()
+                     if os.path.basename(entry['path']) in names)
+    if entries and len(entries) == len(files):
+        digest.update(b'manifest')
+        for sop_uid, file_hash in entries:
+            digest.update(f"{sop_uid}:{file_hash}\n".encode())
+    else:
+        digest.update(b'stat')
+        for path in sorted(files):
+            stat = os.stat(path)
+            digest.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def _slice_geometry(headers):
+    """Unit slice normal and position of each header along it"""
+    orientation = np.array(headers[0].ImageOrientationPatient, dtype=float)
+    row_dir, col_dir = orientation[:3], orientation[3:]
+    normal = np.cross(row_dir, col_dir)
+    positions = [float(np.dot(np.array(ds.ImagePositionPatient, dtype=float), normal)) for ds in headers]
+    return row_dir, col_dir, normal, positions
+
+
+def _echo_key(ds):
+    echo_time = getattr(ds, 'EchoTime', None)
+    if echo_time not in (None, ''):
+        return round(float(echo_time), 3)
+    echo_number = getattr(ds, 'EchoNumbers', None)
+    return float(echo_number) if echo_number not in (None, '') else 0.0
+
+
+def _read_pixels(path):
+    return pydicom.dcmread(path).pixel_array
+
+
+def build_volume(series_dir, root=None, workers=4):
+    """Read a series folder and write its .npy cache and geometry sidecar, returns the SeriesVolume"""
+    series_dir = Path(series_dir)
+    root = Path(root) if root else series_dir.parent.parent
+    files = sorted(scan_files(str(series_dir)))
+    if not files:
+        raise ValueError(f"No DICOM file in {series_dir}")
+
+    headers = [pydicom.dcmread(path, stop_before_pixels=True, specific_tags=GEOMETRY_TAGS) for path in files]
+    row_dir, col_dir, normal, positions = _slice_geometry(headers)
+
+    # Group by echo, then order each echo along the slice normal
+    echoes = {}
+    for index, ds in enumerate(headers):
+        echoes.setdefault(_echo_key(ds), []).append(index)
+    echo_times = sorted(echoes)
+    order = [sorted(echoes[echo], key=lambda i: positions[i]) for echo in echo_times]
+    n_slices = len(order[0])
+    if any(len(indexes) != n_slices for indexes in order):
+        raise ValueError(f"{series_dir}: echoes have different slice counts "
+                         f"{[len(indexes) for indexes in order]}")
+    slice_positions = [positions[i] for i in order[0]]
+    if len(set(np.round(slice_positions, 3))) != n_slices:
+        raise ValueError(f"{series_dir}: several images at the same position within an echo")
+
+    first = headers[order[0][0]]
+    rows, columns = int(first.Rows), int(first.Columns)
+    sample = _read_pixels(files[order[0][0]])
+    shape = (len(echo_times), n_slices, rows, columns) if len(echo_times) > 1 else (n_slices, rows, columns)
+
+    # The volume is written slice by slice into the memory-mapped file, never whole in RAM
+    volume_path = series_dir / VOLUME_FILE
+    tmp_path = series_dir / (VOLUME_FILE + '.tmp')
+    array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=sample.dtype, shape=shape)
+    targets = [(files[i], (e, s) if len(echo_times) > 1 else (s,))
+               for e, indexes in enumerate(order) for s, i in enumerate(indexes)]
+
+    def load(target):
+        path, index = target
+        array[index] = _read_pixels(path)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(load, targets))
+    array.flush()
+    del array
+    os.replace(tmp_path, volume_path)
+
+    pixel_spacing = [float(value) for value in getattr(first, 'PixelSpacing', [1.0, 1.0])]
+    first_position = np.array(headers[order[0][0]].ImagePositionPatient, dtype=float)
+    if n_slices > 1:
+        last_position = np.array(headers[order[0][-1]].ImagePositionPatient, dtype=float)
+        slice_step = (last_position - first_position) / (n_slices - 1)
+    else:
+        slice_step = normal * float(getattr(first, 'SliceThickness', 1.0) or 1.0)
+    affine = np.eye(4)
+    affine[:3, 0] = row_dir * pixel_spacing[1]
+    affine[:3, 1] = col_dir * pixel_spacing[0]
+    affine[:3, 2] = slice_step
+    affine[:3, 3] = first_position
+
+    geometry = {
+        'fingerprint': _fingerprint(series_dir, files, root),
+        'series_instance_uid': str(getattr(first, 'SeriesInstanceUID', '')),
+        'series_description': str(getattr(first, 'SeriesDescription', '')),
+        'shape': list(shape),
+        'dtype': str(sample.dtype),
+        'axes': ['echo', 'slice', 'row', 'column'] if len(echo_times) > 1 else ['slice', 'row', 'column'],
+        'echo_times': echo_times,
+        'pixel_spacing': pixel_spacing,
+        'slice_spacing': float(np.linalg.norm(slice_step)),
+        'slice_positions': slice_positions,
+        'image_orientation': [float(value) for value in first.ImageOrientationPatient],
+        'affine': affine.tolist(),
+        'rescale_slope': float(getattr(first, 'RescaleSlope', 1) or 1),
+        'rescale_intercept': float(getattr(first, 'RescaleIntercept', 0) or 0),
+        'sop_instance_uids': [[str(headers[i].SOPInstanceUID) for i in indexes] for indexes in order],
+    }
+    tmp_geometry = series_dir / (GEOMETRY_FILE + '.tmp')
+    with open(tmp_geometry, 'w', encoding='utf-8') as f:
+        json.dump(geometry, f, indent=1)
+    os.replace(tmp_geometry, series_dir / GEOMETRY_FILE)
+    return SeriesVolume(np.load(volume_path, mmap_mode='r'), geometry, volume_path)
+
+
+def load_volume(series_dir, root=None, rebuild=False, workers=4):
+    """Memory-mapped volume of a series folder, (re)built if the cache is missing or stale"""
+    series_dir = Path(series_dir)
+    root = Path(root) if root else series_dir.parent.parent
+    volume_path = series_dir / VOLUME_FILE
+    geometry_path = series_dir / GEOMETRY_FILE
+    if not rebuild and volume_path.exists() and geometry_path.exists():
+        with open(geometry_path, encoding='utf-8') as f:
+            geometry = json.load(f)
+        files = list(scan_files(str(series_dir)))
+        if files and geometry.get('fingerprint') == _fingerprint(series_dir, files, root):
+            return SeriesVolume(np.load(volume_path, mmap_mode='r'), geometry, volume_path)
+    return build_volume(series_dir, root, workers)
+
+
+def find_series_dirs(root, pattern='*'):
+    """Series folders <root>/<PatientID>/<SeriesNumber>_<SeriesDescription> whose name matches pattern"""
+    root = Path(root)
+    return sorted(path for path in root.glob(f"*/{pattern}")
+                  if path.is_dir() and not path.parent.name.startswith(('.', 'temp_transit')))
@@ -0,0 +1,199 @@
+"""
+Shared Work Queue
+
+(patient, series description) jobs shared by several run_process workers,
+possibly on different hosts. A worker leases a job for a limited time and
+renews the lease with heartbeats while it works on it. Leases that expire
+(worker killed, host down) are put back in the queue for another worker.
+
+The queue is a SQLite database in rollback-journal mode (WAL needs memory
+shared by the processes of one host, it breaks on network filesystems),
+every write is a BEGIN IMMEDIATE transaction. It must live on a filesystem
+with working file locks (local disk, or a network share supporting them).
+
+A job is completed by the worker once its series have been pseudonymized
+and sorted, not when its transfer returns, so that a worker dying during
+the post-processing leaves the job to be leased again.
+"""
+
+import logging
+import sqlite3
+import threading
+from collections import namedtuple
+from time import time
+
+Job = namedtuple('Job', 'id patient_id series_description attempts')
+
+PENDING, LEASED, DONE, FAILED = 'pending', 'leased', 'done', 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    patient_id TEXT NOT NULL,
+    series_description TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result INTEGER,
+    error TEXT,
+    updated REAL,
+    UNIQUE (patient_id, series_description)
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);
+"""
+
+
+class WorkQueue:
+    """SQLite queue of (patient, series) jobs with leases"""
+
+    LEASE_SECONDS = 300
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, db_path, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        # Autocommit mode, transactions are opened explicitly with BEGIN IMMEDIATE
+        self._conn = sqlite3.connect(str(db_path), timeout=30, isolation_level=None, check_same_thread=False)
+        # Rollback journal: the queue may be shared by workers on several hosts
+        self._conn.execute("PRAGMA journal_mode=DELETE")
+        self._conn.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _transaction(self, statements):
+        """Run (sql, params) statements in one write transaction, returns the last cursor"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = None
+                for sql, params in statements:
+                    cursor = self._conn.execute(sql, params)
+                self._conn.execute("COMMIT")
+                return cursor
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def enqueue(self, patient_ids, series_descriptions):
+        """Add one job per (patient, series description), jobs already queued are kept as they are"""
+        now = time()
+        rows = [(p_id, desc, now) for p_id in patient_ids for desc in series_descriptions]
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO jobs (patient_id, series_description, updated) VALUES (?, ?, ?)", rows)
+            added = self._conn.total_changes - before
+            self._conn.execute("COMMIT")
+        return added
+
+    def requeue_expired(self):
+        """Put back the jobs whose lease has expired, returns how many"""
+        cursor = self._transaction([(
+            "UPDATE jobs SET state = ?, worker = NULL, lease_until = NULL, updated = ? "
+            "WHERE state = ? AND lease_until < ?", (PENDING, time(), LEASED, time()))])
+        if cursor.rowcount:
+            logging.warning(f"{cursor.rowcount} expired lease(s) put back in the queue")
+        return cursor.rowcount
+
+    def lease(self, worker):
+        """Take the next pending job for `worker`, or None if there is none right now"""
+        self.requeue_expired()
+        now = time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT id, patient_id, series_description, attempts FROM jobs "
+                    "WHERE state = ? ORDER BY id LIMIT 1", (PENDING,)).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        "UPDATE jobs SET state = ?, worker = ?, lease_until = ?, attempts = attempts + 1, updated = ? "
+                        "WHERE id = ?", (LEASED, worker, now + self.lease_seconds, now, row[0]))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return Job(row[0], row[1], row[2], row[3] + 1)
+
+    def heartbeat(self, job_ids, worker):
+        """Extend the leases `worker` still holds, returns the ids it has lost"""
+        if not job_ids:
+            return []
+        now = time()
+        lost = []
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            for job_id in job_ids:
+                cursor = self._conn.execute(
+                    "UPDATE jobs SET lease_until = ?, updated = ? WHERE id = ? AND worker = ? AND state = ?",
+                    (now + self.lease_seconds, now, job_id, worker, LEASED))
+                if cursor.rowcount == 0:
+                    lost.append(job_id)
+            self._conn.execute("COMMIT")
+        return lost
+
+    def complete(self, job_id, worker, result=None):
+        """Mark a job done (even if its lease was lost meanwhile, the work is done)"""
+        self._transaction([("UPDATE jobs SET state = ?, worker = ?, lease_until = NULL, result = ?, error = NULL, "
+                            "updated = ? WHERE id = ?", (DONE, worker, result, time(), job_id))])
+
+    def fail(self, job_id, worker, error):
+        """Put a failed job back in the queue, or mark it failed after max_attempts"""
+        self._transaction([("UPDATE jobs SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, "
+                            "lease_until = NULL, error = ?, updated = ? WHERE id = ? AND worker = ? AND state = ?",
+                            (self.max_attempts, FAILED, PENDING, str(error), time(), job_id, worker, LEASED))])
+
+    def counts(self):
+        """Number of jobs per state"""
+        with self._lock:
+            rows = self._conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        counts = {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0}
+        counts.update(dict(rows))
+        return counts
+
+
+class LeaseKeeper:
+    """Background thread renewing the leases of the jobs a worker is processing"""
+
+    def __init__(self, queue, worker, interval=None):
+        self.queue = queue
+        self.worker = worker
+        self.interval = interval or max(queue.lease_seconds / 3, 1)
+        self._held = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="lease-keeper", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def hold(self, job_id):
+        with self._lock:
+            self._held.add(job_id)
+
+    def drop(self, job_id):
+        with self._lock:
+            self._held.discard(job_id)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                held = list(self._held)
+            try:
+                for job_id in self.queue.heartbeat(held, self.worker):
+                    logging.warning(f"Lease lost for job {job_id}, another worker may process it again")
+            except sqlite3.Error as e:
+                logging.error(f"Heartbeat failed: {e}")
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
@@ -0,0 +1,66 @@
+"""Synthetic instances shared by the tests"""
+
+import numpy as np
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+
+
+def make_instance(patient_id, study_uid, series_uid, number=1, series_number=1, description="SER 0"):
+    ds = Dataset()
+    ds.PatientID = patient_id
+    ds.PatientName = f"Doe^{patient_id}"
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = series_uid
+    ds.SOPInstanceUID = generate_uid()
+    ds.SOPClassUID = MRImageStorage
+    ds.StudyDate = "20230101"
+    ds.Modality = "MR"
+    ds.SeriesNumber = series_number
+    ds.SeriesDescription = description
+    ds.InstanceNumber = number
+    ds.Rows = ds.Columns = 4
+    ds.BitsAllocated = ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.PixelData = (np.arange(16, dtype=np.uint16) + number).tobytes()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta.MediaStorageSOPClassUID = MRImageStorage
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    return ds
+
+
+def make_instances(patients=2, series=2, instances=3):
+    """patients x series x instances datasets, one study per patient"""
+    out = []
+    for p in range(patients):
+        study_uid = generate_uid()
+        for s in range(series):
+            series_uid = generate_uid()
+            for i in range(instances):
+                out.append(make_instance(f"CL{p:03d}", study_uid, series_uid, i + 1, s + 1, f"SER {s}"))
+    return out
+
+
+def write_image(series_dir, pixels, position, orientation=(1, 0, 0, 0, 1, 0), spacing=(0.8, 0.6), name=None,
+                study_uid=None, series_uid=None, **attributes):
+    """Write one uint16 MR image at position (ImagePositionPatient), returns its path.
+
+    attributes are set on the dataset (SeriesDescription, EchoTime, ImageType, ...).
+    """
+    pixels = np.asarray(pixels, dtype=np.uint16)
+    ds = make_instance("CL000", study_uid or generate_uid(), series_uid or generate_uid())
+    ds.Rows, ds.Columns = pixels.shape
+    ds.PixelData = pixels.tobytes()
+    ds.ImagePositionPatient = [float(value) for value in position]
+    ds.ImageOrientationPatient = [float(value) for value in orientation]
+    ds.PixelSpacing = [float(value) for value in spacing]
+    ds.SliceThickness = 3.0
+    for keyword, value in attributes.items():
+        setattr(ds, keyword, value)
+    series_dir.mkdir(parents=True, exist_ok=True)
+    path = series_dir / (name or f"{ds.SOPInstanceUID}.dcm")
+    ds.save_as(path, enforce_file_format=True)
+    return path
@@ -0,0 +1,149 @@
+"""pynetdicom stand-in PACS serving synthetic instances (C-FIND, C-MOVE, C-GET, C-ECHO)"""
+
+import fnmatch
+import threading
+import time
+
+from pydicom.dataset import Dataset
+from pynetdicom import AE, StoragePresentationContexts, evt
+from pynetdicom.sop_class import (StudyRootQueryRetrieveInformationModelFind, StudyRootQueryRetrieveInformationModelGet,
+                                  StudyRootQueryRetrieveInformationModelMove, Verification)
+
+LEVEL_KEYS = {"STUDY": "StudyInstanceUID", "SERIES": "SeriesInstanceUID", "IMAGE": "SOPInstanceUID"}
+MATCH_KEYS = ("PatientID", "StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID", "SeriesDescription")
+
+
+def matches(ds, query):
+    study_date = getattr(query, 'StudyDate', '') or ''
+    if study_date:
+        if '-' in study_date:
+            low, high = study_date.split('-', 1)
+            if (low and ds.StudyDate < low) or (high and ds.StudyDate > high):
+                return False
+        elif ds.StudyDate != study_date:
+            return False
+    for keyword in MATCH_KEYS:
+        if keyword not in query or query[keyword].value in (None, '', []):
+            continue
+        value = query[keyword].value
+        values = [value] if isinstance(value, str) else list(value)
+        if not any(fnmatch.fnmatchcase(str(getattr(ds, keyword, '')), str(v)) for v in values):
+            return False
+    return True
+
+
+class StandInPacs:
+    """Stand-in PACS on 127.0.0.1 (port 0: any free port).
+
+    cap: at most cap C-FIND matches per query, then final_status (Success by
+    default, like a PACS silently capping its answers). fail(query) returning
+    a status makes a C-FIND fail with it. C-MOVEs are sent to `destinations`
+    {AE title: port}, delay seconds per instance. find_delay seconds per
+    C-FIND match; with ignore_cancel the matches keep coming after a C-CANCEL.
+    `cancels` counts the C-FINDs cancelled, `associations` the associations
+    accepted, `max_active` the most open at once.
+    """
+
+    def __init__(self, instances, port=0, ae_title="TELEMISQR", cap=None, final_status=0x0000, fail=None,
+                 destinations=None, delay=0.0, find_delay=0.0, ignore_cancel=False):
+        self.instances = instances
+        self.cap = cap
+        self.final_status = final_status
+        self.fail = fail
+        self.destinations = destinations or {}
+        self.delay = delay
+        self.find_delay = find_delay
+        self.ignore_cancel = ignore_cancel
+        self.queries = []
+        self.cancels = 0
+        self.associations = 0
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+        self.ae = AE(ae_title)
+        self.ae.network_timeout = 10
+        for context in (StudyRootQueryRetrieveInformationModelFind, StudyRootQueryRetrieveInformationModelMove,
+                        StudyRootQueryRetrieveInformationModelGet, Verification):
+            self.ae.add_supported_context(context)
+        for context in StoragePresentationContexts:
+            self.ae.add_supported_context(context.abstract_syntax, scu_role=False, scp_role=True)
+            self.ae.add_requested_context(context.abstract_syntax)
+        handlers = [(evt.EVT_C_FIND, self.on_find), (evt.EVT_C_MOVE, self.on_move), (evt.EVT_C_GET, self.on_get),
+                    (evt.EVT_ACCEPTED, self.on_accepted), (evt.EVT_RELEASED, self.on_closed),
+                    (evt.EVT_ABORTED, self.on_closed)]
+        self.server = self.ae.start_server(("127.0.0.1", port), block=False, evt_handlers=handlers)
+        self.port = self.server.server_address[1]
+
+    def on_accepted(self, event):
+        with self._lock:
+            self.associations += 1
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+
+    def on_closed(self, event):
+        with self._lock:
+            self.active -= 1
+
+    def select(self, query):
+        return [ds for ds in self.instances if matches(ds, query)]
+
+    def on_find(self, event):
+        query = event.identifier
+        with self._lock:
+            self.queries.append(query)
+        if self.fail is not None:
+            status = self.fail(query)
+            if status is not None:
+                yield status, None
+                return
+        level = query.QueryRetrieveLevel
+        key = LEVEL_KEYS[level]
+        seen = set()
+        cancelled = False
+        for ds in self.select(query):
+            if getattr(ds, key) in seen:
+                continue
+            if self.find_delay:
+                time.sleep(self.find_delay)
+            if event.is_cancelled and not cancelled:
+                cancelled = True
+                with self._lock:
+                    self.cancels += 1
+                if not self.ignore_cancel:
+                    yield 0xFE00, None
+                    return
+            if self.cap and len(seen) >= self.cap:
+                if self.final_status:
+                    yield self.final_status, None
+                return
+            seen.add(getattr(ds, key))
+            identifier = Dataset()
+            identifier.QueryRetrieveLevel = level
+            for element in query:
+                if element.keyword and element.keyword != 'QueryRetrieveLevel':
+                    setattr(identifier, element.keyword, getattr(ds, element.keyword, ''))
+            yield 0xFF00, identifier
+
+    def on_move(self, event):
+        selected = self.select(event.identifier)
+        destination = event.move_destination
+        if isinstance(destination, bytes):
+            destination = destination.decode()
+        yield "127.0.0.1", self.destinations[destination.strip()]
+        yield len(selected)
+        for ds in selected:
+            if event.is_cancelled:
+                yield 0xFE00, None
+                return
+            if self.delay:
+                time.sleep(self.delay)
+            yield 0xFF00, ds
+
+    def on_get(self, event):
+        selected = self.select(event.identifier)
+        yield len(selected)
+        for ds in selected:
+            yield 0xFF00, ds
+
+    def shutdown(self):
+        self.server.shutdown()
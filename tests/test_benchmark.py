@@ -0,0 +1,28 @@
+import threading
+
+from dicom.config.server_config import TelemisConfig
+from dicom.services.benchmark import benchmark_pdu
+from dicom.services.search_criteria import SearchCriteria
+from helpers import make_instances
+from pacs import StandInPacs
+
+
+def acceptor_threads():
+    return sum(thread.name.startswith("AcceptorServer") for thread in threading.enumerate())
+
+def test_benchmark_leaves_no_storage_server_running():
+    instances = make_instances(patients=1, series=1, instances=3)
+    pacs = StandInPacs(instances)
+    try:
+        config = type('StandInConfig', (TelemisConfig,), dict(
+            HOST="127.0.0.1", PORT=pacs.port, CALLED_AET="TELEMISQR", SOURCE_NODES=[]))
+        criteria = SearchCriteria(level='SERIES', study_instance_uid=instances[0].StudyInstanceUID,
+                                  series_instance_uid=instances[0].SeriesInstanceUID)
+        servers = acceptor_threads()
+        results = benchmark_pdu(config, criteria, pdu_sizes=(16382, 0), repeat=2)
+        assert [(result.max_pdu, result.files) for result in results] == [(16382, 3), (0, 3)] * 2
+        # The raw bytes received are counted, not the files written
+        assert len({result.bytes for result in results}) == 1 and results[0].bytes > 3 * 16 * 2
+        assert acceptor_threads() == servers
+    finally:
+        pacs.shutdown()
@@ -0,0 +1,45 @@
+from dicom.services.catalog import LocalCatalog
+from dicom.services.search_criteria import SearchCriteria
+from helpers import make_instances
+
+
+def test_series_with_missing_instances_is_not_known(tmp_path):
+    catalog = LocalCatalog(tmp_path / "catalog.sqlite")
+    instances = make_instances(patients=1, series=2, instances=3)
+    complete_uid, partial_uid = instances[0].SeriesInstanceUID, instances[3].SeriesInstanceUID
+    # The second series only has 2 of its 3 instances
+    for ds in instances[:5]:
+        catalog.add_dataset(ds, f"{ds.SOPInstanceUID}.dcm")
+
+    assert catalog.known_series({complete_uid: 3, partial_uid: 3}) == {complete_uid}
+    # Without an instance count from the PACS, a series is never taken as known
+    assert catalog.known_series({complete_uid: None, "1.2.3": 1}) == set()
+    catalog.close()
+
+
+def test_image_level_search_matches_the_sop_instance_uids(tmp_path):
+    catalog = LocalCatalog(tmp_path / "catalog.sqlite")
+    instances = make_instances(patients=2, series=2, instances=3)
+    for ds in instances:
+        catalog.add_dataset(ds, f"{ds.SOPInstanceUID}.dcm")
+
+    def sop_uids(**criteria):
+        return sorted(ds.SOPInstanceUID for ds in catalog.search(SearchCriteria(level='IMAGE', **criteria)))
+
+    one = instances[4].SOPInstanceUID
+    assert sop_uids(sop_instance_uid=one) == [one]
+    wanted = sorted(ds.SOPInstanceUID for ds in instances[2:5])
+    assert sop_uids(sop_instance_uid=wanted) == wanted
+    assert sop_uids(sop_instance_uid='\\'.join(wanted)) == wanted
+    # With the other keys: only the instances of the series asked for
+    assert sop_uids(series_instance_uid=instances[0].SeriesInstanceUID, sop_instance_uid=wanted) == \
+        sorted(ds.SOPInstanceUID for ds in instances[2:3])
+    # Wildcards
+    prefix = one[:-3]
+    assert sop_uids(sop_instance_uid=prefix + "*") == sorted(
+        ds.SOPInstanceUID for ds in instances if ds.SOPInstanceUID.startswith(prefix))
+    assert sop_uids(sop_instance_uid=one[:-1] + "?") == sorted(
+        ds.SOPInstanceUID for ds in instances if ds.SOPInstanceUID[:-1] == one[:-1])
+    assert sop_uids(patient_id="CL001", sop_instance_uid="*") == sorted(
+        ds.SOPInstanceUID for ds in instances if ds.PatientID == "CL001")
+    catalog.close()
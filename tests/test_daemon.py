@@ -0,0 +1,78 @@
+import os
+import threading
+
+import pytest
+
+from dicom.config.server_config import TelemisConfig
+from dicom.services.daemon import DONE, FAILED, DaemonClient, DicomDaemon, api_server, default_address
+from dicom.services.search_criteria import SearchCriteria
+from pacs import StandInPacs
+from test_find import make_studies
+
+
+@pytest.fixture
+def running(tmp_path, monkeypatch):
+    """Daemon on the default address (a runtime dir under tmp_path) in front of a stand-in PACS"""
+    runtime = tmp_path / "run"
+    runtime.mkdir(mode=0o700)
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(runtime))
+    instances = make_studies([f"CL{i:03d}" for i in range(5)] + ["XX000"])
+    pacs = StandInPacs(instances, fail=lambda query: 0xC000 if query.PatientID.startswith("XX") else None)
+    config = type('StandInConfig', (TelemisConfig,), dict(
+        HOST="127.0.0.1", PORT=pacs.port, CALLED_AET="TELEMISQR", SOURCE_NODES=[], MAX_FIND_RESULTS=None))
+    daemon = DicomDaemon(config, output_dir=str(tmp_path / "out"), workers=4, keep_alive=0)
+    server = api_server(daemon)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield daemon, instances
+    server.shutdown()
+    server.server_close()
+    daemon.close()
+    pacs.shutdown()
+
+
+def test_default_address_is_an_owner_only_socket_with_a_token(running):
+    address = default_address()
+    socket_path = address[len("unix:"):]
+    assert address.startswith("unix:") and os.stat(socket_path).st_mode & 0o077 == 0
+    assert os.stat(socket_path + ".token").st_mode & 0o077 == 0
+    assert DaemonClient.discover() is not None
+
+    intruder = DaemonClient()
+    intruder.token = "guess"
+    with pytest.raises(RuntimeError, match="token"):
+        intruder.status()
+    with pytest.raises(RuntimeError, match="token"):
+        intruder.shutdown()
+
+
+def test_search_records_are_streamed_not_kept(running):
+    daemon, instances = running
+    client = DaemonClient.discover()
+    records = list(client.search(SearchCriteria(level="STUDY", patient_id="CL*")))
+    assert sorted(record.StudyInstanceUID for record in records) == sorted(
+        ds.StudyInstanceUID for ds in instances if ds.PatientID.startswith("CL"))
+    job = client.jobs()[0]
+    assert job['state'] == DONE and job['result']['records'] == len(records)
+
+
+def test_parallel_searches_keep_their_own_errors(running):
+    client = DaemonClient.discover()
+    outcomes = {}
+
+    def search(patient_id):
+        try:
+            outcomes[patient_id] = len(list(client.search(SearchCriteria(level="STUDY", patient_id=patient_id))))
+        except Exception as e:
+            outcomes[patient_id] = e
+    threads = [threading.Thread(target=search, args=(patient_id,))
+               for patient_id in ["XX*", "CL*", "XX0*", "CL00*"] * 2]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+
+    assert outcomes["CL*"] == 5 and outcomes["CL00*"] == 5
+    assert isinstance(outcomes["XX*"], RuntimeError) and isinstance(outcomes["XX0*"], RuntimeError)
+    states = {(job['criteria']['patient_id'], job['state']) for job in client.jobs()}
+    assert states == {("XX*", FAILED), ("XX0*", FAILED), ("CL*", DONE), ("CL00*", DONE)}
@@ -0,0 +1,115 @@
+import io
+
+import pytest
+
+from dicom.config.server_config import TelemisConfig
+from dicom.services.dicomweb import DicomWebClient, MultipartReader
+from dicom.services.get import Get
+from dicom.services.manifest import verify
+from dicom.services.move import Move
+from dicom.services.search_criteria import SearchCriteria
+from helpers import make_instances
+from test_find import make_studies
+from web import StandInWeb
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(instances, **options):
+        web = StandInWeb(instances, **options)
+        servers.append(web)
+        return web
+    yield start
+    for web in servers:
+        web.shutdown()
+
+
+def web_config(*urls):
+    return type('StandInConfig', (TelemisConfig,), dict(
+        SOURCE_NODES=[{"transport": "dicomweb", "url": url, "name": f"web{index}", "max_associations": 3}
+                      for index, url in enumerate(urls)]))
+
+
+def series_criteria(instances):
+    criteria = SearchCriteria(level='SERIES', study_instance_uid=[ds.StudyInstanceUID for ds in instances],
+                              series_instance_uid=[ds.SeriesInstanceUID for ds in instances])
+    criteria.study_instance_uid = list(dict.fromkeys(criteria.study_instance_uid))
+    criteria.series_instance_uid = list(dict.fromkeys(criteria.series_instance_uid))
+    if len(criteria.study_instance_uid) > 1:
+        pairs = list(dict.fromkeys((ds.StudyInstanceUID, ds.SeriesInstanceUID) for ds in instances))
+        criteria.study_instance_uid = [study_uid for study_uid, _ in pairs]
+        criteria.series_instance_uid = [series_uid for _, series_uid in pairs]
+    return criteria
+
+
+@pytest.mark.parametrize('block_size', [1, 2, 3, 7, 1000])
+def test_multipart_parts_across_block_boundaries(block_size):
+    # The first part holds a near miss of the delimiter, the second one is empty
+    body = (b"preamble\r\n--b\r\nContent-Type: application/dicom\r\n\r\nHELLO\r\n--c-\r\n-X\r\n"
+            b"--b\r\nContent-Type: x\r\n\r\n\r\n--b--\r\nepilogue")
+    reader = MultipartReader(io.BytesIO(body), 'b', block_size=block_size)
+    parts = [(part.content_type, b''.join(part.chunks())) for part in reader.parts()]
+    assert parts == [("application/dicom", b"HELLO\r\n--c-\r\n-X"), ("x", b"")]
+
+
+def test_multipart_truncated_body_is_an_error():
+    reader = MultipartReader(io.BytesIO(b"--b\r\nContent-Type: x\r\n\r\nHALF"), 'b', block_size=3)
+    part = next(reader.parts())
+    with pytest.raises(ValueError):
+        b''.join(part.chunks())
+
+
+def test_qido_pages_past_a_server_page_cap(serve):
+    instances = make_studies([f"CL{i:03d}" for i in range(250)])
+    web = serve(instances, page_cap=100)
+    client = DicomWebClient(web.url)
+    records = list(client.iter_search(SearchCriteria(level="STUDY", patient_id="CL*")))
+    assert sorted(record.StudyInstanceUID for record in records) == sorted(ds.StudyInstanceUID for ds in instances)
+    assert [int(params['offset']) for params in web.qido_requests] == [0, 100, 200, 250]
+
+    limited = list(client.iter_search(SearchCriteria(level="STUDY", patient_id="CL*"), limit=150))
+    assert len(limited) == 150
+    client.close()
+
+
+@pytest.mark.parametrize('chunked', [False, True])
+def test_wado_retrieve_into_get(serve, tmp_path, chunked):
+    instances = make_instances(patients=1, series=3, instances=4)
+    web = serve(instances, chunked=chunked)
+    get = Get(web_config(web.url), output_dir=tmp_path / "out")
+    criteria = series_criteria(instances)
+    criteria.anonymize_data = False
+    assert get.retrieve_data(criteria) == len(instances)
+    assert get.last_status == 0x0000
+    report = verify(tmp_path / "out")
+    assert report.ok == len(instances) and report.failed == 0
+    # Series in parallel over at most max_associations pooled connections
+    assert web.connections <= 3
+
+
+def test_wado_retrieve_into_move_with_a_failed_series(serve, tmp_path):
+    instances = make_instances(patients=2, series=2, instances=3)
+    web = serve(instances, fail_series=[instances[0].SeriesInstanceUID])
+    move = Move(web_config(web.url), output_dir=tmp_path / "out")
+    records = move.move_tracked(series_criteria(instances))
+    assert sum(record.files_received for record in records) == len(instances) - 3
+    # One WADO-RS request per study: the one with the failed series ends with a warning
+    assert sorted(record.status for record in records) == [0x0000, 0xB000]
+
+    move.final_global_sort()
+    report = verify(tmp_path / "out")
+    assert report.ok == len(instances) - 3 and report.failed == 0
+
+
+def test_move_without_a_reachable_node_reports_it(tmp_path, capsys):
+    # Nothing listens on the port: each request fails, the only node is not taken out for the next one
+    move = Move(web_config("http://127.0.0.1:9/dicom-web"), output_dir=tmp_path / "out")
+    instances = make_instances(patients=1, series=1, instances=1)
+    for _ in range(2):
+        records = move.move_tracked(series_criteria(instances))
+        assert [record.files_received for record in records] == [0]
+    out = capsys.readouterr().out
+    assert out.count("WADO-RS retrieve failed on web0") == 2 and "WADO-RS retrieve not sent" not in out
+    assert move.nodes.nodes[0].failures == 2
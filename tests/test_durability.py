@@ -0,0 +1,69 @@
+import pydicom
+import pytest
+
+from dicom.run_process import TransferStats, pseudonymize_file_safe
+from dicom.services.durability import DurableWriter
+from dicom.services.manifest import ManifestStore, hash_file
+from helpers import make_instance
+
+
+class RenamingPseudonymizer:
+    def pseudonymize_file(self, ds):
+        ds.PatientID = "PSEUDO-1"
+        ds.PatientName = "PSEUDO^1"
+        return ds
+
+
+class RecordingWriter(DurableWriter):
+    """DurableWriter remembering the (tmp, final) pairs committed"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.committed = []
+
+    def commit(self, tmp, final, on_commit=None, wait=None):
+        self.committed.append((tmp, final))
+        return super().commit(tmp, final, on_commit, wait)
+
+
+@pytest.mark.parametrize('mode', ['response', 'manifest'])
+def test_pseudonymized_file_is_committed_not_rewritten_in_place(tmp_path, mode):
+    ds = make_instance("CL001", pydicom.uid.generate_uid(), pydicom.uid.generate_uid())
+    path = tmp_path / "CL001" / f"{ds.SOPInstanceUID}.dcm"
+    path.parent.mkdir()
+    ds.save_as(path, enforce_file_format=True)
+    manifest = ManifestStore(tmp_path)
+    manifest.record(ds.SeriesInstanceUID, ds.SOPInstanceUID, path, path.stat().st_size, hash_file(path))
+    inode = path.stat().st_ino
+
+    writer = RecordingWriter(mode, window=0.001)
+    try:
+        stats = TransferStats()
+        assert pseudonymize_file_safe(str(path), RenamingPseudonymizer(), stats, manifest, writer)
+        # Committed before returning, even in manifest mode: the sort moves the file next
+        assert len(writer.committed) == 1
+        tmp, final = writer.committed[0]
+        assert str(final) == str(path) and str(tmp) != str(path)
+        assert not tmp.exists()
+    finally:
+        writer.close()
+
+    # The final file is the committed one (a new inode renamed over the original), complete
+    assert path.stat().st_ino != inode
+    assert pydicom.dcmread(path).PatientID == "PSEUDO-1"
+    entry = manifest.instances(ds.SeriesInstanceUID)[ds.SOPInstanceUID]
+    assert entry['hash'] == hash_file(path)
+    assert entry['size'] == path.stat().st_size
+    assert [p.name for p in path.parent.iterdir()] == [path.name]
+    assert writer.files == 1
+
+
+def test_commit_waits_when_asked_in_manifest_mode(tmp_path):
+    tmp, final = tmp_path / ".a.dcm.part", tmp_path / "a.dcm"
+    tmp.write_bytes(b"data")
+    writer = DurableWriter('manifest', window=0.05)
+    try:
+        writer.commit(tmp, final, wait=True)
+        assert final.read_bytes() == b"data" and not tmp.exists()
+    finally:
+        writer.close()
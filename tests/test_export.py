@@ -0,0 +1,53 @@
+import os
+import tarfile
+import zipfile
+
+import pytest
+from pydicom.uid import generate_uid
+
+from dicom.services.export import ArchiveSink
+from dicom.services.sorter import sort_tree
+from helpers import make_instances
+
+
+def members(path, fmt):
+    if fmt == 'tar':
+        with tarfile.open(path) as archive:
+            return sorted(archive.getnames())
+    with zipfile.ZipFile(path) as archive:
+        assert archive.testzip() is None
+        return sorted(archive.namelist())
+
+
+@pytest.mark.parametrize('fmt', ['tar', 'zip'])
+def test_archive_sink_keeps_at_most_max_open_files(tmp_path, fmt):
+    src = tmp_path / "src"
+    src.mkdir()
+    for ds in make_instances(patients=5, series=2, instances=2):
+        ds.save_as(src / f"{generate_uid()}.dcm", enforce_file_format=True)
+    sorted_dir = tmp_path / "sorted"
+    sort_tree(src, sorted_dir, workers=1)
+
+    series = {root: [os.path.join(root, name) for name in files] for root, _, files in os.walk(sorted_dir) if files}
+    sink = ArchiveSink(sorted_dir, tmp_path / "export", fmt, max_open=2)
+    # The series of the 5 patients interleaved: archives are suspended and reopened
+    for files in sorted(series.values(), key=lambda files: os.path.basename(os.path.dirname(files[0]))):
+        sink.add_series(files)
+        assert len(sink._open) <= 2
+    assert sink.close() == (5, 20, sum(os.path.getsize(path) for files in series.values() for path in files))
+
+    for patient in sorted(os.listdir(sorted_dir)):
+        expected = sorted(os.path.relpath(path, sorted_dir) for files in series.values() for path in files
+                          if os.path.relpath(path, sorted_dir).startswith(patient + os.sep))
+        assert members(tmp_path / "export" / f"{patient}.{fmt}", fmt) == expected
+
+
+def test_sort_tree_hands_the_sorted_files_to_the_archives(tmp_path):
+    src = tmp_path / "temp_transit"
+    src.mkdir()
+    for ds in make_instances(patients=2, series=1, instances=3):
+        ds.save_as(src / f"{generate_uid()}.dcm", enforce_file_format=True)
+    sink = ArchiveSink(tmp_path / "out", tmp_path / "export")
+    report = sort_tree(src, tmp_path / "out", workers=1, on_sorted=sink.add_series)
+    assert report.sorted == 6 and not report.errors
+    assert sink.close()[:2] == (2, 6)
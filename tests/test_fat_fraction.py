@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+from pydicom import Dataset
+from pydicom.uid import generate_uid
+
+from dicom.services.fat_fraction import (component, fat_fraction, fat_fraction_acquisition, fat_fraction_patient,
+                                         find_acquisitions)
+from helpers import write_image
+
+
+def header(image_type=None, description=""):
+    ds = Dataset()
+    if image_type is not None:
+        ds.ImageType = image_type
+    ds.SeriesDescription = description
+    return ds
+
+
+@pytest.mark.parametrize('image_type, description, expected', [
+    (['DERIVED', 'PRIMARY', 'DIXON', 'WATER'], "VIBE CUISSES", 'W'),
+    (['DERIVED', 'PRIMARY', 'DIXON', 'FAT'], "VIBE CUISSES", 'F'),
+    (['DERIVED', 'PRIMARY', 'F'], "VIBE CUISSES", 'F'),
+    (['DERIVED', 'PRIMARY', 'DIXON', 'IN_PHASE'], "VIBE CUISSES", 'IN'),
+    (['ORIGINAL', 'PRIMARY', 'M'], "VIBE_CUISSES_W", 'W'),
+    (['ORIGINAL', 'PRIMARY', 'M'], "VIBE_CUISSES_F", 'F'),
+    (None, "VIBE JAMBES_opp", 'OPP'),
+    # The ImageType wins over the description
+    (['DERIVED', 'PRIMARY', 'DIXON', 'FAT'], "VIBE_CUISSES_W", 'F'),
+    (['ORIGINAL', 'PRIMARY', 'M'], "VIBE CUISSES", None),
+])
+def test_component(image_type, description, expected):
+    assert component(header(image_type, description)) == expected
+
+
+def write_stack(series_dir, values, study_uid, positions=(0.0, 4.0, 8.0), **attributes):
+    """One 8x8 image per slice position, written in reverse order; values: pixel value of the centre 4x4"""
+    series_uid = generate_uid()
+    for z in reversed(positions):
+        pixels = np.zeros((8, 8))
+        pixels[2:6, 2:6] = values
+        write_image(series_dir, pixels, (0, 0, z), study_uid=study_uid, series_uid=series_uid, **attributes)
+
+
+def test_water_and_fat_as_two_series_paired_by_description(tmp_path):
+    patient = tmp_path / "CL000"
+    study_uid = generate_uid()
+    write_stack(patient / "10_VIBE CUISSES_W", 700, study_uid, SeriesDescription="VIBE CUISSES_W",
+                ImageType=['ORIGINAL', 'PRIMARY', 'M'])
+    write_stack(patient / "11_VIBE CUISSES_F", 300, study_uid, SeriesDescription="VIBE CUISSES_F",
+                ImageType=['ORIGINAL', 'PRIMARY', 'M'])
+    acquisitions = find_acquisitions(patient)
+    assert list(acquisitions) == [(study_uid, "VIBE CUISSES")]
+    images = acquisitions[(study_uid, "VIBE CUISSES")]
+    assert len(images['W']) == len(images['F']) == 3
+
+    out_dir, voxels = fat_fraction_acquisition(images['W'], images['F'])
+    assert out_dir == str(patient / "10_VIBE CUISSES_FFmap") and voxels == 3 * 16
+    ff, mask = np.load(f"{out_dir}/FFmap.npy"), np.load(f"{out_dir}/FFmask.npy")
+    assert ff.shape == mask.shape == (3, 8, 8)
+    assert np.allclose(ff[mask], 0.3) and not ff[~mask].any()
+
+
+def test_water_and_fat_in_one_series_paired_by_image_type(tmp_path):
+    patient = tmp_path / "CL000"
+    study_uid = generate_uid()
+    series_dir = patient / "12_VIBE JAMBES"
+    for kind, value in (('WATER', 600), ('FAT', 200), ('IN_PHASE', 800), ('OPP_PHASE', 400)):
+        write_stack(series_dir, value, study_uid, SeriesDescription="VIBE JAMBES",
+                    ImageType=['DERIVED', 'PRIMARY', 'DIXON', kind])
+    acquisitions = find_acquisitions(patient)
+    # In-phase and opposed-phase images are left out
+    assert {kind: len(items) for kind, items in acquisitions[(study_uid, "VIBE JAMBES")].items()} == {'W': 3, 'F': 3}
+
+    done, errors = fat_fraction_patient(patient)
+    assert not errors and len(done) == 1
+    ff = np.load(f"{done[0][0]}/FFmap.npy")
+    assert np.isclose(ff.max(), 0.25)
+
+
+def test_water_and_fat_on_other_slices_are_refused(tmp_path):
+    patient = tmp_path / "CL000"
+    study_uid = generate_uid()
+    write_stack(patient / "10_VIBE CUISSES_W", 700, study_uid, SeriesDescription="VIBE CUISSES_W")
+    write_stack(patient / "11_VIBE CUISSES_F", 300, study_uid, positions=(0.0, 4.0, 9.0),
+                SeriesDescription="VIBE CUISSES_F")
+    images = find_acquisitions(patient)[(study_uid, "VIBE CUISSES")]
+    with pytest.raises(ValueError, match="same slices"):
+        fat_fraction_acquisition(images['W'], images['F'])
+
+    done, errors = fat_fraction_patient(patient)
+    assert not done and "same slices" in errors[0][1]
+
+
+def test_missing_fat_images_are_reported(tmp_path):
+    patient = tmp_path / "CL000"
+    write_stack(patient / "10_VIBE CUISSES_W", 700, generate_uid(), SeriesDescription="VIBE CUISSES_W")
+    done, errors = fat_fraction_patient(patient)
+    assert not done and errors[0][1] == "missing fat images"
+
+
+def test_mask_threshold_and_value_range():
+    water = np.array([[1000.0, 0.0, 40.0, -10.0], [10.0, 30.0, 500.0, 0.0]])
+    fat = np.array([[0.0, 1000.0, 20.0, 110.0], [10.0, 40.0, 500.0, 0.0]])
+    ff, mask = fat_fraction(water, fat, mask_fraction=0.05)
+    # 5% of the 99th percentile of W + F (about 1000): 50
+    assert mask.tolist() == [[True, True, True, True], [False, True, True, False]]
+    assert ff.dtype == np.float32 and ff.min() >= 0.0 and ff.max() <= 1.0
+    assert ff[0].tolist() == pytest.approx([0.0, 1.0, 1 / 3, 1.0])
+    assert ff[1].tolist() == pytest.approx([0.0, 40 / 70, 0.5, 0.0])
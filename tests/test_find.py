@@ -0,0 +1,178 @@
+import time
+
+import pytest
+from pydicom.uid import generate_uid
+
+from dicom.config.server_config import TelemisConfig
+from dicom.services.find import Find, FindError
+from dicom.services.search_criteria import SearchCriteria
+from helpers import make_instance, make_instances
+from pacs import StandInPacs
+
+
+def make_studies(patient_ids, dates=("20230101",)):
+    """One single-instance study per patient and date"""
+    instances = []
+    for patient_id in patient_ids:
+        for study_date in dates:
+            ds = make_instance(patient_id, generate_uid(), generate_uid())
+            ds.StudyDate = study_date
+            instances.append(ds)
+    return instances
+
+
+def config_for(pacs, **settings):
+    # A short alphabet keeps the PatientID splits small
+    settings.setdefault('PATIENT_ID_ALPHABET', "0123ABCL")
+    return type('StandInConfig', (TelemisConfig,), dict(
+        HOST="127.0.0.1", PORT=pacs.port, CALLED_AET="TELEMISQR", SOURCE_NODES=[],
+        NETWORK_PROFILE_FILE=None, MAX_FIND_ASSOCIATIONS=2, **settings))
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(instances, **options):
+        pacs = StandInPacs(instances, **options)
+        servers.append(pacs)
+        return pacs
+    yield start
+    for pacs in servers:
+        pacs.shutdown()
+
+
+def study_ids(records):
+    return sorted(record.StudyInstanceUID for record in records)
+
+
+def test_failure_status_is_an_error_not_a_truncation(serve):
+    pacs = serve(make_studies(["CL000", "CL001"]), fail=lambda query: 0xC000)
+    find = Find(config_for(pacs, MAX_FIND_RESULTS=1))
+    assert find.search_data(SearchCriteria(level="STUDY", patient_id="*")) == []
+    assert isinstance(find.last_error, FindError) and find.last_error.status == 0xC000
+    assert len(pacs.queries) == 1
+
+
+def test_truncated_status_is_split(serve):
+    instances = make_studies([f"CL{i:03d}" for i in range(4)] + ["CL010", "CL021"])
+    pacs = serve(instances, cap=4, final_status=0xA700)
+    find = Find(config_for(pacs, MAX_FIND_RESULTS=None, FIND_TRUNCATED_STATUSES=[0xA700]))
+    records = find.search_data(SearchCriteria(level="STUDY", patient_id="CL*"))
+    assert find.last_error is None
+    assert study_ids(records) == study_ids(instances)
+
+
+def test_patient_ids_out_of_the_alphabet_fall_back_to_a_date_split(serve):
+    instances = make_studies(["cl-0042", "cl-0043", "CL0044"], dates=("20230105", "20230220", "20230310"))
+    pacs = serve(instances, cap=3)
+    find = Find(config_for(pacs, MAX_FIND_RESULTS=3))
+    records = find.search_data(SearchCriteria(level="STUDY", patient_id="*", study_date="20230101-20230331"))
+    assert find.last_error is None
+    assert study_ids(records) == study_ids(instances)
+    # Split on the dates only, never on the PatientID
+    assert {query.PatientID for query in pacs.queries} == {"*"}
+
+
+def test_sub_queries_are_capped(serve):
+    instances = make_studies([f"CL{i}{j}" for i in range(4) for j in range(4)])
+    pacs = serve(instances, cap=2)
+    find = Find(config_for(pacs, MAX_FIND_RESULTS=2, MAX_FIND_SUB_QUERIES=10))
+    records = find.search_data(SearchCriteria(level="STUDY", patient_id="CL*"))
+    assert len(pacs.queries) == 10
+    assert records and find.last_error is None
+
+
+def test_failed_sub_query_keeps_the_other_results(serve):
+    instances = make_studies(["A1", "A2", "B1", "B2", "C1"])
+
+    def fail(query):
+        return 0xC001 if query.PatientID == "B*" else None
+    pacs = serve(instances, cap=2, fail=fail)
+    find = Find(config_for(pacs, MAX_FIND_RESULTS=2))
+    records = find.search_data(SearchCriteria(level="STUDY", patient_id="*"))
+    assert isinstance(find.last_error, FindError) and find.last_error.status == 0xC001
+    assert sorted(record.PatientID for record in records) == ["A1", "A2", "C1"]
+
+
+def test_iter_search_raises_after_yielding_the_other_results(serve):
+    instances = make_studies(["A1", "A2", "B1", "C1"])
+    pacs = serve(instances, cap=2, fail=lambda query: 0xC001 if query.PatientID == "C*" else None)
+    find = Find(config_for(pacs, MAX_FIND_RESULTS=2))
+    records = []
+    with pytest.raises(FindError):
+        for record in find.iter_search(SearchCriteria(level="STUDY", patient_id="*")):
+            records.append(record)
+    assert sorted(record.PatientID for record in records) == ["A1", "A2", "B1"]
+
+
+def test_a_limit_cancels_the_find_without_reporting_a_truncation(serve):
+    instances = make_studies([f"CL{i:03d}" for i in range(40)])
+    pacs = serve(instances, find_delay=0.01)
+    find = Find(config_for(pacs, MAX_FIND_RESULTS=5, ASSOCIATION_KEEP_ALIVE=60))
+    records, truncated = find._query(SearchCriteria(level="STUDY", patient_id="*"), limit=5)
+    assert pacs.cancels == 1
+    # Reaching MAX_FIND_RESULTS because of the limit is not a truncation
+    assert not truncated
+    assert 5 <= len(records) < len(instances)
+    # The late responses were drained: the association serves the next query
+    records, truncated = find._query(SearchCriteria(level="STUDY", patient_id="CL001"))
+    assert [record.PatientID for record in records] == ["CL001"] and not truncated
+    assert pacs.associations == 1
+    find.close_idle()
+
+    records = find.search_data(SearchCriteria(level="STUDY", patient_id="*"), limit=5)
+    assert len(records) == 5 and find.last_error is None
+    assert len(pacs.queries) == 3
+
+
+def test_the_association_is_aborted_when_the_pacs_ignores_the_cancel(serve):
+    instances = make_studies([f"CL{i:03d}" for i in range(40)])
+    pacs = serve(instances, find_delay=0.01, ignore_cancel=True)
+    find = Find(config_for(pacs, ASSOCIATION_KEEP_ALIVE=60))
+    find.CANCEL_GRACE_RESPONSES = 3
+    records, truncated = find._query(SearchCriteria(level="STUDY", patient_id="*"), limit=5)
+    assert pacs.cancels == 1
+    assert len(records) == 5 and not truncated
+    # Not kept idle for reuse
+    assert not find._idle
+    for _ in range(100):
+        if not pacs.active:
+            break
+        time.sleep(0.01)
+    assert pacs.active == 0
+
+
+def test_image_level_searches_drill_down_per_series(serve):
+    instances = make_instances(patients=2, series=2, instances=3)
+    for ds in instances:
+        ds.EchoTime = 10.0 * ds.InstanceNumber
+    pacs = serve(instances)
+    find = Find(config_for(pacs))
+    records = find.search_data(SearchCriteria(level="IMAGE", patient_id="CL000"))
+    assert find.last_error is None
+
+    series_query, *image_queries = pacs.queries
+    assert series_query.QueryRetrieveLevel == "SERIES" and series_query.PatientID == "CL000"
+    # One IMAGE sub-query per matching series, on its unique keys only
+    expected = {(ds.StudyInstanceUID, ds.SeriesInstanceUID) for ds in instances if ds.PatientID == "CL000"}
+    assert len(image_queries) == len(expected) == 2
+    assert all(query.QueryRetrieveLevel == "IMAGE" and "PatientID" not in query for query in image_queries)
+    assert {(query.StudyInstanceUID, query.SeriesInstanceUID) for query in image_queries} == expected
+
+    # The instances of every series merged, with the UIDs of their series
+    by_uid = {ds.SOPInstanceUID: ds for ds in instances}
+    assert sorted(record.SOPInstanceUID for record in records) == sorted(
+        ds.SOPInstanceUID for ds in instances if ds.PatientID == "CL000")
+    for record in records:
+        ds = by_uid[record.SOPInstanceUID]
+        assert (record.StudyInstanceUID, record.SeriesInstanceUID) == (ds.StudyInstanceUID, ds.SeriesInstanceUID)
+        assert (record.InstanceNumber, record.EchoTime) == (ds.InstanceNumber, ds.EchoTime)
+
+    # Known series UIDs skip the SERIES query; a limit caps the merged records
+    pacs.queries.clear()
+    ds = instances[-1]
+    records = find.search_data(SearchCriteria(level="IMAGE", study_instance_uid=ds.StudyInstanceUID,
+                                              series_instance_uid=ds.SeriesInstanceUID), limit=2)
+    assert [query.QueryRetrieveLevel for query in pacs.queries] == ["IMAGE"]
+    assert len(records) == 2 and {record.SeriesInstanceUID for record in records} == {ds.SeriesInstanceUID}
@@ -0,0 +1,27 @@
+import pydicom
+import pytest
+
+from dicom.config.server_config import TelemisConfig
+from dicom.services.get import Get
+from dicom.services.search_criteria import SearchCriteria
+from dicom.services.sorter import scan_files
+from helpers import make_instances
+from pacs import StandInPacs
+
+
+@pytest.mark.parametrize('anonymize', [False, True])
+def test_instances_are_anonymized_only_on_request(tmp_path, anonymize):
+    instances = make_instances(patients=1, series=1, instances=2)
+    pacs = StandInPacs(instances)
+    try:
+        config = type('StandInConfig', (TelemisConfig,), dict(
+            HOST="127.0.0.1", PORT=pacs.port, CALLED_AET="TELEMISQR", SOURCE_NODES=[]))
+        get = Get(config, output_dir=tmp_path / "out")
+        criteria = SearchCriteria(level='SERIES', study_instance_uid=instances[0].StudyInstanceUID,
+                                  series_instance_uid=instances[0].SeriesInstanceUID, anonymize=anonymize)
+        assert get.retrieve_data(criteria) == 2
+        files = [path for path in scan_files(str(tmp_path / "out")) if path.endswith(".dcm")]
+        names = {str(pydicom.dcmread(path, force=True).get('PatientName', '')) for path in files}
+        assert names == ({''} if anonymize else {"Doe^CL000"})
+    finally:
+        pacs.shutdown()
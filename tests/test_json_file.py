@@ -0,0 +1,33 @@
+import json
+
+from pydicom.uid import generate_uid
+
+from dicom.config.server_config import TelemisConfig
+from dicom.services.get import Get
+from dicom.services.search_criteria import SearchCriteria
+from helpers import make_instance
+from pacs import StandInPacs
+
+
+def test_metadata_of_successive_retrievals_is_merged(tmp_path):
+    study_a, study_b = generate_uid(), generate_uid()
+    instances = [make_instance("CL001", study_a, generate_uid(), number, 1, "SER A") for number in (1, 2)]
+    instances += [make_instance("CL001", study_b, generate_uid(), number, 7, "SER B") for number in (1, 2, 3)]
+    pacs = StandInPacs(instances)
+    config = type('StandInConfig', (TelemisConfig,), dict(
+        HOST="127.0.0.1", PORT=pacs.port, CALLED_AET="TELEMISQR", SOURCE_NODES=[]))
+    try:
+        get = Get(config, output_dir=tmp_path)
+        # One retrieve_data per study, as the CLI does per instance at IMAGE level
+        for study_uid in (study_a, study_b):
+            criteria = SearchCriteria(level='STUDY', study_instance_uid=study_uid)
+            criteria.anonymize_data = False
+            assert get.retrieve_data(criteria)
+    finally:
+        pacs.shutdown()
+
+    metadata = json.loads((tmp_path / "CL001" / "series_metadata.json").read_text())
+    assert metadata["PatientID"] == "CL001"
+    assert metadata["SeriesNumber"] == [1, 7]
+    assert metadata["Instances"] == 5
+    assert metadata["FirstArrival"] <= metadata["LastArrival"]
@@ -0,0 +1,56 @@
+import os
+import time
+
+from pynetdicom import evt
+
+from dicom.config.server_config import TelemisConfig
+from dicom.services.move import Move
+from dicom.services.search_criteria import SearchCriteria
+from helpers import make_instances
+from pacs import StandInPacs
+
+
+def test_each_series_is_handed_over_once_its_move_completes(tmp_path):
+    instances = make_instances(patients=1, series=3, instances=4)
+    pacs = StandInPacs(instances, destinations={"MOVESCU": 0}, delay=0.05)
+    config = type('StandInConfig', (TelemisConfig,), dict(
+        HOST="127.0.0.1", PORT=pacs.port, CALLED_AET="TELEMISQR", CALLING_AET="MOVESCU", SOURCE_NODES=[],
+        RETRIEVE_BATCH_SIZE=1))
+    move = Move(config, output_dir=tmp_path / "out")
+    scp = move.ae.start_server(("127.0.0.1", 0), block=False, evt_handlers=[(evt.EVT_C_STORE, move._handle_store)])
+    pacs.destinations["MOVESCU"] = scp.server_address[1]
+    completed = []
+
+    def series_complete(record, series_uid):
+        completed.append((series_uid, len(record.files_by_series[series_uid]), move.files_received, time.monotonic()))
+    try:
+        series_uids = list(dict.fromkeys(ds.SeriesInstanceUID for ds in instances))
+        criteria = SearchCriteria(level='SERIES', study_instance_uid=instances[0].StudyInstanceUID,
+                                  series_instance_uid=series_uids)
+        records = move.move_tracked(criteria, on_series_complete=series_complete)
+        returned = time.monotonic()
+    finally:
+        scp.shutdown()
+        pacs.shutdown()
+
+    assert len(records) == 3
+    assert [series_uid for series_uid, *_ in completed] == series_uids
+    assert all(files == 4 for _, files, _, _ in completed)
+    # The first series is handed over while the others are still on their way
+    assert completed[0][2] == 4
+    assert returned - completed[0][3] > 0.3
+
+
+def test_final_sort_keeps_the_files_it_could_not_sort(tmp_path, capsys):
+    move = Move(TelemisConfig, output_dir=tmp_path / "out")
+    incoming = move.temp_dir / "CL000"
+    incoming.mkdir(parents=True)
+    make_instances(1, 1, 1)[0].save_as(incoming / "a.dcm", enforce_file_format=False)
+    (incoming / "b.dcm").write_bytes(b"truncated")
+    (incoming / ".c.dcm.part").write_bytes(b"interrupted write")
+    move.final_global_sort(workers=1)
+
+    assert os.listdir(tmp_path / "out" / "CL000" / "1_SER 0") == ["a.dcm"]
+    # Not sorted: kept and reported, the interrupted write is dropped
+    assert os.listdir(incoming) == ["b.dcm"]
+    assert "1 fichier(s) non trié(s)" in capsys.readouterr().out
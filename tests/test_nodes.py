@@ -0,0 +1,129 @@
+import socket
+import threading
+import time
+
+import pytest
+from pynetdicom import AE
+from pynetdicom.sop_class import Verification
+
+from dicom.services.nodes import NodePool, SourceNode
+from pacs import StandInPacs
+
+
+def echo_ae():
+    ae = AE("TESTSCU")
+    ae.add_requested_context(Verification)
+    ae.network_timeout = 5
+    ae.acse_timeout = 5
+    return ae
+
+
+def closed_port():
+    """A local port nothing listens on"""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def node(pacs_or_port, name, **options):
+    port = pacs_or_port if isinstance(pacs_or_port, int) else pacs_or_port.port
+    return SourceNode("127.0.0.1", port, "TELEMISQR", name=name, **options)
+
+
+def test_failover_to_the_next_node():
+    pacs = StandInPacs([])
+    try:
+        down, up = node(closed_port(), "down", weight=100), node(pacs, "up")
+        pool = NodePool([down, up], retry_delay=60)
+        ae = echo_ae()
+        for _ in range(3):
+            with pool.association(ae) as (chosen, assoc):
+                assert chosen is up and assoc.send_c_echo().Status == 0x0000
+        # Taken out for retry_delay after its first refusal, not tried again
+        assert down.failures == 1 and down.requests == 1 and up.requests == 3
+        assert pool.report()[0].endswith("down")
+        assert pacs.associations == 3
+    finally:
+        pacs.shutdown()
+
+
+def test_concurrent_requests_stay_within_each_node_cap():
+    pacs_a, pacs_b = StandInPacs([]), StandInPacs([])
+    try:
+        nodes = [node(pacs_a, "a", max_associations=2), node(pacs_b, "b", max_associations=1)]
+        pool = NodePool(nodes)
+        ae = echo_ae()
+        lock = threading.Lock()
+        active = {"a": 0, "b": 0}
+        peak = {"a": 0, "b": 0}
+        statuses = []
+
+        def request():
+            with pool.association(ae) as (chosen, assoc):
+                with lock:
+                    active[chosen.name] += 1
+                    peak[chosen.name] = max(peak[chosen.name], active[chosen.name])
+                statuses.append(assoc.send_c_echo().Status)
+                time.sleep(0.1)
+                with lock:
+                    active[chosen.name] -= 1
+        threads = [threading.Thread(target=request) for _ in range(9)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+
+        assert statuses == [0x0000] * 9
+        assert peak == {"a": 2, "b": 1}
+        assert pacs_a.associations + pacs_b.associations == 9
+        assert all(n.in_flight == 0 for n in nodes)
+    finally:
+        pacs_a.shutdown()
+        pacs_b.shutdown()
+
+
+def test_keep_alive_reuses_the_idle_association():
+    pacs = StandInPacs([])
+    try:
+        pool = NodePool([node(pacs, "pacs", max_associations=2)], keep_alive=30)
+        ae = echo_ae()
+        for _ in range(4):
+            with pool.association(ae) as (_, assoc):
+                assert assoc.send_c_echo().Status == 0x0000
+        assert pacs.associations == 1 and pool.reused == 3
+
+        # Another AE never gets the association of the first one
+        with pool.association(echo_ae()) as (_, assoc):
+            assert assoc.send_c_echo().Status == 0x0000
+        assert pacs.associations == 2
+
+        pool.close_idle()
+        deadline = time.monotonic() + 5
+        while pacs.active and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert pacs.active == 0
+    finally:
+        pacs.shutdown()
+
+
+def test_a_single_node_is_not_taken_out_by_one_refusal():
+    pacs = StandInPacs([])
+    port = closed_port()
+    try:
+        only = node(port, "only")
+        pool = NodePool([only], retry_delay=60)
+        ae = echo_ae()
+        # Refused: this request fails, the node stays available for the next ones
+        with pytest.raises(ConnectionError):
+            with pool.association(ae):
+                pass
+        assert only.failures == 1 and only.in_flight == 0
+        assert pool.acquire() is only
+        pool.release(only)
+
+        only.port = pacs.port
+        with pool.association(ae) as (chosen, assoc):
+            assert chosen is only and assoc.send_c_echo().Status == 0x0000
+        assert only.failures == 0 and pool.report()[0].endswith("up")
+    finally:
+        pacs.shutdown()
@@ -0,0 +1,35 @@
+import warnings
+import zipfile
+
+from dicom.services.pack import PackReader, PackStore, pack_path
+
+
+def test_an_instance_packed_again_unchanged_is_not_appended(tmp_path):
+    series_dir = tmp_path / "CL000" / "1_SER 0"
+    src = tmp_path / "b.dcm"
+    src.write_bytes(b"B" * 100)
+    store = PackStore()
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        store.add_bytes(series_dir, "1.1", b"A" * 100)
+        store.add_bytes(series_dir, "1.1", b"A" * 100)
+        store.add_file(series_dir, "1.2", src)
+        store.close()
+        # Reopened for append (e.g. a second run): the members already there are recognised too
+        store.add_file(series_dir, "1.2", src)
+        store.add_bytes(series_dir, "1.1", b"A" * 100)
+        store.close()
+
+    pack = pack_path(series_dir)
+    size = pack.stat().st_size
+    with zipfile.ZipFile(pack) as zf:
+        assert sorted(zf.namelist()) == ["1.1.dcm", "1.2.dcm"]
+
+    # Same size, other content: appended, the index points to the new bytes
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        store.add_bytes(series_dir, "1.1", b"C" * 100)
+        store.close()
+    assert pack.stat().st_size > size
+    with PackReader(pack) as reader:
+        assert reader.read("1.1") == b"C" * 100 and reader.read("1.2") == b"B" * 100
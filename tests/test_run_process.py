@@ -0,0 +1,87 @@
+import threading
+from types import SimpleNamespace
+
+import dicom.run_process as run_process
+from dicom.services.pipeline import SeriesPipeline
+from dicom.services.sync_state import SyncState
+
+
+class ListingFind:
+    """Find answering every series search with the same two series"""
+
+    last_error = None
+
+    def __init__(self, config):
+        pass
+
+    def search_data(self, criteria):
+        return [SimpleNamespace(StudyInstanceUID="1.2", SeriesInstanceUID=uid) for uid in ("1.2.1", "1.2.2")]
+
+
+class SteppedMove:
+    """Mover completing one series per request, noting what the pipeline got before each"""
+
+    catalog = None
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.submitted_before = []
+
+    def move_tracked(self, criteria, on_series_complete=None):
+        records = []
+        for series_uid in criteria.series_instance_uid:
+            self.submitted_before.append(list(self.pipeline.submitted))
+            record = SimpleNamespace(series_uids={series_uid}, status=0,
+                                     files_by_series={series_uid: [f"{series_uid}.dcm"]}, duplicates_by_series={})
+            on_series_complete(record, series_uid)
+            records.append(record)
+        return records
+
+
+def test_series_are_submitted_as_their_moves_complete(monkeypatch):
+    monkeypatch.setattr(run_process, "Find", ListingFind)
+    pipeline = SimpleNamespace(submitted=[])
+    pipeline.submit = pipeline.submitted.append
+    mover = SteppedMove(pipeline)
+    stats = run_process.TransferStats()
+    assert run_process.process_single_series("CL001", "SER A", False, stats, pipeline, mover) == 2
+    # The first series was in the pipeline before the second one was moved
+    assert mover.submitted_before == [[], [["1.2.1.dcm"]]]
+    assert pipeline.submitted == [["1.2.1.dcm"], ["1.2.2.dcm"]]
+
+
+class ListedSeriesMove:
+    """Mover receiving every series of the request at once"""
+
+    catalog = None
+
+    def move_tracked(self, criteria, on_series_complete=None):
+        record = SimpleNamespace(series_uids=set(criteria.series_instance_uid), status=0, duplicates_by_series={},
+                                 files_by_series={uid: [f"{uid}.dcm"] for uid in criteria.series_instance_uid})
+        for series_uid in sorted(record.series_uids):
+            on_series_complete(record, series_uid)
+        return [record]
+
+
+def test_sync_checkpoint_waits_for_the_pipeline(tmp_path, monkeypatch):
+    monkeypatch.setattr(run_process, "Find", ListingFind)
+    release = threading.Event()
+
+    def sort_file(path):
+        release.wait(10)
+        if path == "1.2.2.dcm":
+            raise OSError("disk full")
+        return path
+
+    sync = SyncState(tmp_path / "sync.sqlite")
+    pipeline = SeriesPipeline(sort_file=sort_file)
+    stats = run_process.TransferStats()
+    assert run_process.process_single_series("CL001", "SER A", False, stats, pipeline, ListedSeriesMove(), sync) == 2
+    # Received, not sorted yet: nothing synced
+    assert sync.synced_series("CL001", ["1.2.1", "1.2.2"]) == set()
+
+    release.set()
+    pipeline.close()
+    # The series that failed its sort is moved again next time, the checkpoint stays where it was
+    assert sync.synced_series("CL001", ["1.2.1", "1.2.2"]) == {"1.2.1"}
+    assert sync.checkpoint("CL001", "SER A") is None
@@ -0,0 +1,59 @@
+import os
+
+import pytest
+from pydicom.uid import generate_uid
+
+from dicom.services.sorter import place_file, process_pool, sort_tree
+from helpers import make_instances
+
+
+@pytest.mark.parametrize('mode', ['move', 'link', 'copy'])
+def test_place_file_onto_itself_keeps_the_file(tmp_path, mode):
+    path = tmp_path / "a.dcm"
+    path.write_bytes(b"data")
+    place_file(str(path), path, mode)
+    assert path.read_bytes() == b"data"
+
+
+def test_link_onto_a_hardlink_of_the_same_file(tmp_path):
+    src, dst = tmp_path / "a.dcm", tmp_path / "b.dcm"
+    src.write_bytes(b"data")
+    os.link(src, dst)
+    place_file(str(src), dst, 'link')
+    assert src.read_bytes() == dst.read_bytes() == b"data"
+
+
+@pytest.mark.parametrize('mode', ['move', 'link', 'copy'])
+def test_resorting_a_sorted_tree_in_place(tmp_path, mode):
+    for ds in make_instances(1, 2, 3):
+        ds.save_as(tmp_path / f"{generate_uid()}.dcm", enforce_file_format=True)
+    first = sort_tree(tmp_path, tmp_path / "sorted", workers=1)
+    assert first.sorted == 6 and not first.errors
+
+    again = sort_tree(tmp_path / "sorted", tmp_path / "sorted", mode=mode, workers=1)
+    assert again.sorted == 6 and not again.errors
+    files = [f for _, _, fs in os.walk(tmp_path / "sorted") for f in fs]
+    assert len(files) == 6
+    assert all(os.path.getsize(os.path.join(root, f)) > 0 for root, _, fs in os.walk(tmp_path / "sorted") for f in fs)
+
+
+def test_files_without_preamble_are_sorted(tmp_path):
+    src = tmp_path / "in"
+    src.mkdir()
+    instances = make_instances(1, 1, 2)
+    instances[0].save_as(src / "raw.dcm", enforce_file_format=False)
+    instances[1].save_as(src / "part10.dcm", enforce_file_format=True)
+    (src / "notes.txt").write_text("not a DICOM file")
+    report = sort_tree(src, tmp_path / "sorted", workers=1)
+    assert report.sorted == 2 and report.skipped == 1 and not report.errors
+    assert sorted(os.listdir(tmp_path / "sorted" / "CL000" / "1_SER 0")) == ["part10.dcm", "raw.dcm"]
+
+
+def test_the_pool_workers_are_not_forked_from_the_caller(tmp_path):
+    with process_pool(1) as executor:
+        assert executor._mp_context.get_start_method() in ('forkserver', 'spawn')
+        assert executor.submit(os.getpid).result() != os.getpid()
+    for i, instance in enumerate(make_instances(1, 1, 3)):
+        instance.save_as(tmp_path / f"{i}.dcm", enforce_file_format=True)
+    report = sort_tree(tmp_path, tmp_path / "sorted", workers=2)
+    assert report.sorted == 3 and not report.errors
@@ -0,0 +1,109 @@
+import numpy as np
+import pydicom
+import pytest
+from pydicom.uid import generate_uid
+
+from dicom.services.t2map import DICOM_T2_SCALE, fit_chunk, fit_series, fit_volume, output_dir_for
+from dicom.services.sorter import scan_files
+from helpers import write_image
+
+ECHO_TIMES = np.arange(1, 18) * 10.0
+
+
+def decay(t2, s0=1000.0, echo_times=ECHO_TIMES):
+    """(echoes, voxels) mono-exponential signal of each T2"""
+    return s0 * np.exp(-np.asarray(echo_times)[:, None] / np.atleast_1d(t2)[None, :])
+
+
+def test_fit_recovers_t2_and_s0():
+    t2, s0 = fit_chunk(decay([40.0]), ECHO_TIMES)
+    assert t2[0] == pytest.approx(40.0, rel=1e-4) and s0[0] == pytest.approx(1000.0, rel=1e-4)
+
+
+def test_fit_with_a_noise_floor():
+    floor = 20.0
+    # Magnitude signal biased by the noise: sqrt(S^2 + floor^2), corrected in quadrature by the fit
+    signal = np.sqrt(decay([40.0]) ** 2 + floor ** 2)
+    t2, _ = fit_chunk(signal, ECHO_TIMES, noise_floor=floor)
+    assert t2[0] == pytest.approx(40.0, rel=1e-4)
+    # Without the correction the tail of the decay bends the fit upward
+    biased, _ = fit_chunk(signal, ECHO_TIMES)
+    assert biased[0] > 40.5
+
+
+def test_voxels_without_two_usable_echoes_or_decay_get_zero():
+    signal = np.zeros((len(ECHO_TIMES), 4))
+    signal[0, 0] = 500.0                    # a single echo above zero
+    signal[:, 1] = 300.0                    # flat: no decay
+    signal[:, 2] = decay([40.0])[:, 0][::-1]  # growing
+    signal[:, 3] = decay([40.0])[:, 0]
+    t2, s0 = fit_chunk(signal, ECHO_TIMES)
+    assert list(t2[:3]) == [0.0, 0.0, 0.0] and list(s0[:3]) == [0.0, 0.0, 0.0]
+    assert t2[3] == pytest.approx(40.0, rel=1e-4)
+
+    # Below floor_factor * floor from the second echo on: a single usable echo
+    floor_limited, _ = fit_chunk(decay([5.0]), ECHO_TIMES, noise_floor=150.0)
+    assert floor_limited[0] == 0.0
+
+
+def test_skip_echoes_leaves_the_first_echoes_out():
+    signal = decay([40.0, 80.0])
+    # Stimulated-echo contamination of the first echo
+    signal[0] *= 0.6
+    t2, _ = fit_volume(signal.reshape(len(ECHO_TIMES), 1, 1, 2), ECHO_TIMES, skip_echoes=1)
+    assert t2.ravel() == pytest.approx([40.0, 80.0], rel=1e-4)
+    contaminated, _ = fit_volume(signal.reshape(len(ECHO_TIMES), 1, 1, 2), ECHO_TIMES)
+    assert abs(contaminated.ravel()[0] - 40.0) > 1.0
+
+
+@pytest.mark.parametrize('chunk_voxels', [1, 7, 30, 1 << 16])
+def test_chunks_do_not_change_the_maps(chunk_voxels):
+    t2_true = np.linspace(10.0, 200.0, 2 * 3 * 5)
+    echoes = decay(t2_true).reshape(len(ECHO_TIMES), 2, 3, 5)
+    t2, s0 = fit_volume(echoes, ECHO_TIMES, chunk_voxels=chunk_voxels)
+    assert t2.shape == s0.shape == (2, 3, 5)
+    assert t2.ravel() == pytest.approx(t2_true, rel=1e-4)
+
+
+def write_t2_series(series_dir, t2_by_slice, echo_times=(10.0, 20.0, 30.0, 40.0)):
+    """One image per (echo, slice), slices along the z axis written in reverse order"""
+    series_uid, study_uid = generate_uid(), generate_uid()
+    for echo, te in enumerate(echo_times, 1):
+        for index in reversed(range(len(t2_by_slice))):
+            pixels = np.full((4, 4), np.rint(1000.0 * np.exp(-te / t2_by_slice[index])))
+            write_image(series_dir, pixels, (0, 0, 5.0 * index), study_uid=study_uid, series_uid=series_uid,
+                        EchoTime=te, EchoNumbers=echo, SeriesDescription="T2mapping 2D TRA", SeriesNumber=5)
+    return series_uid
+
+
+def test_fit_series_as_numpy(tmp_path):
+    series_dir = tmp_path / "CL000" / "5_T2mapping 2D TRA"
+    write_t2_series(series_dir, [30.0, 60.0])
+    out_dir, voxels = fit_series(series_dir, root=tmp_path)
+    assert out_dir == str(output_dir_for(series_dir)) and voxels == 32
+    t2 = np.load(output_dir_for(series_dir) / "T2map.npy")
+    assert t2.shape == (2, 4, 4)
+    assert np.allclose(t2[0], 30.0, rtol=0.02) and np.allclose(t2[1], 60.0, rtol=0.02)
+
+
+def test_fit_series_as_a_derived_dicom_series(tmp_path):
+    series_dir = tmp_path / "CL000" / "5_T2mapping 2D TRA"
+    source_uid = write_t2_series(series_dir, [30.0, 60.0, 90.0])
+    out_dir, _ = fit_series(series_dir, root=tmp_path, fmt='dicom')
+
+    images = sorted((pydicom.dcmread(path) for path in scan_files(out_dir)), key=lambda ds: ds.InstanceNumber)
+    assert [ds.InstanceNumber for ds in images] == [1, 2, 3]
+    assert len({ds.SeriesInstanceUID for ds in images}) == 1 and images[0].SeriesInstanceUID != source_uid
+    assert images[0].SeriesNumber == 1005 and images[0].SeriesDescription == "T2mapping 2D TRA T2map"
+    assert all(float(ds.RescaleSlope) == 1 / DICOM_T2_SCALE and 'EchoTime' not in ds for ds in images)
+    # Slices in order along the normal, T2 in ms once rescaled
+    assert [float(ds.ImagePositionPatient[2]) for ds in images] == [0.0, 5.0, 10.0]
+    for ds, expected in zip(images, [30.0, 60.0, 90.0]):
+        assert np.allclose(ds.pixel_array * float(ds.RescaleSlope), expected, rtol=0.02)
+
+
+def test_a_single_echo_series_is_refused(tmp_path):
+    series_dir = tmp_path / "CL000" / "5_T2mapping 2D TRA"
+    write_t2_series(series_dir, [30.0], echo_times=(10.0,))
+    with pytest.raises(ValueError, match="two echoes"):
+        fit_series(series_dir, root=tmp_path)
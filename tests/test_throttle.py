@@ -0,0 +1,106 @@
+import threading
+from datetime import time as dtime
+from time import monotonic
+
+import pytest
+
+from dicom.services.throttle import MB, ThrottleSchedule, ThrottleWindow, Throttler, TokenBucket, parse_window
+
+
+def test_an_unlimited_bucket_never_waits():
+    bucket = TokenBucket()
+    assert bucket.consume(10 ** 9) == 0.0
+
+
+def test_the_bucket_allows_a_burst_then_paces_at_its_rate():
+    bucket = TokenBucket(rate=100, burst=0.5)
+    # A bucket that was unlimited starts full: the 50 tokens of the burst are free
+    assert bucket.reserve(50) == 0.0
+    assert bucket.reserve(10) == pytest.approx(0.1, abs=0.02)
+    assert bucket.reserve(10) == pytest.approx(0.2, abs=0.02)
+
+    bucket = TokenBucket(rate=100, burst=0.1)
+    start = monotonic()
+    for _ in range(4):
+        bucket.consume(10)
+    assert 0.25 <= monotonic() - start < 1.0
+
+
+@pytest.mark.parametrize('rate', [0, 0.0, -5])
+def test_the_bucket_rejects_rates_that_are_not_positive(rate):
+    with pytest.raises(ValueError):
+        TokenBucket(rate=rate)
+
+
+def test_parse_window():
+    window = parse_window('08:00-19:00=20')
+    assert (window.start, window.end) == (dtime(8), dtime(19))
+    assert (window.bytes_per_second, window.instances_per_second) == (20 * MB, None)
+
+    window = parse_window(' 08:00 - 19:30 = 2.5 , 50 ')
+    assert (window.start, window.end) == (dtime(8), dtime(19, 30))
+    assert (window.bytes_per_second, window.instances_per_second) == (2.5 * MB, 50)
+
+    for spec in ('08:00-19:00=unlimited,10', '08:00-19:00=-,10', '08:00-19:00=,10'):
+        window = parse_window(spec)
+        assert (window.bytes_per_second, window.instances_per_second) == (None, 10)
+
+
+@pytest.mark.parametrize('spec', [
+    '08:00-19:00', '08:00=20', '8h-19h=20', '08:00-19:00=fast', '08:00-19:00=20,many',
+    '08:00-19:00=0', '08:00-19:00=20,0', '08:00-19:00=-1',
+])
+def test_parse_window_rejects_invalid_specs(spec):
+    with pytest.raises(ValueError, match='Invalid throttle window'):
+        parse_window(spec)
+
+
+def test_a_window_may_span_midnight():
+    night = parse_window('22:00-06:00=100')
+    assert night.contains(dtime(22))
+    assert night.contains(dtime(23, 30))
+    assert night.contains(dtime(0))
+    assert night.contains(dtime(5, 59))
+    assert not night.contains(dtime(6))
+    assert not night.contains(dtime(12))
+
+    day = parse_window('08:00-19:00=20')
+    assert day.contains(dtime(8))
+    assert not day.contains(dtime(19))
+    assert not day.contains(dtime(23))
+
+
+def test_the_first_matching_window_applies():
+    schedule = ThrottleSchedule(['12:00-14:00=5', '08:00-19:00=20,50', ThrottleWindow(dtime(22), dtime(6), None, 10)])
+    assert schedule.limits_at(dtime(13)) == (5 * MB, None)
+    assert schedule.limits_at(dtime(9)) == (20 * MB, 50)
+    assert schedule.limits_at(dtime(2)) == (None, 10)
+    assert schedule.limits_at(dtime(20)) == (None, None)
+    assert schedule
+    assert not ThrottleSchedule()
+    assert ThrottleSchedule().limits_at(dtime(12)) == (None, None)
+
+
+def test_the_throttler_reports_the_wall_clock_time_throttled():
+    # 20 instances/s with a burst of 1s, whatever the time of day
+    throttler = Throttler(['00:00-23:59:59.999999=-,20'])
+    throttler.instance_bucket.burst = 0.0
+
+    def receive():
+        for _ in range(5):
+            throttler.throttle(1000)
+
+    start = monotonic()
+    threads = [threading.Thread(target=receive) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = monotonic() - start
+
+    assert throttler.instances == 20
+    assert throttler.bytes == 20 * 1000
+    # The 4 handlers waited concurrently: their waits add up to much more than the time spent throttled
+    assert elapsed >= 0.9
+    assert 0.8 <= throttler.throttled_seconds <= elapsed
+    assert 'throttled' in throttler.report()
@@ -0,0 +1,73 @@
+import json
+import threading
+
+from dicom.services import tracing
+from dicom.services.tracing import Tracer
+
+
+def load(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)['traceEvents']
+
+
+def test_nested_spans_in_a_chrome_trace(tmp_path, monkeypatch):
+    tracer = Tracer()
+    monkeypatch.setattr(tracing, 'tracer', tracer)
+
+    @tracing.traced('find.search')
+    def search():
+        with tracing.span('find.request', node="pacs"):
+            pass
+        return 42
+
+    # Off: nothing recorded
+    assert search() == 42 and tracer.summary() == {}
+
+    tracer.enable(directory=tmp_path, prefix='test')
+    assert search() == 42
+    thread = threading.Thread(target=search, name="worker")
+    thread.start()
+    thread.join()
+    paths = tracer.write()
+    assert len(paths) == 1 and paths[0].name.startswith('test-') and paths[0].name.endswith('.trace.json')
+
+    events = load(paths[0])
+    spans = [event for event in events if event['ph'] == 'X']
+    assert sorted(event['name'] for event in spans) == ['find.request'] * 2 + ['find.search'] * 2
+    for outer in (event for event in spans if event['name'] == 'find.search'):
+        inner = next(event for event in spans if event['name'] == 'find.request' and event['tid'] == outer['tid'])
+        assert inner['args'] == {'node': 'pacs'} and inner['cat'] == 'find'
+        assert outer['ts'] <= inner['ts'] and inner['ts'] + inner['dur'] <= outer['ts'] + outer['dur']
+    names = {event['args']['name'] for event in events if event['ph'] == 'M'}
+    assert names == {threading.current_thread().name, "worker"}
+    assert tracer.summary()['find.search'][0] == 2
+
+    # Written: recording has stopped
+    search()
+    assert tracer.summary()['find.search'][0] == 2
+
+
+def test_events_are_streamed_in_batches(tmp_path):
+    tracer = Tracer(flush_events=10)
+    tracer.enable(directory=tmp_path)
+    for index in range(95):
+        with tracer.span('sort.file', index=index):
+            pass
+        assert len(tracer._events) < 10
+    paths = tracer.write()
+    spans = [event for event in load(paths[0]) if event['ph'] == 'X']
+    assert [int(event['args']['index']) for event in spans] == list(range(95))
+    count, total, longest = tracer.summary()['sort.file']
+    assert count == 95 and 0 <= longest <= total
+
+
+def test_profiling_writes_one_file_per_stage(tmp_path):
+    tracer = Tracer()
+    tracer.enable(profile=True, directory=tmp_path, prefix='run')
+    with tracer.span('pseudonymize.file'):
+        with tracer.span('pseudonymize.write'):
+            sum(range(1000))
+    paths = tracer.write()
+    # Only the outermost span of a thread is profiled
+    assert sorted(path.name.split('.', 1)[1] for path in paths[1:]) == ['pseudonymize.file.prof']
+    assert all(path.exists() for path in paths)
@@ -0,0 +1,114 @@
+import hashlib
+
+import numpy as np
+import pydicom
+import pytest
+from pydicom.uid import generate_uid
+
+from dicom.services import volume as volume_module
+from dicom.services.manifest import ManifestStore
+from dicom.services.sorter import scan_files
+from dicom.services.volume import build_volume, load_volume
+from helpers import write_image
+
+# Sagittal slices: rows along +y, columns along -z, normal -x
+SAGITTAL = (0, 1, 0, 0, 0, -1)
+
+
+def write_slices(series_dir, xs, echoes=((10.0, 1),), echo_keywords=('EchoTime', 'EchoNumbers')):
+    """One image per (echo, x), pixel value 100 * echo + slice index along x, written in a shuffled order"""
+    series_uid, study_uid = generate_uid(), generate_uid()
+    images = [(echo, index, x) for echo in range(len(echoes)) for index, x in enumerate(xs)]
+    rng = np.random.default_rng(0)
+    for echo, index, x in (images[i] for i in rng.permutation(len(images))):
+        attributes = dict(zip(('EchoTime', 'EchoNumbers'), echoes[echo]))
+        attributes = {key: value for key, value in attributes.items() if key in echo_keywords}
+        write_image(series_dir, np.full((3, 5), 100 * echo + index), (x, 10.0, 20.0), orientation=SAGITTAL,
+                    study_uid=study_uid, series_uid=series_uid, **attributes)
+    return series_uid
+
+
+def test_slices_are_ordered_along_the_normal(tmp_path):
+    series_dir = tmp_path / "CL000" / "3_SAG"
+    # Along the normal (-x), the slice at x = 8 comes first
+    write_slices(series_dir, [0.0, 4.0, 8.0])
+    volume = build_volume(series_dir)
+    assert volume.array.shape == (3, 3, 5)
+    assert [int(volume.array[s, 0, 0]) for s in range(3)] == [2, 1, 0]
+    assert volume.geometry['slice_positions'] == [-8.0, -4.0, 0.0]
+    assert volume.geometry['slice_spacing'] == pytest.approx(4.0)
+
+
+@pytest.mark.parametrize('echo_keywords', [('EchoTime', 'EchoNumbers'), ('EchoNumbers',)])
+def test_echoes_are_split_by_echo_time_or_number(tmp_path, echo_keywords):
+    series_dir = tmp_path / "CL000" / "5_ME"
+    write_slices(series_dir, [0.0, 4.0], echoes=((30.0, 3), (10.0, 1), (20.0, 2)), echo_keywords=echo_keywords)
+    volume = build_volume(series_dir)
+    assert volume.array.shape == (3, 2, 3, 5)
+    assert volume.geometry['axes'] == ['echo', 'slice', 'row', 'column']
+    assert volume.echo_times == ([10.0, 20.0, 30.0] if 'EchoTime' in echo_keywords else [1.0, 2.0, 3.0])
+    # Echoes in increasing order: the second echo written (10 ms) comes first
+    assert [int(volume.echo(e)[1, 0, 0]) for e in range(3)] == [100, 200, 0]
+
+
+def test_echoes_with_different_slice_counts_are_refused(tmp_path):
+    series_dir = tmp_path / "CL000" / "5_ME"
+    write_slices(series_dir, [0.0, 4.0], echoes=((10.0, 1), (20.0, 2)))
+    write_image(series_dir, np.zeros((3, 5)), (12.0, 10.0, 20.0), orientation=SAGITTAL, EchoTime=10.0)
+    with pytest.raises(ValueError, match="slice counts"):
+        build_volume(series_dir)
+
+
+def test_affine_maps_voxels_to_patient_coordinates(tmp_path):
+    series_dir = tmp_path / "CL000" / "3_SAG"
+    write_slices(series_dir, [0.0, 4.0, 8.0])
+    affine = build_volume(series_dir).affine
+    # (column, row, slice) -> LPS: columns step 0.6 mm along +y, rows 0.8 mm along -z, slices 4 mm along -x
+    assert affine @ [0, 0, 0, 1] == pytest.approx([8.0, 10.0, 20.0, 1.0])
+    assert affine @ [4, 2, 2, 1] == pytest.approx([0.0, 10.0 + 4 * 0.6, 20.0 - 2 * 0.8, 1.0])
+
+
+def test_the_cache_is_loaded_memory_mapped(tmp_path, monkeypatch):
+    series_dir = tmp_path / "CL000" / "3_SAG"
+    write_slices(series_dir, [0.0, 4.0])
+    first = load_volume(series_dir)
+    assert isinstance(first.array, np.memmap) and not first.array.flags.writeable
+
+    def rebuild(*args, **kwargs):
+        raise AssertionError("cache rebuilt")
+    monkeypatch.setattr(volume_module, 'build_volume', rebuild)
+    again = load_volume(series_dir)
+    assert isinstance(again.array, np.memmap) and np.array_equal(again.array, first.array)
+
+
+def test_the_cache_is_rebuilt_when_a_file_changes(tmp_path):
+    series_dir = tmp_path / "CL000" / "3_SAG"
+    write_slices(series_dir, [0.0, 4.0])
+    assert int(load_volume(series_dir).array.max()) == 1
+    path = sorted(scan_files(str(series_dir)))[0]
+    ds = pydicom.dcmread(path)
+    ds.PixelData = np.full((3, 5), 7, dtype=np.uint16).tobytes()
+    ds.save_as(path, enforce_file_format=True)
+    assert int(load_volume(series_dir).array.max()) == 7
+
+
+def test_the_cache_is_rebuilt_when_the_manifest_changes(tmp_path, monkeypatch):
+    series_dir = tmp_path / "CL000" / "3_SAG"
+    series_uid = write_slices(series_dir, [0.0, 4.0])
+    store = ManifestStore(tmp_path)
+    files = sorted(scan_files(str(series_dir)))
+    for index, path in enumerate(files):
+        with open(path, 'rb') as f:
+            store.record(series_uid, f"1.2.{index}", path, 0, hashlib.sha256(f.read()).hexdigest())
+    store.flush()
+    load_volume(series_dir)
+
+    builds = []
+    monkeypatch.setattr(volume_module, 'build_volume', lambda *args, **kwargs: builds.append(args))
+    load_volume(series_dir)
+    assert builds == []
+    # Same files on disk, another hash in the manifest (e.g. rewritten then restored with its mtime)
+    store.update_file(series_uid, "1.2.0", files[0], 0, "0" * 64)
+    store.flush()
+    load_volume(series_dir)
+    assert len(builds) == 1
@@ -0,0 +1,121 @@
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+
+import dicom.run_process as run_process
+from dicom.services.pipeline import SeriesPipeline
+from dicom.services.work_queue import DONE, LEASED, PENDING, WorkQueue
+
+PATIENTS = [f"CL{i:03d}" for i in range(12)]
+PATTERNS = ["SER A", "SER B", "SER C"]
+
+
+def _lease_all(db_path, worker, log_path):
+    """Worker process: lease and complete jobs until none is left, logging each job id"""
+    queue = WorkQueue(db_path, lease_seconds=30)
+    with open(log_path, 'a') as log:
+        while True:
+            job = queue.lease(worker)
+            if job is None:
+                return
+            time.sleep(0.001)
+            queue.complete(job.id, worker, 1)
+            log.write(f"{job.id} {worker}\n")
+            log.flush()
+
+
+def _lease_and_die(db_path):
+    """Worker process killed while holding a lease"""
+    queue = WorkQueue(db_path, lease_seconds=0.5)
+    assert queue.lease("doomed") is not None
+    os._exit(1)
+
+
+def test_rollback_journal(tmp_path):
+    queue = WorkQueue(tmp_path / "jobs.sqlite")
+    mode = sqlite3.connect(tmp_path / "jobs.sqlite").execute("PRAGMA journal_mode").fetchone()[0]
+    assert mode == "delete"
+    queue.close()
+
+
+def test_processes_share_the_queue_without_double_leases(tmp_path):
+    db_path = str(tmp_path / "jobs.sqlite")
+    assert WorkQueue(db_path).enqueue(PATIENTS, PATTERNS) == len(PATIENTS) * len(PATTERNS)
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=_lease_all, args=(db_path, f"w{i}", str(tmp_path / f"w{i}.log")))
+                 for i in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+
+    job_ids = [int(line.split()[0]) for path in tmp_path.glob("w*.log") for line in path.read_text().splitlines()]
+    assert sorted(job_ids) == list(range(1, len(PATIENTS) * len(PATTERNS) + 1))
+    assert WorkQueue(db_path).counts()[DONE] == len(job_ids)
+
+
+def test_lease_of_a_dead_process_is_taken_over(tmp_path):
+    db_path = str(tmp_path / "jobs.sqlite")
+    WorkQueue(db_path).enqueue(["CL000"], ["SER A"])
+    process = multiprocessing.get_context("spawn").Process(target=_lease_and_die, args=(db_path,))
+    process.start()
+    process.join(60)
+    assert WorkQueue(db_path).counts()[LEASED] == 1
+
+    time.sleep(0.6)
+    queue = WorkQueue(db_path)
+    job = queue.lease("survivor")
+    assert job is not None and job.attempts == 2
+
+
+def test_job_completed_only_once_its_series_are_sorted(tmp_path, monkeypatch):
+    queue = WorkQueue(tmp_path / "jobs.sqlite", lease_seconds=30)
+    queue.enqueue(["CL000"], ["SER A"])
+    release = threading.Event()
+
+    def sort_file(path):
+        release.wait(10)
+        return path
+
+    def process_single_series(p_id, series_desc, research_pseudo, stats, pipeline, mover, sync):
+        stats.increment_series()
+        pipeline.submit(["a.dcm", "b.dcm"])
+        return 1
+
+    monkeypatch.setattr(run_process, "process_single_series", process_single_series)
+    pipeline = SeriesPipeline(sort_file=sort_file)
+    stats = run_process.TransferStats()
+    worker = threading.Thread(target=run_process.run_worker,
+                              args=(queue, "w0", False, stats, pipeline, None, 1, 0.05))
+    worker.start()
+    try:
+        time.sleep(0.3)
+        # Transferred, still in the pipeline: the job keeps its lease
+        assert queue.counts()[LEASED] == 1 and queue.counts()[DONE] == 0
+    finally:
+        release.set()
+    worker.join(10)
+    assert not worker.is_alive()
+    assert queue.counts() == {PENDING: 0, LEASED: 0, DONE: 1, 'failed': 0}
+    pipeline.close()
+
+
+def test_job_with_a_failed_sort_goes_back_to_the_queue(tmp_path, monkeypatch):
+    queue = WorkQueue(tmp_path / "jobs.sqlite", lease_seconds=30, max_attempts=1)
+    queue.enqueue(["CL000"], ["SER A"])
+
+    def sort_file(path):
+        raise OSError("disk full")
+
+    def process_single_series(p_id, series_desc, research_pseudo, stats, pipeline, mover, sync):
+        pipeline.submit(["a.dcm"])
+        return 1
+
+    monkeypatch.setattr(run_process, "process_single_series", process_single_series)
+    pipeline = SeriesPipeline(sort_file=sort_file)
+    run_process.run_worker(queue, "w0", False, run_process.TransferStats(), pipeline, None, 1, 0.05)
+    assert queue.counts()['failed'] == 1
+    pipeline.close()
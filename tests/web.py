@@ -0,0 +1,146 @@
+"""Stand-in QIDO-RS / WADO-RS server serving synthetic instances"""
+
+import fnmatch
+import io
+import json
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from pydicom import Dataset, dcmwrite
+
+RESOURCE_KEYS = {
+    'studies': ['PatientID', 'PatientName', 'StudyDate', 'StudyInstanceUID', 'StudyDescription'],
+    'series': ['PatientID', 'PatientName', 'StudyDate', 'StudyInstanceUID', 'SeriesInstanceUID', 'SeriesNumber',
+               'SeriesDescription', 'Modality'],
+    'instances': ['StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID', 'InstanceNumber'],
+}
+RESOURCE_UNIQUE = {'studies': 'StudyInstanceUID', 'series': 'SeriesInstanceUID', 'instances': 'SOPInstanceUID'}
+CONTROL_PARAMS = ('limit', 'offset', 'includefield', 'fuzzymatching')
+
+
+def part10(ds):
+    buffer = io.BytesIO()
+    dcmwrite(buffer, ds, enforce_file_format=True)
+    return buffer.getvalue()
+
+
+def matches(ds, params):
+    for keyword, pattern in params.items():
+        if keyword in CONTROL_PARAMS:
+            continue
+        value = str(getattr(ds, keyword, '') or '')
+        if keyword.endswith('UID'):
+            if value not in pattern.split(','):
+                return False
+        elif not fnmatch.fnmatchcase(value, pattern):
+            return False
+    return True
+
+
+class StandInWeb:
+    """DICOMweb server on 127.0.0.1, base URL `url`.
+
+    page_cap: at most page_cap QIDO-RS results per response whatever the
+    limit asked (like most servers). chunked: WADO-RS responses sent with
+    chunked transfer encoding. WADO-RS of a series in fail_series answers 500.
+    """
+
+    def __init__(self, instances, page_cap=None, chunked=False, fail_series=()):
+        self.instances = instances
+        self.files = {ds.SOPInstanceUID: part10(ds) for ds in instances}
+        self.page_cap = page_cap
+        self.chunked = chunked
+        self.fail_series = set(fail_series)
+        self.qido_requests = []
+        self.connections = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/dicom-web"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def _handler(self):
+        web = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                web.connections += 1
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status, body=b'', content_type=None):
+                self.send_response(status)
+                if content_type:
+                    self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                parts = [part for part in url.path.split('/') if part][1:]
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                if len(parts) == 1:
+                    return self.qido(parts[0], params)
+                if len(parts) == 3 and parts[2] == 'series':
+                    return self.qido('series', dict(params, StudyInstanceUID=parts[1]))
+                if len(parts) >= 4 and parts[0] == 'studies' and parts[2] == 'series':
+                    return self.wado(parts[1], parts[3], parts[5] if len(parts) >= 6 else None)
+                return self._reply(404)
+
+            def qido(self, resource, params):
+                web.qido_requests.append(params)
+                seen, found = set(), []
+                for ds in web.instances:
+                    key = getattr(ds, RESOURCE_UNIQUE[resource])
+                    if key in seen or not matches(ds, params):
+                        continue
+                    seen.add(key)
+                    identifier = Dataset()
+                    for keyword in RESOURCE_KEYS[resource]:
+                        if keyword in ds:
+                            setattr(identifier, keyword, getattr(ds, keyword))
+                    found.append(identifier.to_json_dict())
+                offset = int(params.get('offset', 0))
+                limit = int(params.get('limit', len(found)))
+                if web.page_cap:
+                    limit = min(limit, web.page_cap)
+                page = found[offset:offset + limit]
+                if not page:
+                    return self._reply(204)
+                return self._reply(200, json.dumps(page).encode(), 'application/dicom+json')
+
+            def wado(self, study_uid, series_uid, sop_uid):
+                if series_uid in web.fail_series:
+                    return self._reply(500, b'series unavailable')
+                selected = [ds for ds in web.instances if ds.StudyInstanceUID == study_uid
+                            and ds.SeriesInstanceUID == series_uid and sop_uid in (None, ds.SOPInstanceUID)]
+                if not selected:
+                    return self._reply(404)
+                boundary = uuid.uuid4().hex
+                body = b''.join(f"--{boundary}\r\nContent-Type: application/dicom\r\n\r\n".encode()
+                                + web.files[ds.SOPInstanceUID] + b"\r\n" for ds in selected)
+                body += f"--{boundary}--\r\n".encode()
+                content_type = f'multipart/related; type="application/dicom"; boundary={boundary}'
+                if not web.chunked:
+                    return self._reply(200, body, content_type)
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                for index in range(0, len(body), 777):
+                    chunk = body[index:index + 777]
+                    self.wfile.write(b'%x\r\n' % len(chunk) + chunk + b'\r\n')
+                self.wfile.write(b'0\r\n\r\n')
+                return None
+
+        return Handler
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()